@@ -14,8 +14,10 @@
 
 # flake8: noqa
 from object_database.tcp_server import connect, TcpServer
-from object_database.persistence import RedisPersistence, InMemoryPersistence
-from object_database.schema import Schema, Indexed, Index, SubscribeLazilyByDefault
+from object_database.async_database_connection import AsyncDatabaseConnection, connectAsync
+from object_database.replica_server import ReplicaServer
+from object_database.persistence import RedisPersistence, InMemoryPersistence, WriteAheadLogPersistence
+from object_database.schema import Schema, Indexed, Index, DeltaEncoded, SubscribeLazilyByDefault
 from object_database.core_schema import core_schema
 from object_database.object import DatabaseObject
 from object_database.service_manager.ServiceSchema import service_schema
@@ -3,11 +3,21 @@ import struct
 import threading
 import logging
 import traceback
+import lz4.frame
 
 from typed_python import serialize, deserialize
 
 sizeType = '<L'
-longLength = struct.calcsize(sizeType)
+sizeStruct = struct.Struct(sizeType)
+longLength = sizeStruct.size
+
+# the high bit of a frame's length prefix marks an lz4-compressed payload. Receivers always
+# understand it, but senders only compress once the peer has said it understands it too.
+COMPRESSED_FRAME_FLAG = 0x80000000
+MAX_FRAME_SIZE = COMPRESSED_FRAME_FLAG - 1
+
+# payloads smaller than this aren't worth compressing
+DEFAULT_COMPRESSION_THRESHOLD = 16 * 1024
 
 
 def longToString(l):
@@ -25,14 +35,40 @@ class AlgebraicProtocol(asyncio.Protocol):
         self.transport = None
         self.buffer = bytearray()
         self.writelock = threading.Lock()
+        self.writingPaused = False
+
+        # frames at least this large get compressed once 'peerAcceptsCompressedFrames' is called.
+        # None means never compress.
+        self.compressionThreshold = DEFAULT_COMPRESSION_THRESHOLD
+        self.sendCompressedFrames = False
+
         self._logger = logging.getLogger(__name__)
 
+    def peerAcceptsCompressedFrames(self):
+        """The other side has told us it can read compressed frames."""
+        self.sendCompressedFrames = True
+
+    def serializeMessage(self, msg):
+        """Serialize 'msg' into a length-prefixed frame. Safe to call from any thread."""
+        assert isinstance(msg, self.sendType), "message %s is of type %s != %s" % (msg, type(msg), self.sendType)
+
+        dataToSend = serialize(self.sendType, msg)
+
+        if (self.sendCompressedFrames and self.compressionThreshold is not None and
+                len(dataToSend) >= self.compressionThreshold):
+            compressed = lz4.frame.compress(dataToSend)
+
+            if len(compressed) < len(dataToSend):
+                assert len(compressed) <= MAX_FRAME_SIZE, "message too large to send"
+                return longToString(len(compressed) | COMPRESSED_FRAME_FLAG) + compressed
+
+        assert len(dataToSend) <= MAX_FRAME_SIZE, "message too large to send"
+
+        return longToString(len(dataToSend)) + dataToSend
+
     def sendMessage(self, msg):
         try:
-            assert isinstance(msg, self.sendType), "message %s is of type %s != %s" % (msg, type(msg), self.sendType)
-
-            dataToSend = serialize(self.sendType, msg)
-            dataToSend = longToString(len(dataToSend)) + dataToSend
+            dataToSend = self.serializeMessage(msg)
 
             with self.writelock:
                 self.transport.write(dataToSend)
@@ -47,6 +83,17 @@ class AlgebraicProtocol(asyncio.Protocol):
     def onConnected(self):
         pass
 
+    def onWritingResumed(self):
+        # subclasses override
+        pass
+
+    def pause_writing(self):
+        self.writingPaused = True
+
+    def resume_writing(self):
+        self.writingPaused = False
+        self.onWritingResumed()
+
     def connection_made(self, transport):
         self.transport = transport
         self.onConnected()
@@ -55,18 +102,40 @@ class AlgebraicProtocol(asyncio.Protocol):
         assert isinstance(data, bytes)
         self.buffer += data
 
-        while len(self.buffer) >= longLength:
-            bytesToRead = stringToLong(self.buffer[:longLength])
-            if bytesToRead + longLength <= len(self.buffer):
-                toConsume = self.buffer[longLength:bytesToRead + longLength]
+        # walk every complete message in the buffer with a read offset, deserializing straight
+        # out of a memoryview, and compact the buffer once at the end. Re-slicing the buffer for
+        # each message is quadratic when a single read delivers thousands of them.
+        offset = 0
+        bufferSize = len(self.buffer)
+
+        with memoryview(self.buffer) as bufferView:
+            while bufferSize - offset >= longLength:
+                header = sizeStruct.unpack_from(bufferView, offset)[0]
+                bytesToRead = header & MAX_FRAME_SIZE
+
+                messageStart = offset + longLength
+                messageEnd = messageStart + bytesToRead
 
-                self.buffer = self.buffer[bytesToRead + longLength:]
+                if messageEnd > bufferSize:
+                    break
 
-                if toConsume:
+                offset = messageEnd
+
+                if bytesToRead:
                     try:
-                        self.messageReceived(deserialize(self.receiveType, bytes(toConsume)))
+                        # release each slice as we go: the buffer can't be resized below
+                        # while any view of it is alive
+                        with bufferView[messageStart:messageEnd] as payload:
+                            if header & COMPRESSED_FRAME_FLAG:
+                                message = deserialize(self.receiveType, lz4.frame.decompress(payload))
+                            else:
+                                message = deserialize(self.receiveType, payload)
+
+                        self.messageReceived(message)
                     except Exception:
                         self._logger.error("Error in AlgebraicProtocol: %s", traceback.format_exc())
                         self.transport.close()
-            else:
-                return
+
+        if offset:
+            # deleting a prefix of a bytearray just advances its start, without copying the tail
+            del self.buffer[:offset]
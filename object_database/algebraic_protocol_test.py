@@ -13,7 +13,7 @@
 #   limitations under the License.
 
 from object_database.algebraic_protocol import AlgebraicProtocol
-from typed_python import Alternative
+from typed_python import Alternative, TupleOf
 
 import asyncio
 import queue
@@ -24,7 +24,8 @@ import unittest
 Message = Alternative(
     "Message",
     Ping={},
-    Pong={}
+    Pong={},
+    Data={'payload': str, 'ids': TupleOf(int)}
 )
 
 
@@ -51,6 +52,23 @@ class SendAndReturn(AlgebraicProtocol):
         self.transport.close()
 
 
+class CollectMessages(AlgebraicProtocol):
+    def __init__(self):
+        AlgebraicProtocol.__init__(self, Message, Message)
+        self.received = []
+
+    def messageReceived(self, msg):
+        self.received.append(msg)
+
+
+def framesFor(messages, compressionThreshold=None):
+    sender = AlgebraicProtocol(Message, Message)
+    if compressionThreshold is not None:
+        sender.compressionThreshold = compressionThreshold
+        sender.peerAcceptsCompressedFrames()
+    return b"".join(sender.serializeMessage(m) for m in messages)
+
+
 class AlgebraicProtocolTests(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -135,3 +153,65 @@ class AlgebraicProtocolTests(unittest.TestCase):
 
         server.close()
         loop.run_until_complete(server.wait_closed())
+
+    def test_framing_across_arbitrary_reads(self):
+        messages = [Message.Data(payload="x" * i, ids=tuple(range(i))) for i in range(50)]
+        data = framesFor(messages)
+
+        for chunkSize in [1, 3, 4, 7, 100, len(data)]:
+            protocol = CollectMessages()
+
+            for i in range(0, len(data), chunkSize):
+                protocol.data_received(data[i:i + chunkSize])
+
+            self.assertEqual(protocol.received, messages)
+            self.assertEqual(len(protocol.buffer), 0)
+
+    def test_compressed_frames(self):
+        messages = [Message.Data(payload="x" * i * 10, ids=tuple(range(i))) for i in range(50)]
+
+        uncompressed = framesFor(messages)
+        compressed = framesFor(messages, compressionThreshold=100)
+
+        self.assertLess(len(compressed), len(uncompressed) / 2)
+
+        # frames below the threshold go out as they are
+        self.assertEqual(framesFor(messages[:3], compressionThreshold=100), framesFor(messages[:3]))
+
+        for chunkSize in [1, 7, len(compressed)]:
+            protocol = CollectMessages()
+
+            for i in range(0, len(compressed), chunkSize):
+                protocol.data_received(compressed[i:i + chunkSize])
+
+            self.assertEqual(protocol.received, messages)
+
+    def test_no_compression_until_peer_accepts(self):
+        sender = AlgebraicProtocol(Message, Message)
+        sender.compressionThreshold = 0
+
+        msg = Message.Data(payload="x" * 1000, ids=())
+
+        self.assertEqual(sender.serializeMessage(msg), framesFor([msg]))
+
+        sender.peerAcceptsCompressedFrames()
+
+        self.assertLess(len(sender.serializeMessage(msg)), len(framesFor([msg])))
+
+    def test_one_read_holding_many_frames(self):
+        messages = [Message.Data(payload="x" * 100, ids=tuple(range(i % 10)))
+                    for i in range(20000)]
+        data = framesFor(messages)
+
+        protocol = CollectMessages()
+
+        # with the tail of one more frame, which has to wait for the next read
+        protocol.data_received(data + data[:10])
+
+        self.assertEqual(protocol.received, messages)
+        self.assertEqual(bytes(protocol.buffer), data[:10])
+
+        protocol.data_received(data[10:len(framesFor(messages[:1]))])
+
+        self.assertEqual(protocol.received, messages + messages[:1])
+        self.assertEqual(len(protocol.buffer), 0)
@@ -0,0 +1,176 @@
+#   Copyright 2018 Braxton Mckee
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from object_database.database_connection import changedObjects
+from object_database.tcp_server import connect
+from object_database.view import DisconnectedException
+from typed_python.Codebase import Codebase as TypedPythonCodebase
+
+import asyncio
+
+
+class AsyncDatabaseConnection:
+    """An asyncio front end to a DatabaseConnection.
+
+    Coroutines can wait on the server (subscriptions, flushes, commits) without blocking a
+    thread, so one event loop can serve many concurrent requests. The DatabaseConnection
+    keeps doing its I/O on its own channel (for tcp connections, the EventLoopInThread)
+    and wakes our loop up when what we're waiting for arrives.
+
+    Reading data never waits on the server, except for lazily loaded objects, so views
+    are ordinary 'with' blocks.
+    """
+
+    def __init__(self, db, loop=None):
+        self.db = db
+        self.loop = loop or asyncio.get_event_loop()
+        self.serializationContext = TypedPythonCodebase.coreSerializationContext()
+
+    def setSerializationContext(self, context):
+        self.db.setSerializationContext(context)
+        self.serializationContext = context
+
+    def _checkConnected(self):
+        if self.db.disconnected.is_set():
+            raise DisconnectedException()
+
+    async def _waitFor(self, events):
+        for event in events:
+            future = self.loop.create_future()
+
+            def resolve(future=future):
+                if not future.done():
+                    future.set_result(None)
+
+            event.addCallback(lambda resolve=resolve: self.loop.call_soon_threadsafe(resolve))
+
+            await future
+
+        self._checkConnected()
+
+    async def _negotiateProtocolVersion(self):
+        # the DatabaseConnection blocks on this for some kinds of subscription
+        if not self.db._protocolVersionNegotiated.is_set():
+            await self.flush()
+
+    async def flush(self):
+        """Make sure we know all transactions that have happened up to this point."""
+        await self._waitFor([self.db._requestFlush()])
+
+    async def subscribeMultiple(self, subscriptionTuples):
+        await self._negotiateProtocolVersion()
+        await self._waitFor(self.db.subscribeMultiple(subscriptionTuples, block=False))
+
+    async def subscribeToObjects(self, objects):
+        for o in objects:
+            self.db.addSchema(type(o).__schema__)
+
+        await self.subscribeMultiple([
+            (type(o).__schema__.name, type(o).__qualname__, ("_identity", o._identity), False)
+            for o in objects
+        ])
+
+    async def subscribeToType(self, t, lazySubscription=None, fields=None):
+        await self._negotiateProtocolVersion()
+        await self._waitFor(self.db.subscribeToType(t, block=False, lazySubscription=lazySubscription, fields=fields))
+
+    async def subscribeToIndex(self, t, lazySubscription=None, fields=None, **kwarg):
+        await self._negotiateProtocolVersion()
+        await self._waitFor(
+            self.db.subscribeToIndex(t, block=False, lazySubscription=lazySubscription, fields=fields, **kwarg)
+        )
+
+    async def subscribeToRange(self, t, lazySubscription=None, fields=None, **kwarg):
+        await self._negotiateProtocolVersion()
+        await self._waitFor(
+            self.db.subscribeToRange(t, block=False, lazySubscription=lazySubscription, fields=fields, **kwarg)
+        )
+
+    async def subscribeToSchema(self, *schemas, lazySubscription=None, excluding=()):
+        await self._negotiateProtocolVersion()
+        await self._waitFor(
+            self.db.subscribeToSchema(*schemas, block=False, lazySubscription=lazySubscription, excluding=excluding)
+        )
+
+    def view(self, transaction_id=None):
+        return self.db.view(transaction_id)
+
+    def transaction(self):
+        """An async context manager for a transaction, which commits without blocking when
+        the block exits.
+
+        Don't await inside the block: like any view, the transaction is the current one for
+        the whole thread while it's open, so other coroutines would see it.
+        """
+        return AsyncTransaction(self)
+
+    async def transactions(self):
+        """Yield each transaction we see from the first iteration on, as a dict from each
+        object it touched to a list of (fieldname, newValue, oldValue), like the handler of
+        a TransactionListener gets."""
+        pending = asyncio.Queue(loop=self.loop)
+
+        def onTransaction(key_value, priors, set_adds, set_removes, tid):
+            self.loop.call_soon_threadsafe(pending.put_nowait, (key_value, priors))
+
+        self.db.registerOnTransactionHandler(onTransaction)
+
+        try:
+            while True:
+                key_value, priors = await pending.get()
+
+                yield changedObjects(self.db, self.serializationContext, key_value, priors)
+        finally:
+            self.db.unregisterOnTransactionHandler(onTransaction)
+
+
+class AsyncTransaction:
+    def __init__(self, conn):
+        self._conn = conn
+        self._transaction = None
+
+    async def __aenter__(self):
+        self._transaction = self._conn.db.transaction()
+        return self._transaction.__enter__()
+
+    async def __aexit__(self, type, val, tb):
+        committed = self._transaction.finish(type, self._commit)
+
+        if committed is not None:
+            await asyncio.wrap_future(committed, loop=self._conn.loop)
+
+    def _commit(self):
+        if self._transaction.confirmation is not None:
+            raise Exception(
+                "Async transactions can't be pipelined: awaiting them doesn't block the thread "
+                "already, so use more coroutines to keep more transactions in flight."
+            )
+
+        return self._transaction.commitFuture()
+
+
+async def connectAsync(host, port, auth_token, timeout=10.0, retry=False, loop=None):
+    """Connect to the server at host:port, returning an AsyncDatabaseConnection.
+
+    Authenticating takes a thread from the loop's default executor until the server
+    answers. Nothing after that does.
+    """
+    loop = loop or asyncio.get_event_loop()
+
+    db = await loop.run_in_executor(
+        None,
+        lambda: connect(host, port, auth_token, timeout=timeout, retry=retry)
+    )
+
+    return AsyncDatabaseConnection(db, loop)
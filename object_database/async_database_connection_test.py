@@ -0,0 +1,191 @@
+#   Copyright 2018 Braxton Mckee
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from object_database.async_database_connection import AsyncDatabaseConnection, connectAsync
+from object_database.schema import Indexed, Schema
+from object_database.tcp_server import TcpServer
+from object_database.inmem_server import InMemServer
+from object_database.persistence import InMemoryPersistence
+from object_database.view import RevisionConflictException
+from object_database.util import genToken
+
+import asyncio
+import ssl
+import threading
+import unittest
+
+schema = Schema("test_async_schema")
+
+
+@schema.define
+class Counter:
+    k = Indexed(int)
+    x = int
+
+
+def setToZero(db, counter):
+    with db.transaction():
+        counter.x = 0
+
+
+class AsyncDatabaseConnectionTests(unittest.TestCase):
+    def setUp(self):
+        self.auth_token = genToken()
+        self.server = InMemServer(InMemoryPersistence(), self.auth_token)
+        self.server.start()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        self.server.stop()
+
+    def connect(self):
+        return AsyncDatabaseConnection(self.server.connect(self.auth_token), self.loop)
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(asyncio.wait_for(coroutine, 5.0, loop=self.loop))
+
+    def test_subscribe_and_commit(self):
+        async def test():
+            db1 = self.connect()
+            db2 = self.connect()
+
+            await db1.subscribeToSchema(schema)
+            await db2.subscribeToIndex(Counter, k=1)
+
+            async with db1.transaction():
+                c1 = Counter(k=1, x=10)
+                Counter(k=2, x=20)
+
+            await db2.flush()
+
+            with db2.view():
+                self.assertEqual(Counter.lookupAll(k=1), (c1,))
+                self.assertEqual(c1.x, 10)
+
+            # many coroutines can commit at once on one thread
+            async def increment(c):
+                async with db2.transaction() as t:
+                    t.consistency(writes=True)
+                    c.x = c.x + 1
+
+            async def incrementAndRetry(c):
+                while True:
+                    try:
+                        return await increment(c)
+                    except RevisionConflictException:
+                        await db2.flush()
+
+            await asyncio.gather(*[incrementAndRetry(c1) for _ in range(10)], loop=self.loop)
+
+            await db1.flush()
+
+            with db1.view():
+                self.assertEqual(c1.x, 20)
+
+            with self.assertRaises(RevisionConflictException):
+                async with db1.transaction() as t:
+                    t.consistency(reads=True)
+                    c1.x = c1.x + 1
+
+                    # someone else gets there first
+                    writer = threading.Thread(target=setToZero, args=(db2.db, c1))
+                    writer.start()
+                    writer.join()
+
+        self.run_async(test())
+
+    def test_pipelined_transactions_are_rejected(self):
+        async def test():
+            db = self.connect()
+
+            await db.subscribeToSchema(schema)
+
+            with self.assertRaisesRegex(Exception, "can't be pipelined"):
+                async with db.transaction() as t:
+                    t.pipelined()
+                    Counter(k=1, x=1)
+
+            self.assertTrue(t.confirmation.cancelled())
+
+            # the transaction was released, so we can open another one
+            async with db.transaction():
+                Counter(k=2, x=2)
+
+            with db.view():
+                self.assertEqual([c.k for c in Counter.lookupAll()], [2])
+
+        self.run_async(test())
+
+    def test_transaction_stream(self):
+        async def test():
+            db1 = self.connect()
+            db2 = self.connect()
+
+            await db1.subscribeToSchema(schema)
+            await db2.subscribeToType(Counter)
+
+            stream = db2.transactions()
+            firstChange = asyncio.ensure_future(stream.__anext__(), loop=self.loop)
+
+            # let the stream register itself before we write anything
+            await asyncio.sleep(0.01, loop=self.loop)
+
+            async with db1.transaction():
+                c = Counter(k=3, x=4)
+
+            changed = await firstChange
+
+            self.assertEqual(sorted(changed[c]), [("k", 3, 0), ("x", 4, 0)])
+
+            await stream.aclose()
+
+        self.run_async(test())
+
+
+class AsyncDatabaseConnectionOverSocketTests(unittest.TestCase):
+    def setUp(self):
+        self.auth_token = genToken()
+
+        sc = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        sc.load_cert_chain('testcert.cert', 'testcert.key')
+
+        self.server = TcpServer(
+            host="localhost", port=8890, mem_store=InMemoryPersistence(),
+            ssl_context=sc, auth_token=self.auth_token
+        )
+        self.server.start()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        self.server.stop()
+
+    def test_connect(self):
+        async def test():
+            db = await connectAsync("localhost", 8890, self.auth_token, loop=self.loop)
+
+            await db.subscribeToType(Counter)
+
+            async with db.transaction():
+                c = Counter(k=1)
+
+            await db.flush()
+
+            with db.view():
+                self.assertEqual(Counter.lookupOne(k=1), c)
+
+            db.db.disconnect()
+
+        self.loop.run_until_complete(asyncio.wait_for(test(), 5.0, loop=self.loop))
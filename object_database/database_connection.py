@@ -13,14 +13,27 @@
 #   limitations under the License.
 
 from object_database.messages import ClientToServer, getHeartbeatInterval
+from object_database.messages import (
+    PROTOCOL_VERSION,
+    COMPRESSED_FRAMES_PROTOCOL_VERSION,
+    GROUPED_WRITES_PROTOCOL_VERSION,
+    PROJECTED_FIELDS_PROTOCOL_VERSION,
+    RANGE_SUBSCRIPTIONS_PROTOCOL_VERSION,
+    DELTA_WRITES_PROTOCOL_VERSION,
+    STATS_PROTOCOL_VERSION,
+    encodeSerializedValue,
+    decodeSerializedValue
+)
 from object_database.core_schema import core_schema
 from object_database.view import View, Transaction, _cur_view, SerializedDatabaseValue
-from object_database.identity import IdentityProducer
+from object_database.identity import IdentityProducer, internIdentities
 import object_database.keymapping as keymapping
 from typed_python.SerializationContext import SerializationContext
 from typed_python.Codebase import Codebase as TypedPythonCodebase
 from typed_python import Alternative
 
+import bisect
+import heapq
 import queue
 import threading
 import logging
@@ -29,6 +42,8 @@ import time
 
 from object_database.view import DisconnectedException
 
+DEFAULT_MAX_PIPELINED_COMMITS = 100
+
 
 class Everything:
     """Singleton to mark subscription to everything in a slice."""
@@ -43,15 +58,16 @@ TransactionResult = Alternative(
 
 
 class VersionedBase:
+    __slots__ = ()
+
     def _best_version_offset_for(self, version):
-        i = len(self.version_numbers) - 1
+        # version_numbers is always sorted, since we only ever append newer versions
+        i = bisect.bisect_right(self.version_numbers, version) - 1
 
-        while i >= 0:
-            if self.version_numbers[i] <= version:
-                return i
-            i -= 1
+        if i < 0:
+            return None
 
-        return None
+        return i
 
     def isEmpty(self):
         return not self.version_numbers
@@ -76,6 +92,8 @@ class VersionedBase:
 
 
 class VersionedValue(VersionedBase):
+    __slots__ = ("version_numbers", "values")
+
     def __init__(self):
         self.version_numbers = []
         self.values = []
@@ -118,6 +136,8 @@ class VersionedValue(VersionedBase):
 
 
 class VersionedSet(VersionedBase):
+    __slots__ = ("version_numbers", "adds", "removes")
+
     # values in sets are always strings
     def __init__(self):
         self.version_numbers = []
@@ -210,6 +230,19 @@ class SetWithEdits:
             res.difference_update(self.removes[i])
         return res
 
+    def estimatedSize(self):
+        """How many items are in the set, assuming every add is new and every remove was there."""
+        return len(self.s) + sum(len(a) for a in self.adds) - sum(len(r) for r in self.removes)
+
+    def contains(self, item):
+        for i in reversed(range(len(self.adds))):
+            if item in self.adds[i]:
+                return True
+            if item in self.removes[i]:
+                return False
+
+        return item in self.s
+
     def pickAny(self, toAvoid):
         removed = set()
 
@@ -233,25 +266,113 @@ class SetWithEdits:
 
 
 class ManyVersionedObjects:
+    """The versioned data a DatabaseConnection can see, for each key.
+
+    Values are stored by object: each "schema:typename:identity" has a row, which is a list
+    holding its type's field layout (fieldname -> offset, shared by all rows of the type)
+    followed by one slot per field. A slot is None if we have no data, a bare
+    SerializedDatabaseValue if every open view sees the same value, or a VersionedValue
+    while views disagree. Cleanup collapses VersionedValues back down to bare values,
+    so a client holding millions of objects pays for a version chain only on keys that
+    changed since its oldest open view.
+
+    Index sets are rarer and bigger, so they stay in a VersionedSet per key.
+    """
+
     def __init__(self):
         # for each version number we have outstanding
         self._version_number_refcount = {}
 
         self._min_reffed_version_number = None
 
+        # a heap of the version numbers in _version_number_refcount. Released versions
+        # are removed lazily, when they reach the top.
+        self._reffed_version_heap = []
+
         # for each version number, the set of keys that are set with it
         self._version_number_objects = {}
 
-        # for each key, a VersionedValue or VersionedSet
-        self._versioned_objects = {}
+        # a heap of the keys of _version_number_objects, so cleanup can find the oldest
+        self._version_number_heap = []
+
+        # for each "schema:typename", the offset in a row of each field we've seen
+        self._layouts = {}
+
+        # for each "schema:typename:identity", its row
+        self._rows = {}
+
+        # for each index key, a VersionedSet
+        self._versioned_sets = {}
+
+        # for each index group of an ordered index, the sorted value hashes of the
+        # index keys in '_versioned_sets', so we can find the ones in a range
+        self._ordered_index_hashes = {}
 
     def keycount(self):
-        return len(self._versioned_objects)
+        count = len(self._versioned_sets)
+
+        for row in self._rows.values():
+            for ix in range(1, len(row)):
+                if row[ix] is not None:
+                    count += 1
+
+        return count
+
+    def _slot(self, key):
+        objectKey, _, fieldname = key.rpartition(":")
+
+        row = self._rows.get(objectKey)
+        if row is None:
+            return None
+
+        offset = row[0].get(fieldname)
+        if offset is None or offset >= len(row):
+            return None
+
+        return row[offset]
+
+    def _setSlot(self, key, slot):
+        objectKey, _, fieldname = key.rpartition(":")
+
+        row = self._rows.get(objectKey)
+        if row is None:
+            if slot is None:
+                return
+
+            typeKey = objectKey.rpartition(":")[0]
+
+            layout = self._layouts.get(typeKey)
+            if layout is None:
+                layout = self._layouts[typeKey] = {}
+
+            row = self._rows[objectKey] = [layout]
+
+        layout = row[0]
+
+        offset = layout.get(fieldname)
+        if offset is None:
+            offset = layout[fieldname] = len(layout) + 1
+
+        if offset >= len(row):
+            if slot is None:
+                return
+            row.extend([None] * (offset + 1 - len(row)))
+
+        row[offset] = slot
+
+        if slot is None:
+            for ix in range(1, len(row)):
+                if row[ix] is not None:
+                    return
+
+            del self._rows[objectKey]
 
     def versionIncref(self, version_number):
         if version_number not in self._version_number_refcount:
             self._version_number_refcount[version_number] = 1
 
+            heapq.heappush(self._reffed_version_heap, version_number)
+
             if self._min_reffed_version_number is None:
                 self._min_reffed_version_number = version_number
             else:
@@ -269,67 +390,146 @@ class ManyVersionedObjects:
         if self._version_number_refcount[version_number] == 0:
             del self._version_number_refcount[version_number]
 
-            if version_number == self._min_reffed_version_number:
-                if not self._version_number_refcount:
-                    self._min_reffed_version_number = None
-                else:
-                    self._min_reffed_version_number = min(self._version_number_refcount)
+            heap = self._reffed_version_heap
+
+            if len(heap) > 2 * len(self._version_number_refcount) + 16:
+                # too many released versions are buried in the heap. Rebuild it.
+                heap[:] = self._version_number_refcount
+                heapq.heapify(heap)
+
+            while heap and heap[0] not in self._version_number_refcount:
+                heapq.heappop(heap)
+
+            self._min_reffed_version_number = heap[0] if heap else None
+
+    def _addVersionedSet(self, key):
+        versionedSet = self._versioned_sets[key] = VersionedSet()
+
+        index_group, _, valhash = key.rpartition(":")
+        if keymapping.is_ordered_index_hash(valhash):
+            bisect.insort(self._ordered_index_hashes.setdefault(index_group, []), valhash)
+
+        return versionedSet
+
+    def _dropVersionedSet(self, key):
+        del self._versioned_sets[key]
+
+        index_group, _, valhash = key.rpartition(":")
+        if keymapping.is_ordered_index_hash(valhash):
+            hashes = self._ordered_index_hashes[index_group]
+            del hashes[bisect.bisect_left(hashes, valhash)]
+            if not hashes:
+                del self._ordered_index_hashes[index_group]
+
+    def firstKeyChangedSince(self, keys, index_keys, version_number):
+        """One of 'keys' or 'index_keys' that we know changed after 'version_number', or None.
+
+        The server rejects transactions whose reads as of 'version_number' are out of date,
+        so a transaction that read one of these can't commit.
+        """
+        for key in keys:
+            slot = self._slot(key)
+            if isinstance(slot, VersionedValue) and slot.hasVersionInfoNewerThan(version_number):
+                return key
+
+        for key in index_keys:
+            versionedSet = self._versioned_sets.get(key)
+            if versionedSet is not None and versionedSet.hasVersionInfoNewerThan(version_number):
+                return key
+
+        return None
+
+    def setKeysInRange(self, index_group, low_hash, high_hash):
+        """The index keys we have in 'index_group' whose value hashes are between 'low_hash'
+        (inclusive) and 'high_hash' (exclusive), either of which may be None."""
+        hashes = self._ordered_index_hashes.get(index_group, ())
+
+        lowIx = 0 if low_hash is None else bisect.bisect_left(hashes, low_hash)
+        highIx = len(hashes) if high_hash is None else bisect.bisect_left(hashes, high_hash)
+
+        return [index_group + ":" + valhash for valhash in hashes[lowIx:highIx]]
 
     def setForVersion(self, key, version_number):
-        if key in self._versioned_objects:
-            return self._versioned_objects[key].valueForVersion(version_number)
+        if key in self._versioned_sets:
+            return self._versioned_sets[key].valueForVersion(version_number)
 
         return SetWithEdits(set(), set(), set())
 
     def hasDataForKey(self, key):
-        return key in self._versioned_objects
+        return self._slot(key) is not None
 
     def valueForVersion(self, key, version_number):
-        return self._versioned_objects[key].valueForVersion(version_number)
+        slot = self._slot(key)
+
+        if type(slot) is VersionedValue:
+            return slot.valueForVersion(version_number)
+
+        return slot
 
     def _object_has_version(self, key, version_number):
         if version_number not in self._version_number_objects:
             self._version_number_objects[version_number] = set()
+            heapq.heappush(self._version_number_heap, version_number)
 
         self._version_number_objects[version_number].add(key)
 
     def setVersionedValue(self, key, version_number, serialized_val):
         self._object_has_version(key, version_number)
 
-        if key not in self._versioned_objects:
-            self._versioned_objects[key] = VersionedValue()
+        slot = self._slot(key)
 
-        versioned = self._versioned_objects[key]
+        if type(slot) is VersionedValue:
+            versioned = slot
+        else:
+            versioned = VersionedValue()
+
+            if slot is not None:
+                # every view could see this value, so it's as old as anything they might ask for
+                versioned.setVersionedValue(-1, slot)
+
+            self._setSlot(key, versioned)
 
         initialValue = versioned.newestValue()
 
-        versioned.setVersionedValue(version_number, SerializedDatabaseValue(serialized_val, {}))
+        versioned.setVersionedValue(version_number, SerializedDatabaseValue(serialized_val))
 
         return initialValue
 
     def setVersionedAddsAndRemoves(self, key, version_number, adds, removes):
         self._object_has_version(key, version_number)
 
-        if key not in self._versioned_objects:
-            self._versioned_objects[key] = VersionedSet()
+        if key not in self._versioned_sets:
+            self._addVersionedSet(key)
 
         if adds or removes:
-            self._versioned_objects[key].setVersionedAddsAndRemoves(version_number, adds, removes)
+            self._versioned_sets[key].setVersionedAddsAndRemoves(version_number, adds, removes)
 
     def setVersionedTailValueStringified(self, key, serialized_val):
-        if key not in self._versioned_objects:
-            self._object_has_version(key, -1)
-            self._versioned_objects[key] = VersionedValue()
-            self._versioned_objects[key].setVersionedValue(-1, SerializedDatabaseValue(serialized_val, {}))
+        if self._slot(key) is None:
+            if serialized_val is None:
+                # keep the deletion around until cleanup, like any other
+                self._object_has_version(key, -1)
+                versioned = VersionedValue()
+                versioned.setVersionedValue(-1, SerializedDatabaseValue(serialized_val))
+                self._setSlot(key, versioned)
+            else:
+                self._setSlot(key, SerializedDatabaseValue(serialized_val))
 
     def updateVersionedAdds(self, key, version_number, adds):
         self._object_has_version(key, version_number)
 
-        if key not in self._versioned_objects:
-            self._versioned_objects[key] = VersionedSet()
-            self._versioned_objects[key].setVersionedAddsAndRemoves(version_number, adds, set())
+        if key not in self._versioned_sets:
+            self._addVersionedSet(key).setVersionedAddsAndRemoves(version_number, adds, set())
         else:
-            self._versioned_objects[key].updateVersionedAdds(version_number, adds)
+            self._versioned_sets[key].updateVersionedAdds(version_number, adds)
+
+    def clear(self):
+        """Forget all of our data, but not which versions open views are holding."""
+        self._version_number_objects = {}
+        self._version_number_heap = []
+        self._rows = {}
+        self._versioned_sets = {}
+        self._ordered_index_hashes = {}
 
     def cleanup(self, curTransactionId):
         """Get rid of old objects we don't need to keep around and increase the min_transaction_id"""
@@ -338,20 +538,88 @@ class ManyVersionedObjects:
         else:
             lowestId = curTransactionId
 
-        if self._version_number_objects:
-            while min(self._version_number_objects) < lowestId:
-                toCollapse = min(self._version_number_objects)
+        while self._version_number_heap and self._version_number_heap[0] < lowestId:
+            toCollapse = heapq.heappop(self._version_number_heap)
 
-                for key in self._version_number_objects[toCollapse]:
-                    if key not in self._versioned_objects:
-                        pass
-                    elif self._versioned_objects[key].cleanup(lowestId):
-                        del self._versioned_objects[key]
-                    else:
-                        if self._versioned_objects[key].needsToTrack():
-                            self._object_has_version(key, lowestId)
+            for key in self._version_number_objects[toCollapse]:
+                versionedSet = self._versioned_sets.get(key)
 
-                del self._version_number_objects[toCollapse]
+                if versionedSet is not None:
+                    if versionedSet.cleanup(lowestId):
+                        self._dropVersionedSet(key)
+                    elif versionedSet.needsToTrack():
+                        self._object_has_version(key, lowestId)
+                    continue
+
+                versioned = self._slot(key)
+
+                if type(versioned) is not VersionedValue:
+                    # already collapsed, or gone
+                    pass
+                elif versioned.cleanup(lowestId):
+                    self._setSlot(key, None)
+                elif versioned.needsToTrack():
+                    self._object_has_version(key, lowestId)
+                else:
+                    self._setSlot(key, versioned.values[0])
+
+            del self._version_number_objects[toCollapse]
+
+
+class NotifyingEvent(threading.Event):
+    """A threading.Event that can also call back when it's set, for callers that can't
+    block a thread waiting for it."""
+
+    def __init__(self):
+        threading.Event.__init__(self)
+        self._callbacks = []
+        self._callbackLock = threading.Lock()
+
+    def set(self):
+        threading.Event.set(self)
+
+        with self._callbackLock:
+            callbacks, self._callbacks = self._callbacks, []
+
+        for callback in callbacks:
+            callback()
+
+    def addCallback(self, callback):
+        """Call 'callback' once the event is set, which may be right now, on this thread."""
+        with self._callbackLock:
+            if not self.is_set():
+                self._callbacks.append(callback)
+                return
+
+        callback()
+
+
+def changedObjects(db, serializationContext, key_value, priors):
+    """Turn the writes of a transaction into a dict from each object it touched to a list
+    of (fieldname, newValue, oldValue) for the fields it changed."""
+    changed = {}
+
+    for k in key_value:
+        o, fieldname = db._data_key_to_object(k)
+
+        if o:
+            if o not in changed:
+                changed[o] = []
+
+            if fieldname != " exists":
+                deltaEncoded = o.__schema__.isDeltaEncoded(type(o), fieldname)
+
+                changed[o].append((
+                    fieldname,
+                    View.unwrapSerializedDatabaseValue(
+                        serializationContext, key_value[k], o.__types__[fieldname], deltaEncoded
+                    ),
+                    View.unwrapSerializedDatabaseValue(
+                        serializationContext, priors[k], o.__types__[fieldname], deltaEncoded
+                    )
+                ))
+
+    return changed
 
 
 class TransactionListener:
@@ -401,23 +669,7 @@ class TransactionListener:
                     logger.error("Callback threw exception:\n%s", traceback.format_exc())
 
     def _onTransaction(self, key_value, priors, set_adds, set_removes, tid):
-        changed = {}
-
-        for k in key_value:
-            o, fieldname = self._db._data_key_to_object(k)
-
-            if o:
-                if o not in changed:
-                    changed[o] = []
-
-                if fieldname != " exists":
-                    changed[o].append((
-                        fieldname,
-                        View.unwrapSerializedDatabaseValue(self.serializationContext, key_value[k], o.__types__[fieldname]),
-                        View.unwrapSerializedDatabaseValue(self.serializationContext, priors[k], o.__types__[fieldname])
-                    ))
-
-        self._queue.put(changed)
+        self._queue.put(changedObjects(self._db, self.serializationContext, key_value, priors))
 
 
 class DatabaseConnection:
@@ -430,6 +682,29 @@ class DatabaseConnection:
         # transaction of what's in the KV store
         self._cur_transaction_num = 0
 
+        # the wire protocol version the server agreed to. Until it answers, we have to
+        # assume it only understands version 0.
+        self._protocolVersion = 0
+        self._protocolVersionNegotiated = threading.Event()
+
+        # the server instance we're talking to, if it supports resuming connections.
+        self._serverInstanceGuid = None
+
+        # while we're resuming on a new channel, an Event that fires when the server has
+        # told us whether it could catch us up.
+        self._resumeEvent = None
+        self._resumed = False
+
+        # every subscription tuple (schema, typename, fieldname_and_value) we've asked for,
+        # and whether it was lazy, so that we can reissue them when we reconnect.
+        self._subscriptions = {}
+
+        # type -> the only fields of it we asked the server to send us, for projected types
+        self._projectedFields = {}
+
+        # (schema, typename) pairs we've sent the current channel a ProjectFields message for
+        self._projectionsSent = set()
+
         # a datastructure that keeps track of all the different versions of the objects
         # we have mapped in.
         self._versioned_data = ManyVersionedObjects()
@@ -448,6 +723,15 @@ class DatabaseConnection:
 
         self._flushEvents = {}
 
+        # guid of each GetStats request we're waiting on -> [NotifyingEvent, samples or None]
+        self._statsRequests = {}
+
+        # how many pipelined transactions we let a connection have waiting on the server
+        # before 'commit' blocks until one of them is confirmed
+        self.maxPipelinedCommits = DEFAULT_MAX_PIPELINED_COMMITS
+        self._pipelinedCommits = 0
+        self._pipelineCondition = threading.Condition()
+
         # Map: schema.name -> schema
         self._schemas = {}
 
@@ -464,7 +748,7 @@ class DatabaseConnection:
         # from (schema,typename,field_val) -> {'values', 'index_values', 'identities'}
         self._subscription_buildup = {}
 
-        self._channel.setServerToClientHandler(self._onMessage)
+        self._channel.setServerToClientHandler(self._messageHandlerFor(self._channel))
 
         self._flushIx = 0
 
@@ -475,7 +759,11 @@ class DatabaseConnection:
         self._logger = logging.getLogger(__name__)
 
     def registerOnTransactionHandler(self, handler):
-        self._onTransactionHandlers.append(handler)
+        # copy, rather than modify, the list the message thread may be iterating over
+        self._onTransactionHandlers = self._onTransactionHandlers + [handler]
+
+    def unregisterOnTransactionHandler(self, handler):
+        self._onTransactionHandlers = [h for h in self._onTransactionHandlers if h is not handler]
 
     def setSerializationContext(self, context):
         assert isinstance(context, SerializationContext), context
@@ -503,6 +791,105 @@ class DatabaseConnection:
         self._channel.write(
             ClientToServer.Authenticate(token=token)
         )
+        self._channel.write(
+            ClientToServer.ProtocolVersion(version=PROTOCOL_VERSION)
+        )
+
+    def resume(self, channel, token, timeout=None):
+        """Carry on over 'channel', a new connection to the server, after we were disconnected.
+
+        If the server still has every transaction we missed, it replays them to us and we
+        keep the data we already had. Otherwise, we drop our data and resubscribe to
+        everything from scratch. Returns True if we caught up incrementally.
+
+        The server only restores our type and identity subscriptions, so we reissue our
+        index subscriptions either way. If we have projections, we always resubscribe.
+        """
+        with self._lock:
+            assert self.disconnected.is_set(), "can only resume a disconnected connection"
+
+            # the server can't replay what lazy subscriptions need, and doesn't know our
+            # projections until we resubscribe, so those always resync
+            if self._serverInstanceGuid is not None and not any(self._subscriptions.values()) \
+                    and not self._projectedFields:
+                serverGuid = self._serverInstanceGuid
+            else:
+                serverGuid = ""
+
+            lastTransactionId = self._cur_transaction_num
+
+            types = []
+            identities = []
+            subscriptionSets = self._schema_and_typename_to_subscription_set
+            for schemaAndTypename, subscribed in subscriptionSets.items():
+                if subscribed is Everything:
+                    types.append(schemaAndTypename)
+                else:
+                    identities.extend(subscribed)
+
+            self._channel = channel
+            self._protocolVersion = 0
+            self._protocolVersionNegotiated.clear()
+            self._projectionsSent = set()
+            self._serverInstanceGuid = None
+            self._resumeEvent = threading.Event()
+            self._resumed = False
+            self.initialized.clear()
+
+            resumeEvent = self._resumeEvent
+
+        self._channel.setServerToClientHandler(self._messageHandlerFor(channel))
+
+        self.authenticate(token)
+
+        with self._lock:
+            for schema in self._schemas.values():
+                self._channel.write(
+                    ClientToServer.DefineSchema(name=schema.name, definition=schema.toDefinition())
+                )
+
+            self._channel.write(
+                ClientToServer.Resume(
+                    server_guid=serverGuid,
+                    transaction_id=lastTransactionId,
+                    types=types,
+                    identities=identities
+                )
+            )
+
+        resumeEvent.wait(timeout=timeout)
+
+        with self._lock:
+            if self._resumeEvent is not None:
+                self._resumeEvent = None
+                raise DisconnectedException()
+
+            resumed = self._resumed
+
+            toResubscribe = [
+                subscription + (isLazy,) for subscription, isLazy in self._subscriptions.items()
+            ]
+
+            if resumed:
+                # the objects in an index can change while we're away, so we ask again
+                toResubscribe = [
+                    (schema, typename, fieldname_and_value, isLazy)
+                    for schema, typename, fieldname_and_value, isLazy in toResubscribe
+                    if fieldname_and_value is not None and fieldname_and_value[0] != "_identity"
+                ]
+
+        if toResubscribe:
+            self.subscribeMultiple(toResubscribe)
+
+        return resumed
+
+    def _discardSubscribedData(self):
+        """Forget everything we know about the database. Must be called holding self._lock."""
+        self._versioned_data.clear()
+        self._schema_and_typename_to_subscription_set = {}
+        self._subscription_buildup = {}
+        self._pendingSubscriptions = {}
+        self._lazy_objects = {}
 
     def addSchema(self, schema):
         schema.freeze()
@@ -524,20 +911,59 @@ class DatabaseConnection:
 
     def flush(self):
         """Make sure we know all transactions that have happened up to this point."""
+        e = self._requestFlush()
+
+        e.wait()
+
+        if self.disconnected.is_set():
+            raise DisconnectedException()
+
+    def _requestFlush(self):
+        """Ask the server to flush, returning a NotifyingEvent that's set once it has."""
         with self._lock:
             if self.disconnected.is_set():
                 raise DisconnectedException()
 
             self._flushIx += 1
             ix = str(self._flushIx)
-            e = self._flushEvents[ix] = threading.Event()
+            e = self._flushEvents[ix] = NotifyingEvent()
             self._channel.write(ClientToServer.Flush(guid=ix))
 
-        e.wait()
+        return e
 
-        if self.disconnected.is_set():
+    def serverStats(self):
+        """The server's metrics, as a dict from the name of each sample in the Prometheus
+        text format (with its labels) to its value."""
+        if self._serverProtocolVersion() < STATS_PROTOCOL_VERSION:
+            raise Exception("The server is too old to report its stats.")
+
+        with self._lock:
+            if self.disconnected.is_set():
+                raise DisconnectedException()
+
+            self._flushIx += 1
+            guid = str(self._flushIx)
+            request = self._statsRequests[guid] = [NotifyingEvent(), None]
+            self._channel.write(ClientToServer.GetStats(guid=guid))
+
+        request[0].wait()
+
+        with self._lock:
+            self._statsRequests.pop(guid, None)
+
+        if request[1] is None:
             raise DisconnectedException()
 
+        return request[1]
+
+    def _serverProtocolVersion(self):
+        """The protocol version we speak with the server, waiting to hear it if we have to."""
+        if not self._protocolVersionNegotiated.is_set():
+            # the server answers our ProtocolVersion message before this flush, if it's going to
+            self.flush()
+
+        return self._protocolVersion
+
     def subscribeToObject(self, t):
         self.subscribeToObjects([t])
 
@@ -556,24 +982,112 @@ class DatabaseConnection:
             return True
         return False
 
-    def subscribeToIndex(self, t, block=True, lazySubscription=None, **kwarg):
+    def projectFields(self, t, fields):
+        """Only receive the values of 'fields' of type 't' from the server.
+
+        This applies to every subscription to 't', and must be decided before the first of them.
+        Reading any other field of a 't' raises a FieldNotProjectedException. Transactions can
+        still write to the other fields, unless they're indexed, since updating an index means
+        reading the value it had.
+        """
         self.addSchema(t.__schema__)
 
+        fields = frozenset(fields)
+
+        for fieldname in fields:
+            if fieldname not in t.__types__:
+                raise ValueError("%s has no field %s" % (t.__qualname__, fieldname))
+
+        with self._lock:
+            if self._projectedFields.get(t) == fields:
+                return
+
+            if (t.__schema__.name, t.__qualname__) in self._schema_and_typename_to_subscription_set:
+                raise Exception(
+                    "Can't change the fields we receive for %s after subscribing to it" % t.__qualname__
+                )
+
+            self._projectedFields[t] = fields
+
+    def _isFieldProjected(self, t, fieldname):
+        projection = self._projectedFields.get(t)
+        return projection is None or fieldname in projection
+
+    def _sendProjections(self, subscriptionTuples):
+        """Tell the server about the projections of the types in 'subscriptionTuples' it
+        doesn't know about yet. Must be called holding self._lock."""
+        if self._protocolVersion < PROJECTED_FIELDS_PROTOCOL_VERSION:
+            # the server will send us everything, and we'll ignore the fields we didn't ask for
+            return
+
+        for t, fields in self._projectedFields.items():
+            schemaAndTypename = (t.__schema__.name, t.__qualname__)
+
+            if schemaAndTypename in self._projectionsSent:
+                continue
+
+            if any(tup[0] == schemaAndTypename[0] and tup[1] == schemaAndTypename[1]
+                   for tup in subscriptionTuples):
+                self._channel.write(
+                    ClientToServer.ProjectFields(
+                        schema=schemaAndTypename[0],
+                        typename=schemaAndTypename[1],
+                        fields=tuple(sorted(fields))
+                    )
+                )
+                self._projectionsSent.add(schemaAndTypename)
+
+    def subscribeToIndex(self, t, block=True, lazySubscription=None, fields=None, **kwarg):
+        self.addSchema(t.__schema__)
+
+        if fields is not None:
+            self.projectFields(t, fields)
+
         toSubscribe = []
         for fieldname, fieldvalue in kwarg.items():
             toSubscribe.append((
                 t.__schema__.name,
                 t.__qualname__,
-                (fieldname, keymapping.index_value_to_hash(fieldvalue)),
+                (fieldname, keymapping.index_value_hash(t, fieldname, fieldvalue)),
                 self._lazinessForType(t, lazySubscription)
             )
             )
 
         return self.subscribeMultiple(toSubscribe, block=block)
 
-    def subscribeToType(self, t, block=True, lazySubscription=None):
+    def subscribeToRange(self, t, block=True, lazySubscription=None, fields=None, **kwarg):
+        """Subscribe to the objects of type 't' whose value of an ordered index is in a range.
+
+        The range is given as fieldname=(low, high). 'low' is inclusive and 'high' exclusive,
+        and either may be None. Like index subscriptions, we hear about objects that enter
+        the range later, and stay subscribed to objects that leave it.
+        """
         self.addSchema(t.__schema__)
 
+        if fields is not None:
+            self.projectFields(t, fields)
+
+        if self._serverProtocolVersion() < RANGE_SUBSCRIPTIONS_PROTOCOL_VERSION:
+            raise Exception("The server doesn't support range subscriptions")
+
+        toSubscribe = []
+        for fieldname, (low, high) in kwarg.items():
+            toSubscribe.append((
+                t.__schema__.name,
+                t.__qualname__,
+                (fieldname, keymapping.index_range_token(*keymapping.index_range_hashes(t, fieldname, low, high))),
+                self._lazinessForType(t, lazySubscription)
+            )
+            )
+
+        return self.subscribeMultiple(toSubscribe, block=block)
+
+    def subscribeToType(self, t, block=True, lazySubscription=None, fields=None):
+        self.addSchema(t.__schema__)
+
+        if fields is not None:
+            self.projectFields(t, fields)
+
         if self._isTypeSubscribedAll(t):
             return ()
 
@@ -615,17 +1129,25 @@ class DatabaseConnection:
         return self._schema_and_typename_to_subscription_set.get((t.__schema__.name, t.__qualname__)) is Everything
 
     def subscribeMultiple(self, subscriptionTuples, block=True):
+        if self._projectedFields:
+            # we need to know whether the server can project fields for us
+            self._serverProtocolVersion()
+
         with self._lock:
             if self.disconnected.is_set():
                 raise DisconnectedException()
 
+            self._sendProjections(subscriptionTuples)
+
             events = []
 
             for tup in subscriptionTuples:
+                self._subscriptions[(tup[0], tup[1], tup[2])] = tup[3]
+
                 e = self._pendingSubscriptions.get(tup)
 
                 if not e:
-                    e = self._pendingSubscriptions[(tup[0], tup[1], tup[2])] = threading.Event()
+                    e = self._pendingSubscriptions[(tup[0], tup[1], tup[2])] = NotifyingEvent()
 
                 assert tup[0] and tup[1]
 
@@ -716,40 +1238,116 @@ class DatabaseConnection:
 
             return view
 
+    def _acquirePipelineSlot(self):
+        with self._pipelineCondition:
+            while self._pipelinedCommits >= self.maxPipelinedCommits and not self.disconnected.is_set():
+                self._pipelineCondition.wait(0.1)
+
+            self._pipelinedCommits += 1
+
+    def _releasePipelineSlot(self):
+        with self._pipelineCondition:
+            self._pipelinedCommits -= 1
+            self._pipelineCondition.notify()
+
     def _releaseView(self, view):
         with self._lock:
             self._versioned_data.versionDecref(view._transaction_num)
 
     def isSubscribedToObject(self, object):
-        return not self._suppressKey(object._identity)
+        return self._subscribedIdentitiesOf(
+            type(object).__schema__.name, type(object).__qualname__, (object._identity,)
+        ) is not None
 
-    def _suppressKey(self, k):
-        schema, typename, ident, fieldname = keymapping.split_data_key(k)
+    def _subscribedIdentitiesOf(self, schema, typename, identities):
+        """The members of 'identities', all of type 'schema.typename', that we're subscribed to.
 
+        Returns None for a type we're not subscribed to at all, so that callers can skip a
+        whole group of writes at once.
+        """
         subscriptionSet = self._schema_and_typename_to_subscription_set.get((schema, typename))
 
         if subscriptionSet is Everything:
-            return False
-        if isinstance(subscriptionSet, set) and ident in subscriptionSet:
-            return False
-        return True
-
-    def _suppressIdentities(self, index_key, identities):
-        schema, typename, fieldname, valhash = keymapping.split_index_key_full(index_key)
+            return identities
+        if subscriptionSet is None:
+            return None
 
-        subscriptionSet = self._schema_and_typename_to_subscription_set.get((schema, typename))
+        identities = subscriptionSet.intersection(identities)
 
-        if subscriptionSet is Everything:
-            return identities
-        elif subscriptionSet is None:
-            return set()
-        else:
-            return identities.intersection(subscriptionSet)
+        return identities if identities else None
 
     def cleanup(self):
         with self._lock:
             self._versioned_data.cleanup(self._cur_transaction_num)
 
+    def _applyDeltas(self, deltas, transaction_id, key_value, priors):
+        """Append the frames in 'deltas' to the values of the DeltaEncoded fields they change,
+        recording the new and prior values in 'key_value' and 'priors'.
+
+        We skip values we don't have, which belong to objects we haven't loaded yet.
+        Must be called holding self._lock.
+        """
+        for (schema, typename), objects in deltas.items():
+            subscribed = self._subscribedIdentitiesOf(schema, typename, objects)
+            if subscribed is None:
+                continue
+
+            prefix = schema + ":" + typename + ":"
+
+            for identity in subscribed:
+                objectPrefix = prefix + identity + ":"
+
+                for fieldname, frames in objects[identity].items():
+                    k = objectPrefix + fieldname
+
+                    prior = self._versioned_data.valueForVersion(k, transaction_id)
+
+                    if prior is None or prior.serializedByteRep is None:
+                        continue
+
+                    key_value[k] = prior.serializedByteRep + frames
+
+                    priors[k] = self._versioned_data.setVersionedValue(k, transaction_id, key_value[k])
+
+    def _acceptsDeltaWrites(self):
+        return self._protocolVersion >= DELTA_WRITES_PROTOCOL_VERSION
+
+    def _applyIndexChanges(self, setOps, transaction_id, isAdd):
+        """Apply grouped index adds (or removes) from a transaction to our versioned data.
+
+        Returns all of them, subscribed to or not, keyed by index key.
+        """
+        res = {}
+
+        for (schema, typename), indices in setOps.items():
+            subscriptionSet = self._schema_and_typename_to_subscription_set.get((schema, typename))
+
+            for (fieldname, valhash), identities in indices.items():
+                index_key = keymapping.index_key_from_names_encoded(schema, typename, fieldname, valhash)
+                res[index_key] = identities
+
+                if subscriptionSet is None:
+                    continue
+
+                identities = internIdentities(identities)
+                if subscriptionSet is not Everything:
+                    identities.intersection_update(subscriptionSet)
+
+                if isAdd:
+                    self._versioned_data.setVersionedAddsAndRemoves(index_key, transaction_id, identities, set())
+                else:
+                    self._versioned_data.setVersionedAddsAndRemoves(index_key, transaction_id, set(), identities)
+
+        return res
+
+    def _messageHandlerFor(self, channel):
+        def onMessage(msg):
+            # once we've resumed on a new channel, stragglers from the old one are stale
+            if channel is self._channel:
+                self._onMessage(msg)
+
+        return onMessage
+
     def _onMessage(self, msg):
         self._messages_received += 1
 
@@ -764,9 +1362,15 @@ class DatabaseConnection:
                 for e in self._flushEvents.values():
                     e.set()
 
+                for e, _ in self._statsRequests.values():
+                    e.set()
+
                 for e in self._pendingSubscriptions.values():
                     e.set()
 
+                if self._resumeEvent is not None:
+                    self._resumeEvent.set()
+
                 for q in self._transaction_callbacks.values():
                     try:
                         q(TransactionResult.Disconnected())
@@ -785,9 +1389,40 @@ class DatabaseConnection:
                     self._logger.error("Got an unrequested flush response: %s", msg.guid)
                 else:
                     e.set()
+        elif msg.matches.Stats:
+            with self._lock:
+                request = self._statsRequests.get(msg.guid)
+                if not request:
+                    self._logger.error("Got unrequested stats: %s", msg.guid)
+                else:
+                    request[1] = dict(msg.samples)
+                    request[0].set()
+        elif msg.matches.ProtocolVersion:
+            with self._lock:
+                self._protocolVersion = msg.version
+                self._protocolVersionNegotiated.set()
+
+            if msg.version >= COMPRESSED_FRAMES_PROTOCOL_VERSION:
+                self._channel.peerAcceptsCompressedFrames()
+        elif msg.matches.ServerInstance:
+            with self._lock:
+                self._serverInstanceGuid = msg.guid
+        elif msg.matches.ResumeResult:
+            with self._lock:
+                if not msg.resumed:
+                    self._discardSubscribedData()
+
+                self._cur_transaction_num = msg.transaction_id
+                self._resumed = msg.resumed
+                self.disconnected.clear()
+
+                self._resumeEvent.set()
+                self._resumeEvent = None
         elif msg.matches.Initialize:
             with self._lock:
-                self._cur_transaction_num = msg.transaction_num
+                if self._resumeEvent is None:
+                    # when resuming, we're still at the last transaction we saw
+                    self._cur_transaction_num = msg.transaction_num
                 self.identityProducer = IdentityProducer(msg.identity_root)
                 self.connectionObject = core_schema.Connection.fromIdentity(msg.connIdentity)
                 self.initialized.set()
@@ -803,32 +1438,45 @@ class DatabaseConnection:
                         "Transaction commit callback threw an exception:\n%s",
                         traceback.format_exc()
                     )
-        elif msg.matches.Transaction:
+        elif msg.matches.Transaction or msg.matches.GroupedTransaction or msg.matches.DeltaTransaction:
+            if msg.matches.Transaction:
+                # a server that predates grouped writes
+                writes = keymapping.group_data_keys(
+                    {k: decodeSerializedValue(v) for k, v in msg.writes.items()}
+                )
+                set_adds = keymapping.group_index_keys(msg.set_adds)
+                set_removes = keymapping.group_index_keys(msg.set_removes)
+            else:
+                writes, set_adds, set_removes = msg.writes, msg.set_adds, msg.set_removes
+
             with self._lock:
                 key_value = {}
                 priors = {}
 
-                writes = {k: msg.writes[k] for k in msg.writes}
-                set_adds = {k: msg.set_adds[k] for k in msg.set_adds}
-                set_removes = {k: msg.set_removes[k] for k in msg.set_removes}
+                for (schema, typename), objects in writes.items():
+                    subscribed = self._subscribedIdentitiesOf(schema, typename, objects)
+                    if subscribed is None:
+                        continue
 
-                for k, val_serialized in writes.items():
-                    if not self._suppressKey(k):
-                        key_value[k] = val_serialized
+                    prefix = schema + ":" + typename + ":"
 
-                        priors[k] = self._versioned_data.setVersionedValue(
-                            k, msg.transaction_id,
-                            bytes.fromhex(val_serialized) if val_serialized is not None else None
-                        )
+                    for identity in subscribed:
+                        objectPrefix = prefix + identity + ":"
+
+                        for fieldname, val_serialized in objects[identity].items():
+                            k = objectPrefix + fieldname
 
-                for k, a in set_adds.items():
-                    a = self._suppressIdentities(k, set(a))
+                            key_value[k] = val_serialized
 
-                    self._versioned_data.setVersionedAddsAndRemoves(k, msg.transaction_id, a, set())
+                            priors[k] = self._versioned_data.setVersionedValue(
+                                k, msg.transaction_id, val_serialized
+                            )
 
-                for k, r in set_removes.items():
-                    r = self._suppressIdentities(k, set(r))
-                    self._versioned_data.setVersionedAddsAndRemoves(k, msg.transaction_id, set(), r)
+                if msg.matches.DeltaTransaction:
+                    self._applyDeltas(msg.deltas, msg.transaction_id, key_value, priors)
+
+                index_adds = self._applyIndexChanges(set_adds, msg.transaction_id, True)
+                index_removes = self._applyIndexChanges(set_removes, msg.transaction_id, False)
 
                 self._cur_transaction_num = msg.transaction_id
 
@@ -836,7 +1484,7 @@ class DatabaseConnection:
 
             for handler in self._onTransactionHandlers:
                 try:
-                    handler(key_value, priors, set_adds, set_removes, msg.transaction_id)
+                    handler(key_value, priors, index_adds, index_removes, msg.transaction_id)
                 except Exception:
                     self._logger.error(
                         "_onTransaction handler %s threw an exception:\n%s",
@@ -849,7 +1497,7 @@ class DatabaseConnection:
                 subscribedIdentities = self._schema_and_typename_to_subscription_set.setdefault((msg.schema, msg.typename), set())
                 if subscribedIdentities is not Everything:
                     subscribedIdentities.update(
-                        msg.identities
+                        internIdentities(msg.identities)
                     )
         elif msg.matches.SubscriptionData:
             with self._lock:
@@ -860,21 +1508,21 @@ class DatabaseConnection:
                 else:
                     assert not self._subscription_buildup[lookupTuple]['markedLazy'], 'received non-lazy data for a lazy subscription'
 
-                self._subscription_buildup[lookupTuple]['values'].update({k: msg.values[k] for k in msg.values})
+                self._subscription_buildup[lookupTuple]['values'].update({k: decodeSerializedValue(msg.values[k]) for k in msg.values})
                 self._subscription_buildup[lookupTuple]['index_values'].update({k: msg.index_values[k] for k in msg.index_values})
 
                 if msg.identities is not None:
                     if self._subscription_buildup[lookupTuple]['identities'] is None:
                         self._subscription_buildup[lookupTuple]['identities'] = set()
-                    self._subscription_buildup[lookupTuple]['identities'].update(msg.identities)
+                    self._subscription_buildup[lookupTuple]['identities'].update(internIdentities(msg.identities))
         elif msg.matches.LazyTransactionPriors:
             with self._lock:
                 for k, v in msg.writes.items():
-                    self._versioned_data.setVersionedTailValueStringified(k, bytes.fromhex(v) if v is not None else None)
+                    self._versioned_data.setVersionedTailValueStringified(k, decodeSerializedValue(v))
         elif msg.matches.LazyLoadResponse:
             with self._lock:
                 for k, v in msg.values.items():
-                    self._versioned_data.setVersionedTailValueStringified(k, bytes.fromhex(v) if v is not None else None)
+                    self._versioned_data.setVersionedTailValueStringified(k, decodeSerializedValue(v))
 
                 self._lazy_objects.pop(msg.identity, None)
 
@@ -891,7 +1539,7 @@ class DatabaseConnection:
                 self._subscription_buildup[lookupTuple] = {
                     'values': {},
                     'index_values': msg.index_values,
-                    'identities': msg.identities,
+                    'identities': internIdentities(msg.identities),
                     'markedLazy': True
                 }
 
@@ -959,7 +1607,7 @@ class DatabaseConnection:
                         self._lazy_objects[i] = schema_and_typename
 
                 for key, val in values.items():
-                    self._versioned_data.setVersionedValue(key, msg.tid, None if val is None else bytes.fromhex(val))
+                    self._versioned_data.setVersionedValue(key, msg.tid, val)
 
                     # this could take a long time, so we need to keep heartbeating
                     if time.time() - t0 > heartbeatInterval:
@@ -971,7 +1619,7 @@ class DatabaseConnection:
                         t0 = time.time()
 
                 for key, setval in sets.items():
-                    self._versioned_data.updateVersionedAdds(key, msg.tid, set(setval))
+                    self._versioned_data.updateVersionedAdds(key, msg.tid, internIdentities(setval))
 
                     # this could take a long time, so we need to keep heartbeating
                     if time.time() - t0 > heartbeatInterval:
@@ -1028,6 +1676,13 @@ class DatabaseConnection:
 
             return self._versioned_data.setForVersion(key, transaction_id)
 
+    def _get_set_keys_in_range(self, index_group, low_hash, high_hash):
+        with self._lock:
+            if self.disconnected.is_set():
+                raise DisconnectedException()
+
+            return self._versioned_data.setKeysInRange(index_group, low_hash, high_hash)
+
     def _get_versioned_object_data(self, key, transaction_id):
         with self._lock:
             if self._versioned_data.hasDataForKey(key):
@@ -1086,18 +1741,65 @@ class DatabaseConnection:
                                    keys_to_check_versions,
                                    indices_to_check_versions,
                                    as_of_version,
-                                   confirmCallback
+                                   confirmCallback,
+                                   key_deltas=None
                                    ):
+        """Send a transaction to the server, and call 'confirmCallback' with its TransactionResult.
+
+        'key_deltas' maps keys of DeltaEncoded fields to the frames to append to their values
+        (see field_deltas), and may only be given once the server accepts delta writes.
+        """
         assert confirmCallback is not None
+        assert not key_deltas or self._acceptsDeltaWrites()
+
+        with self._lock:
+            conflict = self._versioned_data.firstKeyChangedSince(
+                keys_to_check_versions, indices_to_check_versions, as_of_version
+            )
+
+        if conflict is not None:
+            # the server would only tell us what we already know
+            confirmCallback(TransactionResult.RevisionConflict(key=conflict))
+            return
 
         transaction_guid = self.identityProducer.createIdentity()
 
         self._transaction_callbacks[transaction_guid] = confirmCallback
 
+        protocolVersion = self._protocolVersion
+
+        if protocolVersion >= GROUPED_WRITES_PROTOCOL_VERSION:
+            self._sendGroupedTransactionData(
+                transaction_guid,
+                key_value,
+                set_adds,
+                set_removes,
+                keys_to_check_versions,
+                indices_to_check_versions
+            )
+
+            key_deltas = list((key_deltas or {}).items())
+            while key_deltas:
+                self._channel.write(
+                    ClientToServer.TransactionDeltas(
+                        deltas=keymapping.group_data_keys(dict(key_deltas[:10000])),
+                        transaction_guid=transaction_guid
+                    )
+                )
+                key_deltas = key_deltas[10000:]
+
+            self._channel.write(
+                ClientToServer.CompleteTransaction(
+                    as_of_version=as_of_version,
+                    transaction_guid=transaction_guid
+                )
+            )
+            return
+
         out_writes = {}
 
         for k, v in key_value.items():
-            out_writes[k] = v.serializedByteRep.hex() if v.serializedByteRep is not None else None
+            out_writes[k] = encodeSerializedValue(v.serializedByteRep, protocolVersion)
             if len(out_writes) > 10000:
                 self._channel.write(
                     ClientToServer.TransactionData(
@@ -1184,3 +1886,54 @@ class DatabaseConnection:
                 transaction_guid=transaction_guid
             )
         )
+
+    def _sendGroupedTransactionData(self,
+                                    transaction_guid,
+                                    key_value,
+                                    set_adds,
+                                    set_removes,
+                                    keys_to_check_versions,
+                                    indices_to_check_versions
+                                    ):
+        """Send the contents of a transaction as GroupedTransactionData messages.
+
+        Like the flat TransactionData messages, no message carries more than 10000 writes,
+        index keys, or versions to check, or more than 100000 identities in index changes.
+        """
+        writes = list(key_value.items())
+        set_adds = list(set_adds.items())
+        set_removes = list(set_removes.items())
+        keys_to_check_versions = list(keys_to_check_versions)
+        indices_to_check_versions = list(indices_to_check_versions)
+
+        def takeSetOps(setOps):
+            ct = 0
+            for i, (k, v) in enumerate(setOps):
+                ct += len(v)
+                if i >= 10000 or ct > 100000:
+                    return dict(setOps[:max(i, 1)]), setOps[max(i, 1):]
+            return dict(setOps), []
+
+        while True:
+            out_set_adds, set_adds = takeSetOps(set_adds)
+            out_set_removes, set_removes = takeSetOps(set_removes)
+
+            self._channel.write(
+                ClientToServer.GroupedTransactionData(
+                    writes=keymapping.group_data_keys({k: v.serializedByteRep for k, v in writes[:10000]}),
+                    set_adds=keymapping.group_index_keys(out_set_adds),
+                    set_removes=keymapping.group_index_keys(out_set_removes),
+                    key_versions=keys_to_check_versions[:10000],
+                    index_versions=indices_to_check_versions[:10000],
+                    transaction_guid=transaction_guid
+                )
+            )
+
+            writes = writes[10000:]
+            keys_to_check_versions = keys_to_check_versions[10000:]
+            indices_to_check_versions = indices_to_check_versions[10000:]
+
+            if not (writes or set_adds or set_removes or keys_to_check_versions or indices_to_check_versions):
+                return
+
+            self._channel.write(ClientToServer.Heartbeat())
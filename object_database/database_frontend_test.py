@@ -37,18 +37,19 @@ class ObjectDatabaseFrontEnd(unittest.TestCase):
 
             time.sleep(.5)
 
-            client = subprocess.run([
-                sys.executable,
-                os.path.join(own_dir, "frontends", "database_throughput_test.py"),
-                "localhost", "8888",
-                "--service-token", token,
-                "1"
-            ],
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL
-            )
-
-            self.assertEqual(client.returncode, 0)
+            for extraArgs in [[], ["--pipelined"]]:
+                client = subprocess.run([
+                    sys.executable,
+                    os.path.join(own_dir, "frontends", "database_throughput_test.py"),
+                    "localhost", "8888",
+                    "--service-token", token,
+                    "1"
+                ] + extraArgs,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL
+                )
+
+                self.assertEqual(client.returncode, 0)
         finally:
             server.terminate()
             server.wait()
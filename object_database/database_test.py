@@ -12,19 +12,25 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-from typed_python import Alternative, TupleOf, OneOf, ConstDict
+from typed_python import Alternative, TupleOf, ListOf, OneOf, ConstDict, serialize, deserialize
 from typed_python.SerializationContext import SerializationContext
 
-from object_database.schema import Indexed, Index, Schema
+from object_database.schema import Indexed, Index, Schema, DeltaEncoded
 from object_database.core_schema import core_schema
-from object_database.view import RevisionConflictException, DisconnectedException, ObjectDoesntExistException
-from object_database.database_connection import TransactionListener, DatabaseConnection, SetWithEdits
-from object_database.tcp_server import TcpServer
+from object_database.view import RevisionConflictException, DisconnectedException, ObjectDoesntExistException, revisionConflictRetry
+from object_database.view import SerializedDatabaseValue, FieldNotProjectedException, DeserializedValueCache
+from object_database.database_connection import (
+    TransactionListener, DatabaseConnection, SetWithEdits, ManyVersionedObjects, VersionedValue
+)
+from object_database.tcp_server import TcpServer, OVERFLOW_DISCONNECT, OVERFLOW_DROP
+from object_database.replica_server import ReplicaServer
 from object_database.inmem_server import InMemServer
-from object_database.persistence import InMemoryPersistence, RedisPersistence
+from object_database.persistence import InMemoryPersistence, RedisPersistence, WriteAheadLogPersistence
 from object_database.util import configureLogging, genToken
 from object_database.test_util import currentMemUsageMb
 
+import object_database.field_deltas as field_deltas
+import object_database.keymapping as keymapping
 import object_database.messages as messages
 import queue
 import unittest
@@ -106,6 +112,190 @@ class StringIndexed:
     name = Indexed(str)
 
 
+@schema.define
+class Reading:
+    value = Indexed(float, ordered=True)
+    sensor = str
+
+
+@schema.define
+class Shipment:
+    region = Indexed(str)
+    status = Indexed(str)
+    weight = int
+
+
+@schema.define
+class EventLog:
+    events = DeltaEncoded(ListOf(str))
+    counts = DeltaEncoded(ConstDict(str, int))
+
+
+class FieldDeltasTests(unittest.TestCase):
+    def test_changes_apply_to_the_stored_value(self):
+        T = ListOf(int)
+        context = SerializationContext({})
+
+        data = field_deltas.encodeValue(T, list(range(10)), context)
+        self.assertEqual(field_deltas.chainLength(data), 0)
+
+        for i in range(10, 13):
+            data += field_deltas.encodeChange(T, T(list(range(i))), T(list(range(i + 1))), context)
+
+        self.assertEqual(field_deltas.chainLength(data), 3)
+        self.assertEqual(field_deltas.decode(T, data, context), T(list(range(13))))
+
+        # anything but a short append gets written in full
+        self.assertIsNone(field_deltas.encodeChange(T, T([1, 2]), T([2, 3]), context))
+        self.assertIsNone(field_deltas.encodeChange(T, T([1, 2]), T([1]), context))
+        self.assertIsNone(field_deltas.encodeChange(T, T([1]), T([1, 2, 3]), context))
+
+    def test_dict_changes(self):
+        T = ConstDict(str, int)
+        old = T({"k%s" % i: i for i in range(10)})
+        new = old + {"k0": 100, "new": 1} - ["k1", "k2"]
+
+        data = field_deltas.encodeValue(T, old) + field_deltas.encodeChange(T, old, new)
+
+        self.assertEqual(field_deltas.chainLength(data), 2)
+        self.assertEqual(field_deltas.decode(T, data), new)
+
+        self.assertIsNone(field_deltas.encodeChange(T, old, T({"other": 1})))
+
+
+class DeserializedValueCacheTests(unittest.TestCase):
+    def test_shares_and_evicts(self):
+        T = ConstDict(str, int)
+        cache = DeserializedValueCache(maxBytes=1000)
+
+        value = cache.get(serialize(T, {"a": 1}), T, None)
+        self.assertEqual(value, T({"a": 1}))
+
+        # equal bytes share an entry, but other types and contexts don't
+        self.assertIs(cache.get(serialize(T, {"a": 1}), T, None), value)
+        context = SerializationContext({})
+        self.assertIsNot(cache.get(serialize(T, {"a": 1}, context), T, context), value)
+
+        big = [cache.get(serialize(T, {"k%s" % i: i}), T, None) for i in range(200)]
+        self.assertLessEqual(cache._bytes, 1000)
+        self.assertIsNot(cache.get(serialize(T, {"a": 1}), T, None), value)
+        self.assertIs(cache.get(serialize(T, {"k199": 199}), T, None), big[-1])
+
+        # values too big for the cache are deserialized but not kept
+        huge = serialize(T, {"k%s" % i: i for i in range(1000)})
+        self.assertEqual(len(cache.get(huge, T, None)), 1000)
+        self.assertLessEqual(cache._bytes, 1000)
+
+
+class OrderedIndexHashTests(unittest.TestCase):
+    def test_hashes_sort_like_values(self):
+        floats = [-float("inf"), -1e300, -2.5, -1.0, -1e-300, 0.0, 1e-300, 0.5, 1.0, 3.0, 1e300, float("inf")]
+        ints = [-2 ** 63, -10, -1, 0, 1, 9, 10, 2 ** 63 - 1]
+        strs = ["", "a", "ab", "b", "\u00e9", "\u4e2d"]
+
+        for values in [floats, ints, strs]:
+            hashes = [keymapping.ordered_index_value_to_hash(v) for v in values]
+            self.assertEqual(hashes, sorted(hashes))
+            self.assertEqual(len(set(hashes)), len(hashes))
+
+            for h in hashes:
+                self.assertNotIn(":", h)
+                self.assertNotIn("..", h)
+
+        self.assertEqual(
+            keymapping.ordered_index_value_to_hash(-0.0),
+            keymapping.ordered_index_value_to_hash(0.0)
+        )
+
+        with self.assertRaises(ValueError):
+            keymapping.ordered_index_value_to_hash(float("nan"))
+
+        with self.assertRaises(ValueError):
+            keymapping.ordered_index_value_to_hash(2 ** 63)
+
+    def test_range_tokens(self):
+        low, high = keymapping.index_range_hashes(Reading, "value", -1, None)
+
+        self.assertEqual(keymapping.parse_index_range_token(keymapping.index_range_token(low, high)), (low, high))
+        self.assertIsNone(keymapping.parse_index_range_token(keymapping.index_value_to_hash(True)))
+
+        with self.assertRaises(Exception):
+            keymapping.index_range_hashes(Counter, "k", 0, 1)
+
+
+class ManyVersionedObjectsTests(unittest.TestCase):
+    def test_old_views_against_many_writes(self):
+        objects = ManyVersionedObjects()
+
+        # one view stays open at the start the whole time
+        objects.versionIncref(0)
+        objects.setVersionedValue("test:Counter:hot:x", 0, b"0")
+
+        count = 5000
+
+        for tid in range(1, count):
+            objects.setVersionedValue("test:Counter:hot:x", tid, b"x")
+            objects.setVersionedValue("test:Counter:key_%s:x" % (tid % 100), tid, b"x")
+
+            # and we keep about a hundred more open at any given time
+            if tid % 10 == 0:
+                objects.versionIncref(tid)
+                if tid > 1000:
+                    objects.versionDecref(tid - 1000)
+
+            self.assertEqual(objects.valueForVersion("test:Counter:hot:x", 0).serializedByteRep, b"0")
+            self.assertEqual(objects.valueForVersion("test:Counter:hot:x", tid).serializedByteRep, b"x")
+
+            objects.cleanup(tid)
+
+        objects.versionDecref(0)
+        objects.cleanup(count)
+
+        # only the versions the remaining views can see are left
+        self.assertEqual(len(objects._slot("test:Counter:hot:x").version_numbers), 1000)
+
+    def test_version_chains_only_for_keys_views_disagree_about(self):
+        objects = ManyVersionedObjects()
+
+        for i in range(1000):
+            for field in ["x", "y", " exists"]:
+                objects.setVersionedValue("test:Counter:%s:%s" % (i, field), 1, b"1")
+
+        objects.cleanup(2)
+
+        # once no view can see an older version, values are stored bare, one row per object
+        self.assertEqual(objects.keycount(), 3000)
+        self.assertEqual(len(objects._rows), 1000)
+        self.assertEqual(len(objects._layouts), 1)
+        self.assertFalse(objects._version_number_objects)
+        self.assertIsInstance(objects._slot("test:Counter:5:x"), SerializedDatabaseValue)
+
+        # a view open at 2 needs to see the old value after a write at 3
+        objects.versionIncref(2)
+        objects.setVersionedValue("test:Counter:5:x", 3, b"2")
+        objects.cleanup(4)
+
+        self.assertIsInstance(objects._slot("test:Counter:5:x"), VersionedValue)
+        self.assertEqual(objects.valueForVersion("test:Counter:5:x", 2).serializedByteRep, b"1")
+        self.assertEqual(objects.valueForVersion("test:Counter:5:x", 3).serializedByteRep, b"2")
+        self.assertIsInstance(objects._slot("test:Counter:6:x"), SerializedDatabaseValue)
+
+        objects.versionDecref(2)
+        objects.cleanup(4)
+
+        self.assertIsInstance(objects._slot("test:Counter:5:x"), SerializedDatabaseValue)
+        self.assertEqual(objects.valueForVersion("test:Counter:5:x", 4).serializedByteRep, b"2")
+
+        # deleting every field of an object drops its row
+        for field in ["x", "y", " exists"]:
+            objects.setVersionedValue("test:Counter:5:%s" % field, 5, None)
+        objects.cleanup(6)
+
+        self.assertFalse(objects.hasDataForKey("test:Counter:5:x"))
+        self.assertEqual(len(objects._rows), 999)
+        self.assertEqual(objects.keycount(), 2997)
+
+
 class ObjectDatabaseTests:
     @classmethod
     def setUpClass(cls):
@@ -284,6 +474,201 @@ class ObjectDatabaseTests:
         with self.assertRaises(queue.Empty):
             loadedIDs.get_nowait()
 
+    def test_projected_subscriptions(self):
+        db1 = self.createNewDb()
+        db1.subscribeToSchema(schema)
+
+        with db1.transaction():
+            c1 = Counter(k=1, x=2)
+
+        db2 = self.createNewDb()
+        db2.subscribeToType(Counter, fields=["k"])
+
+        with db1.transaction():
+            c2 = Counter(k=3, x=4)
+            c1.k = 5
+
+        db2.flush()
+
+        with db2.view():
+            self.assertEqual((c1.k, c2.k), (5, 3))
+            self.assertEqual(set(Counter.lookupAll(k=3)), set([c2]))
+
+            with self.assertRaises(FieldNotProjectedException):
+                c1.x
+
+        if db2._protocolVersion >= messages.PROJECTED_FIELDS_PROTOCOL_VERSION:
+            for c in [c1, c2]:
+                self.assertFalse(db2._versioned_data.hasDataForKey(keymapping.data_key(Counter, c._identity, "x")))
+
+        # we can still write fields we don't read
+        with db2.transaction():
+            c1.x = 6
+
+        db1.flush()
+
+        with db1.view():
+            self.assertEqual(c1.x, 6)
+
+        with self.assertRaises(Exception):
+            db2.subscribeToType(Counter, fields=["x"])
+
+    def test_ordered_index_lookups(self):
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        with db.transaction():
+            readings = [Reading(value=v) for v in [-3.5, -1.0, 0.0, 0.25, 2.0, 2.0, 10.0]]
+
+        with db.view():
+            self.assertEqual(Reading.lookupRange(value=(-1, 2.0)), tuple(readings[1:4]))
+            self.assertEqual(Reading.lookupRange(value=(None, -1.0)), (readings[0],))
+            self.assertEqual(set(Reading.lookupRange(value=(2.0, None))), set(readings[4:]))
+            self.assertEqual(Reading.lookupRange(value=(3.0, 4.0)), ())
+            self.assertEqual(set(Reading.lookupAll(value=2)), set(readings[4:6]))
+            self.assertEqual(Reading.lookupOne(value=-3.5), readings[0])
+
+        # lookups see the transaction's own changes
+        with db.transaction():
+            readings[0].value = 1.5
+            readings[3].delete()
+            r = Reading(value=-2.0)
+
+            self.assertEqual(Reading.lookupRange(value=(-5.0, 2.0)), (r, readings[1], readings[2], readings[0]))
+
+        with db.view():
+            self.assertEqual(Reading.lookupRange(value=(-5.0, 2.0)), (r, readings[1], readings[2], readings[0]))
+
+        with self.assertRaises(Exception):
+            with db.view():
+                Counter.lookupRange(k=(0, 1))
+
+    def test_compound_lookups(self):
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        with db.transaction():
+            for i in range(40):
+                Shipment(region="north" if i % 4 else "south", status="delivered" if i % 10 else "lost", weight=i % 3)
+
+        with db.view():
+            lost = Shipment.lookupAll(status="lost")
+            self.assertEqual(len(lost), 4)
+
+            self.assertEqual(
+                set(Shipment.lookupAll(region="south", status="lost")),
+                set(s for s in lost if s.region == "south")
+            )
+            self.assertEqual(
+                set(Shipment.lookupAll(region="north", status="lost", weight=0)),
+                set(s for s in lost if s.region == "north" and s.weight == 0)
+            )
+            self.assertEqual(len(Shipment.lookupAll(weight=1)), 13)
+            self.assertEqual(Shipment.lookupAll(region="east", status="lost"), ())
+
+            # the smallest index goes first, and unindexed fields get checked last
+            self.assertEqual(
+                Shipment.explainLookup(weight=0, region="north", status="lost").split("\n"),
+                [
+                    "start from index status == 'lost' (~4 objects)",
+                    "intersect with index region == 'north' (~30 objects)",
+                    "filter on unindexed weight == 0"
+                ]
+            )
+            self.assertEqual(
+                Shipment.explainLookup(weight=0).split("\n"),
+                ["start from all objects (~40 objects)", "filter on unindexed weight == 0"]
+            )
+
+            with self.assertRaises(Exception):
+                Shipment.lookupAll(region="north", color="red")
+
+        # lookups see the transaction's own changes
+        with db.transaction():
+            s = Shipment(region="south", status="lost", weight=7)
+            lost[0].status = "found"
+
+            self.assertIn(s, Shipment.lookupAll(region="south", status="lost", weight=7))
+            self.assertNotIn(lost[0], Shipment.lookupAll(region=lost[0].region, status="lost"))
+            self.assertEqual(Shipment.lookupAny(region="south", weight=7), s)
+
+    def test_delta_encoded_fields(self):
+        db1 = self.createNewDb()
+        db2 = self.createNewDb()
+
+        db1.subscribeToSchema(schema)
+        db2.subscribeToType(EventLog)
+
+        with db1.transaction():
+            log = EventLog(events=["e%s" % i for i in range(10)], counts={"a": 1, "b": 2})
+
+        for i in range(10, 50):
+            with db1.transaction():
+                log.events = log.events + ["e%s" % i]
+
+        with db1.transaction():
+            log.counts = log.counts + {"c": 3} - ["a"]
+
+        db2.flush()
+
+        for db in [db1, db2]:
+            with db.view():
+                self.assertEqual(list(log.events), ["e%s" % i for i in range(50)])
+                self.assertEqual(dict(log.counts), {"b": 2, "c": 3})
+
+        stored = db2._versioned_data.valueForVersion(
+            keymapping.data_key(EventLog, log._identity, "events"), db2._cur_transaction_num
+        ).serializedByteRep
+
+        if db1._protocolVersion >= messages.DELTA_WRITES_PROTOCOL_VERSION:
+            # after 32 appends we wrote the whole list again, and appended the last 7 to that
+            self.assertEqual(field_deltas.chainLength(stored), 7)
+        else:
+            self.assertEqual(field_deltas.chainLength(stored), 0)
+
+        # replacing the value outright still works
+        with db2.transaction():
+            log.events = ["only"]
+
+        db1.flush()
+
+        with db1.view():
+            self.assertEqual(list(log.events), ["only"])
+
+    def test_range_subscriptions(self):
+        db1 = self.createNewDb()
+        db1.subscribeToSchema(schema)
+
+        with db1.transaction():
+            readings = [Reading(value=v, sensor="s%s" % v) for v in [0.5, 1.5, 2.5, 3.5]]
+
+        db2 = self.createNewDb()
+
+        if db2._serverProtocolVersion() < messages.RANGE_SUBSCRIPTIONS_PROTOCOL_VERSION:
+            with self.assertRaises(Exception):
+                db2.subscribeToRange(Reading, value=(1.0, 3.0))
+            return
+
+        db2.subscribeToRange(Reading, value=(1.0, 3.0))
+
+        with db2.view():
+            self.assertEqual(Reading.lookupRange(value=(None, None)), tuple(readings[1:3]))
+            self.assertEqual(readings[1].sensor, "s1.5")
+            self.assertFalse(readings[0].exists())
+
+        # objects that move into the range, or are created in it, show up
+        with db1.transaction():
+            readings[0].value = 2.0
+            r = Reading(value=1.0)
+            Reading(value=3.0)
+
+        db2.flush()
+
+        with db2.view():
+            self.assertEqual(Reading.lookupRange(value=(None, None)), (r, readings[1], readings[0], readings[2]))
+            self.assertEqual(readings[0].sensor, "s0.5")
+            self.assertFalse(readings[3].exists())
+
     def test_methods(self):
         db = self.createNewDb()
         db.subscribeToSchema(schema)
@@ -438,6 +823,114 @@ class ObjectDatabaseTests:
 
         self.assertEqual(len(OK), 10)
 
+    def test_concurrent_commits_detect_conflicts(self):
+        threadCount = 4
+        count = 50
+
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        with db.transaction():
+            shared = Counter(k=-1)
+
+        def worker(index):
+            db = self.createNewDb()
+            db.subscribeToSchema(schema)
+
+            with db.transaction():
+                mine = Counter(k=index)
+
+            @revisionConflictRetry
+            def increment():
+                with db.transaction():
+                    shared.x = shared.x + 1
+                    mine.x = mine.x + 1
+
+            for _ in range(count):
+                increment()
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(threadCount)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+
+        db.flush()
+
+        with db.view():
+            self.assertEqual(shared.x, count * threadCount)
+
+            for i in range(threadCount):
+                self.assertEqual(Counter.lookupOne(k=i).x, count)
+
+    def test_broadcast_sees_values_as_of_its_transaction(self):
+        db1 = self.createNewDb()
+        db1.subscribeToSchema(schema)
+
+        with db1.transaction():
+            c = Counter(k=0, x=1)
+
+        db2 = self.createNewDb()
+        db2.subscribeToIndex(Counter, k=5)
+
+        broadcast = []
+        broadcastTransactions = self.server._broadcastTransactions
+
+        def recordBroadcast(transactions):
+            broadcastTransactions(transactions)
+            broadcast.extend(transactions)
+
+        self.server._broadcastTransactions = recordBroadcast
+
+        def encode(value):
+            return serialize(int, value, db1.serializationContext)
+
+        kKey = keymapping.data_key(Counter, c._identity, "k")
+        xKey = keymapping.data_key(Counter, c._identity, "x")
+        tid = self.server._cur_transaction_num
+
+        def waitForKvstore(key, value):
+            t0 = time.time()
+            while self.server._kvstore.get(key) != value:
+                self.assertLess(time.time() - t0, 5.0 * self.PERFORMANCE_FACTOR)
+                time.sleep(.01)
+
+        # hold the broadcast of a transaction moving 'c' into db2's index until a later
+        # transaction has written to it.
+        with self.server._lock:
+            moveIntoIndex = threading.Thread(
+                target=self.server._handleNewTransaction,
+                args=(
+                    None,
+                    {kKey: encode(5)},
+                    {keymapping.index_key(Counter, "k", 5): {c._identity}},
+                    {keymapping.index_key(Counter, "k", 0): {c._identity}},
+                    [], [], tid
+                )
+            )
+            moveIntoIndex.start()
+            waitForKvstore(kKey, encode(5))
+
+            write = threading.Thread(
+                target=self.server._handleNewTransaction,
+                args=(None, {xKey: encode(2)}, {}, {}, [], [], tid)
+            )
+            write.start()
+            waitForKvstore(xKey, encode(2))
+
+        moveIntoIndex.join()
+        write.join()
+
+        moved = [t for t in broadcast if t.transaction_id == tid + 1][0]
+        movedX = moved.writes[schema.name, "Counter"][c._identity]["x"]
+        self.assertEqual(deserialize(int, movedX, db1.serializationContext), 1)
+
+        db2.flush()
+
+        with db2.view():
+            self.assertEqual(c.x, 2)
+
     def test_transaction_handlers(self):
         db = self.createNewDb()
         db.subscribeToSchema(schema)
@@ -489,6 +982,73 @@ class ObjectDatabaseTests:
             self.assertTrue(root.obj.k.value > 500, root.obj.k.value)
             print(root.obj.k.value, "transactions per second")
 
+    def test_pipelined_commits(self):
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        with db.transaction():
+            counters = [Counter(k=i) for i in range(100)]
+
+        db.maxPipelinedCommits = 10
+
+        confirmations = []
+        for c in counters:
+            with db.transaction().pipelined() as t:
+                c.x = c.k + 1
+            confirmations.append(t.confirmation)
+
+        for confirmation in confirmations:
+            self.assertIsNone(confirmation.result(timeout=5.0))
+
+        self.assertEqual(db._pipelinedCommits, 0)
+
+        # once a transaction is confirmed, new ones see what it wrote
+        with db.view():
+            self.assertEqual([c.x for c in counters], [c.k + 1 for c in counters])
+
+        # but transactions opened while it's in flight don't
+        t2 = db.transaction()
+
+        with db.transaction().pipelined() as t1:
+            counters[0].x = counters[0].x + 1
+        with t2.pipelined():
+            counters[0].x = counters[0].x + 1
+
+        t1.confirmation.result(timeout=5.0)
+
+        with self.assertRaises(RevisionConflictException):
+            t2.confirmation.result(timeout=5.0)
+
+        # transactions we already know are out of date fail without asking the server
+        def overwrite():
+            with db.transaction():
+                counters[1].x = 0
+
+        with db.transaction().pipelined() as t3:
+            x = counters[1].x
+
+            writer = threading.Thread(target=overwrite)
+            writer.start()
+            writer.join()
+
+            db.flush()
+
+            counters[1].x = x + 1
+
+        self.assertTrue(t3.confirmation.done())
+        self.assertIsInstance(t3.confirmation.exception(), RevisionConflictException)
+
+        # pipelining keeps the server busy
+        t0 = time.time()
+        count = 0
+        while time.time() < t0 + 1.0:
+            with db.transaction().pipelined() as t:
+                counters[count % 100].x = count
+            count += 1
+
+        t.confirmation.result(timeout=5.0)
+        print(count, "pipelined transactions per second")
+
     def test_delayed_transactions(self):
         db = self.createNewDb()
         db.subscribeToSchema(schema)
@@ -503,8 +1063,6 @@ class ObjectDatabaseTests:
             with db.transaction().onConfirmed(confirmed.put):
                 root.obj.k = expr.Constant(value=root.obj.k.value + 1)
 
-        self.assertTrue(confirmed.qsize() < 1000)
-
         good = 0
         for i in range(1000):
             if confirmed.get().matches.Success:
@@ -539,6 +1097,37 @@ class ObjectDatabaseTests:
         with db.view():
             self.assertFalse(root.exists())
 
+    def test_identities_are_shared_between_index_sets(self):
+        db1 = self.createNewDb()
+        db1.subscribeToSchema(schema)
+
+        db2 = self.createNewDb()
+        db2.subscribeToSchema(schema)
+
+        # db2 hears about c1 in a transaction, and db3 in its subscription
+        with db1.transaction():
+            c1 = Counter(k=1)
+
+        db3 = self.createNewDb()
+        db3.subscribeToSchema(schema)
+
+        for db in [db2, db3]:
+            db.flush()
+
+            existsSet = db._get_versioned_set_data(
+                keymapping.index_key(Counter, " exists", True), db._cur_transaction_num
+            ).toSet()
+            kSet = db._get_versioned_set_data(
+                keymapping.index_key(Counter, "k", 1), db._cur_transaction_num
+            ).toSet()
+
+            inExists = [i for i in existsSet if i == c1._identity]
+            inK = [i for i in kSet if i == c1._identity]
+
+            self.assertEqual(len(inExists), 1)
+            self.assertEqual(len(inK), 1)
+            self.assertIs(inExists[0], inK[0])
+
     def test_read_performance(self):
         db = self.createNewDb()
         db.subscribeToSchema(schema)
@@ -612,13 +1201,45 @@ class ObjectDatabaseTests:
                 with t2:
                     root.obj.k = expr.Constant(value=root.obj.k.value + 1)
 
-    def test_conflicts_dont_cause_view_leaks(self):
+    def test_server_stats(self):
         db = self.createNewDb()
         db.subscribeToSchema(schema)
 
-        with db.transaction():
-            root = Root()
-            root.obj = Object(k=expr.Constant(value=0))
+        for i in range(5):
+            with db.transaction():
+                Counter(k=i, x=i)
+
+        stats = db.serverStats()
+
+        self.assertGreaterEqual(stats["object_database_transactions_total"], 5)
+        self.assertGreaterEqual(stats["object_database_keys_set_total"], 10)
+        self.assertGreaterEqual(stats["object_database_subscriptions_total"], 1)
+        self.assertGreater(stats["object_database_version_numbers"], 0)
+
+        for phase in ["validate", "persist", "broadcast"]:
+            name = "object_database_commit_%s_seconds" % phase
+
+            self.assertGreaterEqual(stats[name + "_count"], 5)
+            self.assertEqual(stats[name + '_bucket{le="+Inf"}'], stats[name + "_count"])
+
+        self.assertGreater(
+            stats['object_database_channel_outbound_messages_total{connection="%s"}' % db.connectionObject._identity],
+            5
+        )
+
+        text = self.server.prometheusStats()
+
+        self.assertIn("# TYPE object_database_commit_persist_seconds histogram\n", text)
+        self.assertIn("# TYPE object_database_transactions_total counter\n", text)
+        self.assertIn("object_database_subscription_seconds_count ", text)
+
+    def test_conflicts_dont_cause_view_leaks(self):
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        with db.transaction():
+            root = Root()
+            root.obj = Object(k=expr.Constant(value=0))
 
         t1 = db.transaction()
         t2 = db.transaction()
@@ -1209,6 +1830,7 @@ class ObjectDatabaseTests:
         blocker = BlockingCallback()
 
         self.server._subscriptionBackgroundThreadCallback = blocker.callback
+        self.server.SUBSCRIPTION_CHUNK_SIZE = 1000
 
         if shouldSubscribeToIndex:
             subscriptionEvents = db2.subscribeToIndex(Counter, k=123, block=False)
@@ -1223,7 +1845,9 @@ class ObjectDatabaseTests:
             c2 = Counter(k=123)
 
         blocker.releaseCallback()
-        for i in range(1, 101):
+
+        # the rest of the objects go out in chunks of 1000
+        for i in range(1, 11):
             self.assertEqual(blocker.waitForCallback(pfactor), i)
             blocker.releaseCallback()
 
@@ -1256,10 +1880,11 @@ class ObjectDatabaseTests:
         blocker = BlockingCallback()
 
         self.server._subscriptionBackgroundThreadCallback = blocker.callback
+        self.server.SUBSCRIPTION_CHUNK_SIZE = 1000
 
         subscriptionEvents = db2.subscribeToIndex(Counter, k=123, block=False)
 
-        for i in range(0, 50):
+        for i in range(0, 5):
             self.assertEqual(blocker.waitForCallback(self.PERFORMANCE_FACTOR), i)
             blocker.releaseCallback()
 
@@ -1273,7 +1898,7 @@ class ObjectDatabaseTests:
         with db1.transaction():
             c1.k = 123
 
-        for i in range(50, 101):
+        for i in range(5, 11):
             self.assertEqual(blocker.waitForCallback(self.PERFORMANCE_FACTOR), i)
             blocker.releaseCallback()
 
@@ -1468,11 +2093,240 @@ class ObjectDatabaseTests:
 
         time.sleep(.1)
 
-        self.assertTrue(len(self.server._version_numbers) > 10)
+        self.assertTrue(self.server.versionNumberCount() > 10)
 
         self.server._garbage_collect(intervalOverride=.1)
 
-        self.assertTrue(len(self.server._version_numbers) < 10)
+        self.assertTrue(self.server.versionNumberCount() < 10)
+        self.assertGreater(self.server.metrics.counter("gc_keys_reclaimed_total"), 10)
+
+    def test_garbage_collection_in_slices(self):
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        self.server.GC_SLICE_SIZE = 5
+
+        with db.transaction():
+            counters = [Counter(k=i) for i in range(100)]
+
+        with db.transaction():
+            for c in counters[:50]:
+                c.delete()
+
+        versionNumbers = self.server.versionNumberCount()
+
+        # nothing is old enough yet
+        self.assertEqual(self.server._garbage_collect(intervalOverride=100), 0)
+
+        time.sleep(.2)
+
+        # someone commits to one of the emptied index keys after it goes stale
+        with db.transaction():
+            recreated = Counter(k=1)
+
+        pauses = self.server.metrics.histogramCount("gc_pause_seconds")
+
+        self.assertGreater(self.server._garbage_collect(intervalOverride=.1), 50)
+        self.assertLess(self.server.versionNumberCount(), versionNumbers)
+
+        # each slice pauses commits twice, and we took more than one slice per shard
+        self.assertGreater(self.server.metrics.histogramCount("gc_pause_seconds") - pauses, 2 * 64)
+
+        indexKey = keymapping.index_key(Counter, "k", 1)
+        self.assertIn(indexKey, self.server._shardFor(indexKey).version_numbers)
+
+        with db.view():
+            self.assertEqual(Counter.lookupAll(k=1), (recreated,))
+            self.assertEqual(len(Counter.lookupAll()), 51)
+
+    def dropConnection(self, db):
+        db._channel.close()
+        self.assertTrue(db.disconnected.wait(timeout=5.0))
+
+    def test_resume_replays_missed_transactions(self):
+        db1 = self.createNewDb()
+        db1.subscribeToType(Counter)
+        db1.subscribeToIndex(StringIndexed, name="nobody")
+
+        db2 = self.createNewDb()
+        db2.subscribeToSchema(schema)
+
+        with db2.transaction():
+            c1 = Counter(k=1, x=1)
+            c2 = Counter(k=2, x=2)
+            s1 = StringIndexed(name="hi")
+
+        db1.flush()
+
+        with db1.transaction():
+            # an object outside our index subscription, which we see because we made it
+            s2 = StringIndexed(name="there")
+
+        self.dropConnection(db1)
+
+        db2.flush()
+
+        with db2.transaction():
+            c1.x = 10
+            c2.delete()
+            c3 = Counter(k=3, x=3)
+            s1.name = "bye"
+            s2.name = "everyone"
+
+        self.assertTrue(self.server.resume(db1, self.auth_token))
+
+        with db1.view():
+            self.assertEqual(c1.x, 10)
+            self.assertFalse(c2.exists())
+            self.assertEqual(c3.x, 3)
+            self.assertEqual(Counter.lookupOne(k=3), c3)
+            self.assertEqual(s2.name, "everyone")
+
+        # the server only replays what we're subscribed to
+        s1Name = keymapping.data_key(StringIndexed, s1._identity, "name")
+        self.assertFalse(db1._versioned_data.hasDataForKey(s1Name))
+
+        # and we keep receiving transactions, and can commit our own
+        with db2.transaction():
+            c1.x = 20
+
+        with db1.transaction():
+            c3.x = 30
+
+        db1.flush()
+        db2.flush()
+
+        with db1.view():
+            self.assertEqual(c1.x, 20)
+
+        with db2.view():
+            self.assertEqual(c3.x, 30)
+
+    def test_resume_refreshes_index_subscriptions(self):
+        db1 = self.createNewDb()
+        db2 = self.createNewDb()
+        db2.subscribeToSchema(schema)
+
+        with db2.transaction():
+            c1 = Counter(k=1, x=1)
+            c2 = Counter(k=2, x=2)
+
+        db1.subscribeToIndex(Counter, k=1)
+
+        self.dropConnection(db1)
+
+        with db2.transaction():
+            c1.x = 10
+            c2.k = 1
+
+        self.assertTrue(self.server.resume(db1, self.auth_token))
+
+        with db1.view():
+            self.assertEqual(c1.x, 10)
+            self.assertEqual(c2.x, 2)
+            self.assertEqual(set(Counter.lookupAll(k=1)), set([c1, c2]))
+
+    def test_resume_with_an_active_index_subscription(self):
+        db1 = self.createNewDb()
+        db2 = self.createNewDb()
+        db2.subscribeToSchema(schema)
+
+        with db2.transaction():
+            c1 = Counter(k=1, x=1)
+            c2 = Counter(k=1, x=2)
+            c3 = Counter(k=2, x=3)
+
+        db1.subscribeToIndex(Counter, k=1)
+
+        self.dropConnection(db1)
+
+        with db2.transaction():
+            c1.x = 10
+            c2.k = 2
+            c3.k = 1
+
+        self.assertTrue(self.server.resume(db1, self.auth_token))
+
+        with db1.view():
+            self.assertEqual(set(Counter.lookupAll(k=1)), set([c1, c3]))
+            self.assertEqual(c1.x, 10)
+            self.assertEqual(c3.x, 3)
+
+        # the index subscription is live again on the new channel
+        with db2.transaction():
+            c3.x = 30
+            c4 = Counter(k=1, x=4)
+
+        db2.flush()
+        db1.flush()
+
+        with db1.view():
+            self.assertEqual(set(Counter.lookupAll(k=1)), set([c1, c3, c4]))
+            self.assertEqual(c3.x, 30)
+            self.assertEqual(c4.x, 4)
+
+    def test_resume_with_projections_resubscribes(self):
+        db1 = self.createNewDb()
+        db1.subscribeToType(Counter, fields=["k"])
+
+        db2 = self.createNewDb()
+        db2.subscribeToSchema(schema)
+
+        with db2.transaction():
+            c1 = Counter(k=1, x=1)
+
+        db1.flush()
+
+        self.dropConnection(db1)
+
+        with db2.transaction():
+            c1.k = 2
+
+        self.assertFalse(self.server.resume(db1, self.auth_token))
+
+        with db1.view():
+            self.assertEqual(c1.k, 2)
+
+            with self.assertRaises(FieldNotProjectedException):
+                c1.x
+
+    def test_resume_resyncs_when_history_is_too_short(self):
+        self.server.transactionHistorySize = 2
+
+        db1 = self.createNewDb()
+        db1.subscribeToSchema(schema)
+
+        db2 = self.createNewDb()
+        db2.subscribeToSchema(schema)
+
+        with db2.transaction():
+            counters = [Counter(k=i, x=i) for i in range(5)]
+
+        db1.flush()
+
+        self.dropConnection(db1)
+
+        for c in counters[:3]:
+            with db2.transaction():
+                c.delete()
+
+        with db2.transaction():
+            counters[4].x = 100
+
+        self.assertFalse(self.server.resume(db1, self.auth_token))
+
+        with db1.view():
+            self.assertEqual(set(Counter.lookupAll()), set(counters[3:]))
+            self.assertEqual(counters[4].x, 100)
+
+        with db2.transaction():
+            counters[3].x = 50
+
+        db2.flush()
+        db1.flush()
+
+        with db1.view():
+            self.assertEqual(counters[3].x, 50)
 
 
 class ObjectDatabaseOverChannelTestsWithRedis(unittest.TestCase, ObjectDatabaseTests):
@@ -1507,6 +2361,7 @@ class ObjectDatabaseOverChannelTestsWithRedis(unittest.TestCase, ObjectDatabaseT
 
     def tearDown(self):
         self.server.stop()
+        self.mem_store.close()
         self.redisProcess.terminate()
         self.redisProcess.wait()
         self.redisProcess = None
@@ -1521,6 +2376,279 @@ class ObjectDatabaseOverChannelTestsWithRedis(unittest.TestCase, ObjectDatabaseT
     def test_flush_db_works(self):
         pass
 
+    def test_hex_encoded_values_are_upgraded(self):
+        # write into an unused db the way old servers did
+        r = redis.StrictRedis(db=1, port=1115)
+        r.set("test_schema:Counter:1_1:x", serialize(int, 10).hex())
+        r.set("test_schema:Counter:1_1: ixval:k", "int_3")
+
+        store = RedisPersistence(db=1, port=1115)
+
+        self.assertEqual(store.get("test_schema:Counter:1_1:x"), serialize(int, 10))
+        self.assertEqual(store.get("test_schema:Counter:1_1: ixval:k"), b"int_3")
+
+        # the conversion only ever happens once
+        store = RedisPersistence(db=1, port=1115)
+        self.assertEqual(store.get("test_schema:Counter:1_1:x"), serialize(int, 10))
+
+    def test_interrupted_hex_upgrade_can_be_rerun(self):
+        # an upgrade that died after converting 'x' but before 'y'
+        r = redis.StrictRedis(db=1, port=1115)
+        r.set("test_schema:Counter:1_1:x", serialize(int, 10))
+        r.sadd(RedisPersistence.CONVERTED_KEYS_KEY, "test_schema:Counter:1_1:x")
+        r.set("test_schema:Counter:1_1:y", serialize(int, 20).hex())
+
+        store = RedisPersistence(db=1, port=1115)
+
+        self.assertEqual(store.get("test_schema:Counter:1_1:x"), serialize(int, 10))
+        self.assertEqual(store.get("test_schema:Counter:1_1:y"), serialize(int, 20))
+        self.assertFalse(r.exists(RedisPersistence.CONVERTED_KEYS_KEY))
+        self.assertEqual(r.get(RedisPersistence.STORAGE_FORMAT_KEY), b"binary")
+
+    def test_queued_writes(self):
+        store = RedisPersistence(db=2, port=1115, asyncWrites=True)
+
+        self.assertEqual(store.setSeveral({"a": b"1", "b": b"2"}, {"s": {"x", "y"}}), ({"s"}, set()))
+
+        # we can read writes before redis has them
+        self.assertEqual(store.getSeveral(["a", "b", "c"]), [b"1", b"2", None])
+        self.assertEqual(store.getSetMembers("s"), {"x", "y"})
+
+        self.assertEqual(store.setSeveral({"a": None}, {}, {"s": {"x", "y"}}), (set(), {"s"}))
+
+        self.assertIsNone(store.get("a"))
+        self.assertFalse(store.exists("a"))
+        self.assertEqual(store.getSetMembers("s"), set())
+
+        store.flush()
+
+        other = RedisPersistence(db=2, port=1115)
+
+        self.assertEqual(other.getSeveral(["a", "b"]), [None, b"2"])
+        self.assertEqual(other.getSetMembers("s"), set())
+
+        # synchronous writes are in redis as soon as setSeveral returns
+        other.setSeveral({"c": b"3"}, {"s": {"z"}})
+
+        r = redis.StrictRedis(db=2, port=1115)
+        self.assertEqual(r.get("c"), b"3")
+        self.assertEqual(r.smembers("s"), {b"z"})
+
+        store.close()
+        other.close()
+
+    def test_rejected_writes_stop_the_store(self):
+        store = RedisPersistence(db=3, port=1115)
+
+        r = redis.StrictRedis(db=3, port=1115)
+        r.config_set("maxmemory-policy", "noeviction")
+        r.config_set("maxmemory", 1)
+
+        try:
+            with self.assertRaises(Exception):
+                store.setSeveral({"a": b"1"})
+
+            # once a write is lost, we refuse to take more
+            with self.assertRaises(Exception):
+                store.setSeveral({"b": b"2"})
+
+            with self.assertRaises(Exception):
+                store.flush()
+        finally:
+            r.config_set("maxmemory", 0)
+
+        store.close()
+
+
+class ObjectDatabaseOverChannelTestsWithWriteAheadLog(unittest.TestCase, ObjectDatabaseTests):
+    @classmethod
+    def setUpClass(cls):
+        ObjectDatabaseTests.setUpClass()
+
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.tempDirName = self.tempDir.__enter__()
+        self.auth_token = genToken()
+
+        self.startServer()
+
+    def startServer(self):
+        self.mem_store = WriteAheadLogPersistence(self.tempDirName)
+        self.server = InMemServer(self.mem_store, self.auth_token)
+        self.server._gc_interval = .1
+        self.server.start()
+
+    def restartServer(self):
+        self.server.stop()
+        self.mem_store.close()
+        self.startServer()
+
+    def createNewDb(self):
+        return self.server.connect(self.auth_token)
+
+    def tearDown(self):
+        self.server.stop()
+        self.mem_store.close()
+        self.tempDir.__exit__(None, None, None)
+
+    def test_data_survives_restart(self):
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        with db.transaction():
+            for i in range(10):
+                Counter(k=i, x=i * 2)
+            toDelete = Counter(k=100)
+
+        with db.transaction():
+            toDelete.delete()
+            Counter.lookupOne(k=3).x = 1000
+
+        self.restartServer()
+
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        with db.view():
+            self.assertEqual(len(Counter.lookupAll()), 10)
+            self.assertEqual(Counter.lookupOne(k=3).x, 1000)
+            self.assertEqual(Counter.lookupOne(k=4).x, 8)
+            self.assertIsNone(Counter.lookupAny(k=100))
+
+    def test_resume_after_restart_resyncs(self):
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        with db.transaction():
+            c1 = Counter(k=1, x=1)
+            c2 = Counter(k=2, x=2)
+
+        self.restartServer()
+        self.dropConnection(db)
+
+        db2 = self.createNewDb()
+        db2.subscribeToSchema(schema)
+
+        with db2.transaction():
+            c1.x = 10
+            c2.delete()
+
+        self.assertFalse(self.server.resume(db, self.auth_token))
+
+        with db.view():
+            self.assertEqual(c1.x, 10)
+            self.assertFalse(c2.exists())
+
+    def test_snapshots_compact_the_log(self):
+        self.mem_store.snapshotThreshold = 1000
+
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        for i in range(100):
+            with db.transaction():
+                Counter(k=i, x=i)
+
+        self.mem_store.snapshot()
+
+        names = os.listdir(self.tempDirName)
+        self.assertEqual(len([n for n in names if n.startswith("snapshot.")]), 1, names)
+        self.assertEqual(len([n for n in names if n.startswith("log.")]), 1, names)
+
+        with db.transaction():
+            Counter.lookupOne(k=5).x = 500
+
+        self.restartServer()
+
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        with db.view():
+            self.assertEqual(len(Counter.lookupAll()), 100)
+            self.assertEqual(Counter.lookupOne(k=5).x, 500)
+            self.assertEqual(Counter.lookupOne(k=6).x, 6)
+
+    def test_writes_overlay_the_mapped_snapshot(self):
+        self.mem_store.setSeveral({"a": b"1", "b": b"2"}, {"s": set(["x", "y"])})
+        self.mem_store.snapshot()
+
+        self.restartServer()
+
+        store = self.mem_store
+        self.assertEqual(store.get("a"), b"1")
+        self.assertEqual(store.getSetMembers("s"), set(["x", "y"]))
+
+        store.setSeveral({"a": b"3", "b": None}, {"s": set(["z"])}, {"s": set(["x"])})
+
+        self.assertEqual(store.get("a"), b"3")
+        self.assertIsNone(store.get("b"))
+        self.assertFalse(store.exists("b"))
+        self.assertEqual(store.getSetMembers("s"), set(["y", "z"]))
+
+        new_sets, dropped_sets = store.setSeveral({}, {}, {"s": set(["y", "z"])})
+        self.assertEqual(dropped_sets, set(["s"]))
+        self.assertFalse(store.exists("s"))
+
+        store.snapshot()
+        self.restartServer()
+
+        store = self.mem_store
+        self.assertEqual(store.get("a"), b"3")
+        self.assertIsNone(store.get("b"))
+        self.assertEqual(store.getSetMembers("s"), set())
+
+    def test_writes_after_close_raise(self):
+        store = WriteAheadLogPersistence(os.path.join(self.tempDirName, "other"))
+        store.setSeveral({"a": b"1"})
+        store.close()
+
+        with self.assertRaisesRegex(Exception, "is closed"):
+            store.setSeveral({"a": b"2"})
+
+    def test_writes_that_cant_apply_are_not_logged(self):
+        store = self.mem_store
+        store.setSeveral({"a": b"1"}, {"s": set(["x"])})
+
+        with self.assertRaises(AssertionError):
+            store.setSeveral({"a": b"2"}, {}, {"s": set(["y"])})
+
+        with self.assertRaises(AssertionError):
+            store.setSeveral({"b": b"2"}, {"a": set(["x"])})
+
+        self.assertEqual(store.get("a"), b"1")
+        self.assertIsNone(store.get("b"))
+        self.assertEqual(store.getSetMembers("s"), set(["x"]))
+
+        self.restartServer()
+
+        store = self.mem_store
+        self.assertEqual(store.get("a"), b"1")
+        self.assertIsNone(store.get("b"))
+        self.assertEqual(store.getSetMembers("s"), set(["x"]))
+
+    def test_torn_log_writes_are_discarded(self):
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        with db.transaction():
+            Counter(k=1, x=1)
+
+        self.server.stop()
+        self.mem_store.close()
+
+        # simulate a crash halfway through appending a record
+        lastLog = sorted(n for n in os.listdir(self.tempDirName) if n.startswith("log."))[-1]
+        with open(os.path.join(self.tempDirName, lastLog), "ab") as f:
+            f.write(b"\x10\x00\x00\x00garbage")
+
+        self.startServer()
+
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        with db.view():
+            self.assertEqual(Counter.lookupOne(k=1).x, 1)
+
 
 class ObjectDatabaseOverChannelTests(unittest.TestCase, ObjectDatabaseTests):
     @classmethod
@@ -1554,7 +2682,112 @@ class ObjectDatabaseOverChannelTests(unittest.TestCase, ObjectDatabaseTests):
         finally:
             messages.setHeartbeatInterval(old_interval)
 
+    def test_legacy_protocol_clients_interoperate(self):
+        db1 = self.createNewDb()
+
+        # a client that never negotiates gets (and sends) hex-encoded values
+        db2 = DatabaseConnection(self.server.getChannel())
+        db2._channel.write(messages.ClientToServer.Authenticate(token=self.auth_token))
+        db2.initialized.wait()
+
+        db1.subscribeToSchema(schema)
+        db2.subscribeToSchema(schema)
+
+        self.assertEqual(db1._protocolVersion, messages.PROTOCOL_VERSION)
+        self.assertEqual(db2._protocolVersion, 0)
+
+        with db1.transaction():
+            c1 = Counter(k=1, x=2)
+
+        with db2.transaction():
+            c2 = Counter(k=3, x=4)
+
+        db1.flush()
+        db2.flush()
+
+        for db in [db1, db2]:
+            with db.view():
+                self.assertEqual((c1.k, c1.x), (1, 2))
+                self.assertEqual((c2.k, c2.x), (3, 4))
+
+        self.assertTrue(all(isinstance(v, (bytes, set)) for v in self.mem_store.values.values()))
+
+    def test_clients_without_grouped_writes_interoperate(self):
+        db1 = self.createNewDb()
+
+        # a client that negotiates version 3 sends and receives transactions with flat keys
+        db2 = DatabaseConnection(self.server.getChannel())
+        db2._channel.write(messages.ClientToServer.Authenticate(token=self.auth_token))
+        db2._channel.write(
+            messages.ClientToServer.ProtocolVersion(version=messages.RESUMABLE_PROTOCOL_VERSION)
+        )
+        db2.initialized.wait()
+
+        db1.subscribeToSchema(schema)
+        db2.subscribeToIndex(Counter, k=3)
+
+        self.assertEqual(db2._protocolVersion, messages.RESUMABLE_PROTOCOL_VERSION)
+
+        with db1.transaction():
+            c1 = Counter(k=1, x=2)
+
+        with db2.transaction():
+            c2 = Counter(k=3, x=4)
+
+        db1.flush()
+        db2.flush()
+
+        with db1.transaction():
+            c3 = Counter(k=3, x=5)
+            c1.x = 3
+
+        db2.flush()
+
+        with db1.view():
+            self.assertEqual((c1.k, c1.x), (1, 3))
+            self.assertEqual((c2.k, c2.x), (3, 4))
+
+        with db2.view():
+            self.assertEqual((c2.k, c2.x), (3, 4))
+            self.assertEqual((c3.k, c3.x), (3, 5))
+            self.assertEqual(set(Counter.lookupAll(k=3)), set([c2, c3]))
+
+    def test_clients_without_delta_writes_interoperate(self):
+        db1 = self.createNewDb()
+
+        # a client that negotiates version 6 gets whole values for DeltaEncoded fields
+        db2 = DatabaseConnection(self.server.getChannel())
+        db2._channel.write(messages.ClientToServer.Authenticate(token=self.auth_token))
+        db2._channel.write(
+            messages.ClientToServer.ProtocolVersion(version=messages.RANGE_SUBSCRIPTIONS_PROTOCOL_VERSION)
+        )
+        db2.initialized.wait()
+
+        db1.subscribeToSchema(schema)
+        db2.subscribeToType(EventLog)
+
+        with db1.transaction():
+            log = EventLog(events=["e%s" % i for i in range(10)])
+
+        with db1.transaction():
+            log.events = log.events + ["e10"]
+
+        db2.flush()
+
+        with db2.view():
+            self.assertEqual(len(log.events), 11)
+
+        # and sends them
+        with db2.transaction():
+            log.events = log.events + ["e11"]
+
+        db1.flush()
+
+        with db1.view():
+            self.assertEqual(list(log.events), ["e%s" % i for i in range(12)])
+
     def test_heartbeats(self):
+
         old_interval = messages.getHeartbeatInterval()
         messages.setHeartbeatInterval(.25)
 
@@ -1640,6 +2873,91 @@ class ObjectDatabaseOverChannelTests(unittest.TestCase, ObjectDatabaseTests):
             SetWithEdits.AGRESSIVELY_CHECK_SET_ADDS_NOT_CHANGING = False
 
 
+class ObjectDatabaseOverChannelTestsWithGroupCommit(ObjectDatabaseOverChannelTests):
+    def setUp(self):
+        self.auth_token = genToken()
+
+        self.mem_store = InMemoryPersistence()
+        self.server = InMemServer(self.mem_store, self.auth_token)
+        self.server._gc_interval = .1
+        self.server.groupCommitWindow = .001
+        self.server.start()
+
+    def test_throughput(self):
+        # a lone client committing serially waits out the whole window on every commit,
+        # so this would measure the window rather than the server
+        self.server.groupCommitWindow = 0.0
+        super().test_throughput()
+
+    def test_group_commit_coalesces_transactions(self):
+        self.server.groupCommitWindow = .5
+
+        writers = [self.createNewDb() for _ in range(4)]
+        for w in writers:
+            w.subscribeToSchema(schema)
+
+        db = self.createNewDb()
+        db.subscribeToSchema(schema)
+
+        transactionIds = []
+        db.registerOnTransactionHandler(
+            lambda key_value, priors, set_adds, set_removes, tid: transactionIds.append(tid)
+        )
+
+        def writer(ix):
+            with writers[ix].transaction():
+                Counter(k=ix, x=ix)
+
+        threads = [threading.Thread(target=writer, args=(i,)) for i in range(len(writers))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        db.flush()
+
+        with db.view():
+            self.assertEqual(sorted(c.k for c in Counter.lookupAll()), [0, 1, 2, 3])
+
+        self.assertLess(len(transactionIds), len(writers))
+
+    def test_group_commit_detects_conflicts_within_a_batch(self):
+        self.server.groupCommitWindow = .5
+
+        db1 = self.createNewDb()
+        db1.subscribeToSchema(schema)
+        db2 = self.createNewDb()
+        db2.subscribeToSchema(schema)
+
+        with db1.transaction():
+            c = Counter(k=0)
+
+        db2.flush()
+
+        succeeded = []
+
+        def increment(db):
+            try:
+                with db.transaction():
+                    c.x = c.x + 1
+                succeeded.append(True)
+            except RevisionConflictException:
+                pass
+
+        threads = [threading.Thread(target=increment, args=(db,)) for db in (db1, db2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        db1.flush()
+
+        self.assertEqual(len(succeeded), 1)
+
+        with db1.view():
+            self.assertEqual(c.x, 1)
+
+
 class ObjectDatabaseOverSocketTests(unittest.TestCase, ObjectDatabaseTests):
     @classmethod
     def setUpClass(cls):
@@ -1727,3 +3045,240 @@ class ObjectDatabaseOverSocketTests(unittest.TestCase, ObjectDatabaseTests):
 
         finally:
             messages.setHeartbeatInterval(old_interval)
+
+    def test_outbound_queue_metrics(self):
+        db1 = self.createNewDb()
+        db1.subscribeToSchema(schema)
+
+        for i in range(10):
+            with db1.transaction():
+                Counter(k=i)
+
+        db1.flush()
+
+        metrics = self.server.outboundQueueMetrics()
+
+        self.assertEqual(metrics['connections'], 1)
+        self.assertEqual(metrics['queuedMessages'], 0)
+        self.assertEqual(metrics['queuedBytes'], 0)
+        self.assertGreater(metrics['peakQueuedBytes'], 0)
+        self.assertEqual(metrics['overflowedConnections'], 0)
+
+    def test_compressed_subscriptions(self):
+        self.server.compressionThreshold = 1024
+
+        db1 = self.createNewDb()
+        db1.subscribeToSchema(schema)
+
+        with db1.transaction():
+            for i in range(1000):
+                StringIndexed(name="a repetitive name %s" % (i % 10))
+
+        db2 = self.createNewDb()
+        db2.subscribeToSchema(schema)
+
+        self.assertTrue(db2._channel.sendCompressedFrames)
+        for connectedChannel in self.server._clientChannels.values():
+            self.assertTrue(connectedChannel.channel.sendCompressedFrames)
+
+        with db2.view():
+            self.assertEqual(len(StringIndexed.lookupAll(name="a repetitive name 3")), 100)
+
+    def test_slow_clients_are_disconnected(self):
+        self.checkSlowClientIsDropped(OVERFLOW_DISCONNECT)
+
+    def test_slow_clients_are_told_to_resubscribe(self):
+        self.checkSlowClientIsDropped(OVERFLOW_DROP)
+
+    def test_outbound_queue_overflows_without_a_paused_transport(self):
+        self.server.maxOutboundBytes = 64 * 1024
+
+        db = self.createNewDb(useSecondaryLoop=True)
+
+        [protocol] = list(self.server._clientChannels)
+
+        # hold the server's event loop, so nothing we queue gets flushed
+        loopHeld = threading.Event()
+        releaseLoop = threading.Event()
+
+        def holdLoop():
+            loopHeld.set()
+            releaseLoop.wait()
+
+        protocol.loop.call_soon_threadsafe(holdLoop)
+        loopHeld.wait()
+
+        try:
+            for _ in range(100):
+                protocol.write(messages.ServerToClient.FlushResponse(guid=os.urandom(1024).hex()))
+
+            self.assertFalse(protocol.writingPaused)
+        finally:
+            releaseLoop.set()
+
+        self.assertTrue(db.disconnected.wait(timeout=10.0))
+        self.assertEqual(self.server.outboundQueueMetrics()['overflowedConnections'], 1)
+
+    def checkSlowClientIsDropped(self, policy):
+        self.server.maxOutboundBytes = 4 * 1024 * 1024
+        self.server.outboundOverflowPolicy = policy
+        self.server.compressionThreshold = None
+
+        db1 = self.createNewDb()
+        db1.subscribeToSchema(schema)
+
+        db2 = self.createNewDb(useSecondaryLoop=True)
+        db2.subscribeToSchema(schema)
+
+        # stop reading on db2's socket, so the server has to queue everything we send it
+        channel = db2._channel
+        channel.loop.call_soon_threadsafe(channel.transport.pause_reading)
+
+        for i in range(64):
+            with db1.transaction():
+                # random, so that value compression can't shrink it
+                StringIndexed(name=os.urandom(512 * 1024).hex())
+
+        self.assertEqual(self.server.outboundQueueMetrics()['overflowedConnections'], 1)
+
+        # once db2 reads again, it finds out it was dropped
+        channel.loop.call_soon_threadsafe(channel.transport.resume_reading)
+        self.assertTrue(db2.disconnected.wait(timeout=10.0))
+
+        # the well-behaved client is unaffected
+        db1.flush()
+        with db1.view():
+            self.assertEqual(len(StringIndexed.lookupAll()), 64)
+
+
+class ObjectDatabaseOverReplicaTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        ObjectDatabaseTests.setUpClass()
+
+    def setUp(self):
+        self.auth_token = genToken()
+
+        sc = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        sc.load_cert_chain('testcert.cert', 'testcert.key')
+
+        self.primary = TcpServer(
+            host="localhost", port=8888, mem_store=InMemoryPersistence(),
+            ssl_context=sc, auth_token=self.auth_token
+        )
+        self.primary.start()
+
+        self.replica = ReplicaServer(
+            host="localhost", port=8889, ssl_context=sc, auth_token=self.auth_token,
+            primaryHost="localhost", primaryPort=8888
+        )
+        self.replica.start()
+
+    def tearDown(self):
+        self.replica.stop()
+        self.primary.stop()
+
+    def createNewDb(self, server):
+        db = server.connect(self.auth_token)
+        db.initialized.wait()
+        return db
+
+    def test_replica_sees_writes_to_the_primary(self):
+        onPrimary = self.createNewDb(self.primary)
+        onPrimary.subscribeToSchema(schema)
+
+        with onPrimary.transaction():
+            c = Counter(k=1, x=1)
+
+        onReplica = self.createNewDb(self.replica)
+        onReplica.subscribeToSchema(schema)
+
+        with onReplica.view():
+            self.assertEqual(c.x, 1)
+            self.assertEqual(Counter.lookupOne(k=1), c)
+
+        with onPrimary.transaction():
+            c.x = 2
+            c2 = Counter(k=2, x=3)
+
+        self.assertTrue(
+            onReplica.waitForCondition(lambda: c.x == 2 and Counter.lookupOne(k=2) == c2, 5.0)
+        )
+
+    def test_delta_encoded_fields_through_the_replica(self):
+        onPrimary = self.createNewDb(self.primary)
+        onPrimary.subscribeToSchema(schema)
+
+        onReplica = self.createNewDb(self.replica)
+        onReplica.subscribeToSchema(schema)
+
+        with onPrimary.transaction():
+            log = EventLog(events=["e%s" % i for i in range(10)])
+
+        self.assertTrue(onReplica.waitForCondition(lambda: log.exists(), 5.0))
+
+        with onPrimary.transaction():
+            log.events = log.events + ["e10"]
+
+        self.assertTrue(onReplica.waitForCondition(lambda: len(log.events) == 11, 5.0))
+
+        with onReplica.transaction():
+            log.events = log.events + ["e11"]
+
+        self.assertTrue(onPrimary.waitForCondition(lambda: len(log.events) == 12, 5.0))
+
+        with onReplica.view():
+            self.assertEqual(list(log.events), ["e%s" % i for i in range(12)])
+
+    def test_commits_through_the_replica(self):
+        onPrimary = self.createNewDb(self.primary)
+        onPrimary.subscribeToSchema(schema)
+
+        onReplica = self.createNewDb(self.replica)
+        onReplica.subscribeToSchema(schema)
+
+        with onReplica.transaction():
+            c = Counter(k=1, x=1)
+
+        self.assertTrue(onPrimary.waitForCondition(lambda: c.exists() and c.x == 1, 5.0))
+
+        # the primary checks the replica's commits for conflicts against everyone's
+        t = onReplica.transaction()
+
+        with onPrimary.transaction():
+            c.x = 2
+
+        with self.assertRaises(RevisionConflictException):
+            with t:
+                c.x = c.x + 10
+
+        onReplica.flush()
+
+        with onReplica.view():
+            self.assertEqual(c.x, 2)
+
+    def test_replica_clients_see_objects_they_create(self):
+        onReplica = self.createNewDb(self.replica)
+        onReplica.subscribeToIndex(Counter, k=1)
+
+        # the new object is outside our index subscription. We see it because we made it.
+        with onReplica.transaction():
+            c = Counter(k=5, x=7)
+
+        onReplica.flush()
+
+        with onReplica.view():
+            self.assertEqual(c.x, 7)
+
+    def test_replica_connections_live_on_the_primary(self):
+        onPrimary = self.createNewDb(self.primary)
+        onPrimary.subscribeToSchema(core_schema)
+
+        onReplica = self.createNewDb(self.replica)
+        conn = onReplica.connectionObject
+
+        self.assertTrue(onPrimary.waitForCondition(lambda: conn.exists(), 5.0))
+
+        onReplica.disconnect()
+
+        self.assertTrue(onPrimary.waitForCondition(lambda: not conn.exists(), 5.0))
@@ -0,0 +1,123 @@
+#   Copyright 2018 Braxton Mckee
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""The stored form of DeltaEncoded fields.
+
+A DeltaEncoded field holds a chain of frames: the whole value as of some commit, followed by
+each change committed to it since. A commit that appends to a long list (or sets a few keys
+of a big dict) sends a frame describing just that change. The server appends the frame to
+the bytes it has stored without looking inside it, and passes it on to subscribers, who do
+the same to the bytes they have. Readers apply the changes when they deserialize the value.
+
+Once a chain has MAX_DELTA_CHAIN_LENGTH changes, the next commit writes the whole value,
+which bounds both the work of reading a value and the garbage it carries.
+"""
+
+from typed_python import serialize, deserialize, TupleOf
+
+import struct
+
+MAX_DELTA_CHAIN_LENGTH = 32
+
+# each frame is an opcode and the length of its payload, followed by the payload
+_frameHeader = struct.Struct(">cI")
+
+# the payload is the whole value
+VALUE = b"v"
+# the payload is a ListOf or TupleOf of elements to append
+APPEND = b"a"
+# the payload is a ConstDict of keys to add or replace
+SET_KEYS = b"s"
+# the payload is a TupleOf the keys to remove
+REMOVE_KEYS = b"r"
+
+
+def isDeltaEncodable(T):
+    return getattr(T, "__typed_python_category__", None) in ("ListOf", "TupleOf", "ConstDict")
+
+
+def _frame(opcode, payload):
+    return _frameHeader.pack(opcode, len(payload)) + payload
+
+
+def _frameOffsets(data):
+    """Yield the (opcode, start, end) of each frame in 'data'."""
+    offset = 0
+
+    while offset < len(data):
+        opcode, size = _frameHeader.unpack_from(data, offset)
+        offset += _frameHeader.size
+
+        yield opcode, offset, offset + size
+
+        offset += size
+
+
+def chainLength(data):
+    """The number of changes stored after the whole value in 'data'."""
+    return sum(1 for _ in _frameOffsets(data)) - 1
+
+
+def encodeValue(T, value, serializationContext=None):
+    """The stored form of 'value', a T, with no changes after it."""
+    return _frame(VALUE, serialize(T, value, serializationContext))
+
+
+def encodeChange(T, old, new, serializationContext=None):
+    """Frames that turn 'old' into 'new', or None if 'new' isn't a small change to 'old',
+    in which case it should be written out in full."""
+    if T.__typed_python_category__ == "ConstDict":
+        removed = [k for k in old if k not in new]
+        changed = {k: v for k, v in new.items() if k not in old or old[k] != v}
+
+        if len(removed) + len(changed) > len(new) // 2:
+            return None
+
+        res = b""
+
+        if removed:
+            res += _frame(REMOVE_KEYS, serialize(TupleOf(T.KeyType), removed, serializationContext))
+        if changed:
+            res += _frame(SET_KEYS, serialize(T, changed, serializationContext))
+
+        return res
+
+    if len(new) < len(old) or new[:len(old)] != old:
+        return None
+
+    appended = new[len(old):]
+
+    if len(appended) > len(new) // 2:
+        return None
+
+    return _frame(APPEND, serialize(T, appended, serializationContext)) if appended else b""
+
+
+def decode(T, data, serializationContext=None):
+    """The T that 'data', a chain of frames, describes."""
+    value = None
+
+    for opcode, start, end in _frameOffsets(data):
+        payload = data[start:end]
+
+        if opcode == VALUE:
+            value = deserialize(T, payload, serializationContext)
+        elif opcode == APPEND or opcode == SET_KEYS:
+            value = value + deserialize(T, payload, serializationContext)
+        elif opcode == REMOVE_KEYS:
+            value = value - deserialize(TupleOf(T.KeyType), payload, serializationContext)
+        else:
+            raise Exception("Unknown frame %s in a DeltaEncoded value" % opcode)
+
+    return value
@@ -15,11 +15,15 @@
 #   limitations under the License.
 
 import argparse
+import logging
+import os
 import sys
 import time
+import traceback
 
-from object_database.persistence import InMemoryPersistence, RedisPersistence
-from object_database.tcp_server import TcpServer
+from object_database.persistence import InMemoryPersistence, RedisPersistence, WriteAheadLogPersistence
+from object_database.tcp_server import TcpServer, OVERFLOW_DISCONNECT, OVERFLOW_DROP
+from object_database.replica_server import ReplicaServer
 from object_database.util import sslContextFromCertPathOrNone
 
 
@@ -34,16 +38,105 @@ def main(argv):
     )
     parser.add_argument("--ssl-path", default=None, required=False, help="path to (self-signed) SSL certificate")
     parser.add_argument("--redis_port", type=int, default=None)
+    parser.add_argument(
+        "--redis-async-writes", default=False, action='store_true',
+        help="tell clients a transaction committed before redis has it. Faster, but a crash "
+        "loses transactions redis hadn't written yet"
+    )
     parser.add_argument("--inmem", default=False, action='store_true')
+    parser.add_argument(
+        "--wal-dir", type=str, default=None,
+        help="keep the database in memory, made durable by a write-ahead log and snapshots in this directory"
+    )
+    parser.add_argument(
+        "--group-commit-window", type=float, default=None,
+        help="commit transactions in batches, waiting up to this many seconds for each batch to fill"
+    )
+    parser.add_argument(
+        "--max-outbound-mb", type=float, default=None,
+        help="how many megabytes of messages we'll queue for a client whose socket is backed up"
+    )
+    parser.add_argument(
+        "--outbound-overflow-policy", choices=[OVERFLOW_DISCONNECT, OVERFLOW_DROP], default=OVERFLOW_DISCONNECT,
+        help="what to do with a client that falls further behind than --max-outbound-mb"
+    )
+    parser.add_argument(
+        "--replica-of", type=str, default=None,
+        help="serve reads as a replica of the server at this host:port, forwarding writes to it"
+    )
+    parser.add_argument(
+        "--primary-token", type=str, default=None,
+        help="the auth token of the primary, if it's not --service-token"
+    )
+    parser.add_argument(
+        "--metrics-path", type=str, default=None,
+        help="periodically write the server's metrics to this file, in the Prometheus text format"
+    )
+    parser.add_argument(
+        "--metrics-interval", type=float, default=10.0,
+        help="how many seconds to wait between writes of --metrics-path"
+    )
 
     parsedArgs = parser.parse_args(argv[1:])
 
+    ssl_ctx = sslContextFromCertPathOrNone(parsedArgs.ssl_path)
+
+    if parsedArgs.replica_of:
+        primaryHost, primaryPort = parsedArgs.replica_of.rsplit(":", 1)
+
+        databaseServer = ReplicaServer(
+            parsedArgs.host,
+            parsedArgs.port,
+            ssl_context=ssl_ctx,
+            auth_token=parsedArgs.service_token,
+            primaryHost=primaryHost,
+            primaryPort=int(primaryPort),
+            primaryAuthToken=parsedArgs.primary_token
+        )
+    else:
+        databaseServer = makeServer(parsedArgs, ssl_ctx)
+
+    databaseServer.outboundOverflowPolicy = parsedArgs.outbound_overflow_policy
+    if parsedArgs.max_outbound_mb is not None:
+        databaseServer.maxOutboundBytes = int(parsedArgs.max_outbound_mb * 1024 * 1024)
+
+    databaseServer.start()
+
+    nextMetricsWrite = time.time()
+
+    try:
+        while True:
+            time.sleep(0.1)
+
+            if parsedArgs.metrics_path and time.time() >= nextMetricsWrite:
+                writeMetrics(databaseServer, parsedArgs.metrics_path)
+                nextMetricsWrite = time.time() + parsedArgs.metrics_interval
+    except KeyboardInterrupt:
+        if isinstance(databaseServer._kvstore, RedisPersistence):
+            databaseServer._kvstore.flush()
+        return
+
+
+def writeMetrics(databaseServer, path):
+    """Replace the file at 'path' with the server's metrics, so that whatever scrapes it
+    (e.g. node_exporter's textfile collector) never sees a partial file."""
+    try:
+        with open(path + ".tmp", "w") as f:
+            f.write(databaseServer.prometheusStats())
+
+        os.replace(path + ".tmp", path)
+    except Exception:
+        logging.error("Failed to write metrics to %s:\n%s", path, traceback.format_exc())
+
+
+def makeServer(parsedArgs, ssl_ctx):
     if parsedArgs.inmem:
         mem_store = InMemoryPersistence()
+    elif parsedArgs.wal_dir:
+        mem_store = WriteAheadLogPersistence(parsedArgs.wal_dir)
     else:
-        mem_store = RedisPersistence(port=parsedArgs.redis_port)
+        mem_store = RedisPersistence(port=parsedArgs.redis_port, asyncWrites=parsedArgs.redis_async_writes)
 
-    ssl_ctx = sslContextFromCertPathOrNone(parsedArgs.ssl_path)
     databaseServer = TcpServer(
         parsedArgs.host,
         parsedArgs.port,
@@ -52,13 +145,9 @@ def main(argv):
         auth_token=parsedArgs.service_token
     )
 
-    databaseServer.start()
+    databaseServer.groupCommitWindow = parsedArgs.group_commit_window
 
-    try:
-        while True:
-            time.sleep(0.1)
-    except KeyboardInterrupt:
-        return
+    return databaseServer
 
 
 if __name__ == '__main__':
@@ -32,6 +32,11 @@ def main(argv):
     )
     parser.add_argument("seconds", type=float)
     parser.add_argument("--threads", dest='threads', type=int, default=1)
+    parser.add_argument(
+        "--pipelined", default=False, action='store_true',
+        help="keep many transactions in flight per thread instead of waiting for each one, "
+        "so we measure what the server can handle rather than the round trip"
+    )
 
     parsedArgs = parser.parse_args(argv[1:])
 
@@ -53,12 +58,27 @@ def main(argv):
         with db.transaction():
             c = Counter()
 
-        while time.time() - t0 < parsedArgs.seconds:
-            with db.transaction():
-                c.k = c.k + 1
+        if parsedArgs.pipelined:
+            confirmations = []
+
+            # transactions in flight can't see each other's writes, so these can't read 'c.k'
+            while time.time() - t0 < parsedArgs.seconds:
+                with db.transaction().consistency(none=True).pipelined() as t:
+                    c.k = len(confirmations)
+
+                confirmations.append(t.confirmation)
+
+            for confirmation in confirmations:
+                confirmation.result()
+
+            transactionCount.append(len(confirmations))
+        else:
+            while time.time() - t0 < parsedArgs.seconds:
+                with db.transaction():
+                    c.k = c.k + 1
 
-        with db.view():
-            transactionCount.append(c.k)
+            with db.view():
+                transactionCount.append(c.k)
 
     threads = [threading.Thread(target=doWork) for _ in range(parsedArgs.threads)]
     for t in threads:
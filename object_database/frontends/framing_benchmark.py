@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+#   Copyright 2018 Braxton Mckee
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Measure how fast AlgebraicProtocol.data_received frames messages out of a single read.
+
+We compare it against the framing loop it replaced, which re-sliced the receive buffer
+after every message, at a range of read sizes.
+"""
+
+import argparse
+import sys
+import time
+import traceback
+
+from object_database.algebraic_protocol import AlgebraicProtocol, longLength, stringToLong
+from typed_python import Alternative, TupleOf, deserialize
+
+
+Message = Alternative(
+    "Message",
+    Data={'payload': str, 'ids': TupleOf(int)}
+)
+
+
+class CountMessages(AlgebraicProtocol):
+    def __init__(self):
+        AlgebraicProtocol.__init__(self, Message, Message)
+        self.received = 0
+
+    def messageReceived(self, msg):
+        self.received += 1
+
+
+class ReslicingCountMessages(CountMessages):
+    """The framing loop AlgebraicProtocol used to have, for a baseline."""
+
+    def data_received(self, data):
+        self.buffer += data
+
+        while len(self.buffer) >= longLength:
+            bytesToRead = stringToLong(self.buffer[:longLength])
+            if bytesToRead + longLength <= len(self.buffer):
+                toConsume = self.buffer[longLength:bytesToRead + longLength]
+
+                self.buffer = self.buffer[bytesToRead + longLength:]
+
+                if toConsume:
+                    try:
+                        self.messageReceived(deserialize(self.receiveType, bytes(toConsume)))
+                    except Exception:
+                        self._logger.error("Error in AlgebraicProtocol: %s", traceback.format_exc())
+                        self.transport.close()
+            else:
+                return
+
+
+def messagesPerSecond(protocolType, frame, count):
+    protocol = protocolType()
+
+    t0 = time.time()
+    protocol.data_received(frame * count)
+    elapsed = time.time() - t0
+
+    assert protocol.received == count
+
+    return count / elapsed
+
+
+def main(argv):
+    parser = argparse.ArgumentParser("Measure AlgebraicProtocol framing throughput")
+
+    parser.add_argument("--payload-bytes", type=int, default=100)
+    parser.add_argument(
+        "--counts", type=int, nargs="+", default=[1000, 10000, 50000],
+        help="how many messages to deliver in a single read"
+    )
+
+    parsedArgs = parser.parse_args(argv[1:])
+
+    frame = AlgebraicProtocol(Message, Message).serializeMessage(
+        Message.Data(payload="x" * parsedArgs.payload_bytes, ids=tuple(range(10)))
+    )
+
+    print("%12s %16s %16s" % ("messages", "reslicing msg/s", "offset msg/s"))
+
+    for count in parsedArgs.counts:
+        print("%12d %16.0f %16.0f" % (
+            count,
+            messagesPerSecond(ReslicingCountMessages, frame, count),
+            messagesPerSecond(CountMessages, frame, count)
+        ))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
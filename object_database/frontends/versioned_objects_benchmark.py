@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+#   Copyright 2018 Braxton Mckee
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Measure how ManyVersionedObjects holds up as writes pile up behind old views.
+
+One view stays open at version 0 and about a hundred more are open at any given time,
+while we write a hot key and a hundred others. Operations per second should stay roughly
+flat as the number of writes grows.
+"""
+
+import argparse
+import sys
+import time
+
+from object_database.database_connection import ManyVersionedObjects
+
+
+def operationsPerSecond(count):
+    objects = ManyVersionedObjects()
+
+    objects.versionIncref(0)
+    objects.setVersionedValue("test:Counter:hot:x", 0, b"0")
+
+    t0 = time.time()
+
+    for tid in range(1, count):
+        objects.setVersionedValue("test:Counter:hot:x", tid, b"x")
+        objects.setVersionedValue("test:Counter:key_%s:x" % (tid % 100), tid, b"x")
+
+        if tid % 10 == 0:
+            objects.versionIncref(tid)
+            if tid > 1000:
+                objects.versionDecref(tid - 1000)
+
+        objects.valueForVersion("test:Counter:hot:x", 0)
+        objects.valueForVersion("test:Counter:hot:x", tid)
+
+        objects.cleanup(tid)
+
+    return count / (time.time() - t0)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser("Measure ManyVersionedObjects throughput behind old views")
+
+    parser.add_argument(
+        "--counts", type=int, nargs="+", default=[2000, 20000, 100000],
+        help="how many transactions to write in each run"
+    )
+
+    parsedArgs = parser.parse_args(argv[1:])
+
+    print("%12s %16s" % ("writes", "ops/s"))
+
+    for count in parsedArgs.counts:
+        print("%12d %16.0f" % (count, operationsPerSecond(count)))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
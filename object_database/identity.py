@@ -1,15 +1,26 @@
+import sys
 import threading
 
 
+def internIdentity(identity):
+    """'identity', interned so that the sets and maps that keep it share one string."""
+    return sys.intern(identity)
+
+
+def internIdentities(identities):
+    return set(map(sys.intern, identities))
+
+
 class IdentityProducer:
     def __init__(self, ix):
         self.ix = ix
         self.count = 0
         self.lock = threading.Lock()
+        self._prefix = str(ix) + "_"
 
     def createIdentity(self):
         with self.lock:
             count = self.count
             self.count += 1
 
-        return str(self.ix) + "_" + str(count)
+        return sys.intern(self._prefix + str(count))
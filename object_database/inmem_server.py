@@ -27,6 +27,9 @@ class InMemoryChannel:
 
         self._stopHeartbeatingSet = False
 
+        # messages the server has sent. They're never serialized, so we can't count bytes.
+        self.messagesWritten = 0
+
         self._logger = logging.getLogger(__name__)
 
     def _stopHeartbeating(self):
@@ -81,16 +84,23 @@ class InMemoryChannel:
         self._clientToServerMsgQueue.put(None)
         self._serverToClientMsgQueue.put(None)
         if block:
-            self._pumpThreadServer.join()
-            self._pumpThreadClient.join()
+            for thread in (self._pumpThreadServer, self._pumpThreadClient):
+                # a pump thread only starts once its handler is set
+                if thread.ident is not None:
+                    thread.join()
 
     def sendMessage(self, msg):
         self.write(msg)
 
+    def peerAcceptsCompressedFrames(self):
+        # messages never leave the process, so there's nothing to compress
+        pass
+
     def write(self, msg):
         if isinstance(msg, ClientToServer):
             self._clientToServerMsgQueue.put(msg)
         elif isinstance(msg, ServerToClient):
+            self.messagesWritten += 1
             self._serverToClientMsgQueue.put(msg)
         else:
             assert False
@@ -132,6 +142,9 @@ class InMemServer(Server):
         dbc.initialized.wait()
         return dbc
 
+    def resume(self, dbc, auth_token):
+        return dbc.resume(self.getChannel(), auth_token)
+
     def checkForDeadConnectionsLoop(self):
         lastCheck = time.time()
         while not self.stopped.is_set():
@@ -151,6 +164,12 @@ class InMemServer(Server):
 
         for c in self.channels:
             c.stop()
+
+        # pump threads drop their connections on the way out, which writes to the kvstore,
+        # so they need to be done before anyone closes it
+        for c in self.channels:
+            c.stop(block=True)
+
         self.checkForDeadConnectionsLoopThread.join()
 
     def __enter__(self):
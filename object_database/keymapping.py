@@ -1,3 +1,5 @@
+import struct
+
 from typed_python import sha_hash
 
 
@@ -22,6 +24,84 @@ def index_value_to_hash(value):
     return sha_hash(value).hexdigest
 
 
+def ordered_index_value_to_hash(value):
+    """Hash a value in an ordered index.
+
+    Hashes of values of the same type sort the way the values do, so the server and clients
+    can find the values of an ordered index in a range by comparing their hashes.
+    """
+    if isinstance(value, int):
+        if not -2 ** 63 <= value < 2 ** 63:
+            raise ValueError("Ordered indices only hold 64 bit integers, not %s" % value)
+        return "ordi_%016x" % (value + 2 ** 63)
+
+    if isinstance(value, float):
+        if value != value:
+            raise ValueError("Ordered indices can't hold NaN")
+        if value == 0.0:
+            # so that -0.0 and 0.0 are the same value
+            value = 0.0
+
+        bits = struct.unpack(">Q", struct.pack(">d", value))[0]
+
+        # flip negative numbers so they sort backwards, and below the positive ones
+        if bits >> 63:
+            bits ^= 0xFFFFFFFFFFFFFFFF
+        else:
+            bits |= 1 << 63
+
+        return "ordf_%016x" % bits
+
+    if isinstance(value, str):
+        return "ords_" + value.encode("utf8").hex()
+
+    raise TypeError("Ordered indices can only hold ints, floats, and strs, not %s" % type(value))
+
+
+def is_ordered_index_hash(valhash):
+    return valhash.startswith("ord")
+
+
+def index_value_hash(obj_type, field_name, value):
+    """Hash 'value' for the index 'field_name' of 'obj_type'."""
+    if obj_type.__schema__.isOrderedIndex(obj_type, field_name):
+        return ordered_index_value_to_hash(obj_type.__schema__._indexTypes[obj_type][field_name](value))
+    return index_value_to_hash(value)
+
+
+def index_range_hashes(obj_type, field_name, low, high):
+    """The hashes bounding the values from 'low' up to (but not including) 'high' in the
+    ordered index 'field_name' of 'obj_type'. Either end may be None, for no bound."""
+    if not obj_type.__schema__.isOrderedIndex(obj_type, field_name):
+        raise Exception(
+            "%s.%s.%s isn't an ordered index" % (obj_type.__schema__.name, obj_type.__qualname__, field_name)
+        )
+
+    return (
+        None if low is None else index_value_hash(obj_type, field_name, low),
+        None if high is None else index_value_hash(obj_type, field_name, high)
+    )
+
+
+def index_range_token(low_hash, high_hash):
+    """The stand-in for a value hash in a subscription to a range of an ordered index."""
+    return "range_" + (low_hash or "") + ".." + (high_hash or "")
+
+
+def parse_index_range_token(valhash):
+    """The (low_hash, high_hash) of a range token, or None if 'valhash' is a normal value hash."""
+    if not valhash.startswith("range_"):
+        return None
+
+    low_hash, high_hash = valhash[len("range_"):].split("..")
+
+    return low_hash or None, high_hash or None
+
+
+def index_hash_in_range(valhash, low_hash, high_hash):
+    return (low_hash is None or valhash >= low_hash) and (high_hash is None or valhash < high_hash)
+
+
 def index_key_from_names(schema_name, typename, field_name, value):
     return schema_name + ":" + typename + ": ix:" + field_name + ":" + index_value_to_hash(value)
 
@@ -60,8 +140,61 @@ def index_group_and_hashval_to_index_key(index_group, hashval):
 
 
 def index_key(obj_type, field_name, value):
-    return index_key_from_names(obj_type.__schema__.name, obj_type.__qualname__, field_name, value)
+    return index_key_from_names_encoded(
+        obj_type.__schema__.name, obj_type.__qualname__, field_name,
+        index_value_hash(obj_type, field_name, value)
+    )
 
 
 def isIndexKey(key):
     return ': ix:' in key
+
+
+def group_data_keys(key_value):
+    """Regroup a map from data keys to values as (schema, typename) -> identity -> field -> value."""
+    res = {}
+
+    for key, value in key_value.items():
+        schema_name, typename, identity, field_name = key.split(":")
+        res.setdefault((schema_name, typename), {}).setdefault(identity, {})[field_name] = value
+
+    return res
+
+
+def ungroup_data_keys(grouped):
+    """The inverse of group_data_keys."""
+    res = {}
+
+    for (schema_name, typename), objects in grouped.items():
+        prefix = schema_name + ":" + typename + ":"
+
+        for identity, fields in objects.items():
+            object_prefix = prefix + identity + ":"
+
+            for field_name, value in fields.items():
+                res[object_prefix + field_name] = value
+
+    return res
+
+
+def group_index_keys(set_ops):
+    """Regroup a map from index keys to identities as
+    (schema, typename) -> (field, value hash) -> identities."""
+    res = {}
+
+    for key, identities in set_ops.items():
+        schema_name, typename, field_name, valhash = split_index_key_full(key)
+        res.setdefault((schema_name, typename), {})[(field_name, valhash)] = identities
+
+    return res
+
+
+def ungroup_index_keys(grouped):
+    """The inverse of group_index_keys."""
+    res = {}
+
+    for (schema_name, typename), indices in grouped.items():
+        for (field_name, valhash), identities in indices.items():
+            res[index_key_from_names_encoded(schema_name, typename, field_name, valhash)] = identities
+
+    return res
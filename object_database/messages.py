@@ -1,5 +1,6 @@
 from typed_python import *
 from object_database.schema import SchemaDefinition
+import object_database.keymapping as keymapping
 
 
 _heartbeatInterval = [5.0]
@@ -13,10 +14,83 @@ def getHeartbeatInterval():
     return _heartbeatInterval[0]
 
 
+# Version 0 of the wire protocol carries serialized values as hex-encoded strings. Version 1
+# carries them as raw bytes. Clients announce the highest version they speak with a
+# 'ProtocolVersion' message right after authenticating, and the server answers with the
+# version it will use for that channel. Servers accept either encoding on every inbound message,
+# so servers must be upgraded before clients.
+#
+# Version 2 peers can read lz4-compressed frames (see algebraic_protocol), so each side may
+# compress large frames once the other has announced version 2.
+#
+# Version 3 servers tell clients which server instance they're talking to with a
+# 'ServerInstance' message, so that a client that loses its connection can 'Resume' on a new
+# one, and catch up from its last transaction instead of resubscribing to everything.
+# 'Resume' only restores whole-type and identity subscriptions. A client must reissue its
+# index subscriptions once a resume succeeds, and a client with 'ProjectFields' projections
+# can't resume at all: it sends an empty 'server_guid' and resubscribes from scratch.
+#
+# Version 4 peers send transactions as 'GroupedTransactionData' and 'GroupedTransaction',
+# whose writes are grouped by (schema, typename) and then by object, and whose index changes
+# are grouped by (schema, typename) and then by (fieldname, value hash). Routing and filtering
+# a transaction then takes a lookup per group rather than a split of every key.
+#
+# Version 5 servers accept 'ProjectFields', which limits the fields of a type that the server
+# sends a channel, for clients that subscribe to types with large fields they never read.
+#
+# Version 6 servers accept subscriptions to ranges of ordered indices, which are index
+# subscriptions whose value hash is a range token from 'keymapping.index_range_token'.
+#
+# Version 7 peers send changes to DeltaEncoded fields as frames to append to the value's
+# stored bytes (see field_deltas): clients in a 'TransactionDeltas' message ahead of their
+# 'CompleteTransaction', and servers in a 'DeltaTransaction', which is a 'GroupedTransaction'
+# with such frames in 'deltas'. Servers send older clients whole values instead.
+#
+# Version 8 servers answer 'GetStats' with a 'Stats' message holding their metrics (see
+# server_metrics), keyed by the names of the samples in the Prometheus text format.
+BINARY_VALUES_PROTOCOL_VERSION = 1
+COMPRESSED_FRAMES_PROTOCOL_VERSION = 2
+RESUMABLE_PROTOCOL_VERSION = 3
+GROUPED_WRITES_PROTOCOL_VERSION = 4
+PROJECTED_FIELDS_PROTOCOL_VERSION = 5
+RANGE_SUBSCRIPTIONS_PROTOCOL_VERSION = 6
+DELTA_WRITES_PROTOCOL_VERSION = 7
+STATS_PROTOCOL_VERSION = 8
+PROTOCOL_VERSION = 8
+
+
+def encodeSerializedValue(value, protocolVersion):
+    """Encode serialized bytes (or None) for transmission at 'protocolVersion'."""
+    if value is None or protocolVersion >= BINARY_VALUES_PROTOCOL_VERSION:
+        return value
+    return value.hex()
+
+
+def decodeSerializedValue(value):
+    """Decode a value received over the wire (hex string, bytes, or None) into bytes or None."""
+    if isinstance(value, str):
+        return bytes.fromhex(value)
+    return value
+
+
+def _hexEncodeValues(values):
+    return {k: v.hex() if isinstance(v, bytes) else v for k, v in values.items()}
+
+
+# (schema, typename) -> identity -> fieldname -> serialized value (or None for a delete)
+GroupedWrites = ConstDict(Tuple(str, str), ConstDict(str, ConstDict(str, OneOf(None, bytes))))
+
+# (schema, typename) -> (fieldname, value hash) -> identities
+GroupedSetOps = ConstDict(Tuple(str, str), ConstDict(Tuple(str, str), TupleOf(str)))
+
+# (schema, typename) -> identity -> fieldname -> frames to append to the stored value
+GroupedDeltas = ConstDict(Tuple(str, str), ConstDict(str, ConstDict(str, bytes)))
+
+
 ClientToServer = Alternative(
     "ClientToServer",
     TransactionData={
-        "writes": ConstDict(str, OneOf(None, str)),
+        "writes": ConstDict(str, OneOf(None, str, bytes)),
         "set_adds": ConstDict(str, TupleOf(str)),
         "set_removes": ConstDict(str, TupleOf(str)),
         "key_versions": TupleOf(str),
@@ -37,7 +111,34 @@ ClientToServer = Alternative(
         'isLazy': bool  # load values when we first request them, instead of blocking on all the data.
     },
     Flush={'guid': str},
-    Authenticate={'token': str}
+    Authenticate={'token': str},
+    ProtocolVersion={'version': int},
+    Resume={
+        'server_guid': str,  # the server instance we were last connected to
+        'transaction_id': int,  # the last transaction we saw
+        'types': TupleOf(Tuple(str, str)),  # (schema, typename) pairs we're fully subscribed to
+        'identities': TupleOf(str)  # objects of other types we're subscribed to
+    },
+    # sent by read replicas (see replica_server) on behalf of their own clients
+    CreateReplicaConnection={'guid': str},
+    DropReplicaConnection={'connIdentity': str},
+    GroupedTransactionData={
+        "writes": GroupedWrites,
+        "set_adds": GroupedSetOps,
+        "set_removes": GroupedSetOps,
+        "key_versions": TupleOf(str),
+        "index_versions": TupleOf(str),
+        "transaction_guid": str
+    },
+    # only send values of these fields of schema.typename. Applies to every subscription
+    # to the type that follows it.
+    ProjectFields={'schema': str, 'typename': str, 'fields': TupleOf(str)},
+    # changes to DeltaEncoded fields in the transaction 'transaction_guid'
+    TransactionDeltas={
+        "deltas": GroupedDeltas,
+        "transaction_guid": str
+    },
+    GetStats={'guid': str}
 )
 
 
@@ -50,12 +151,12 @@ ServerToClient = Alternative(
         'schema': str,
         'typename': OneOf(None, str),
         'fieldname_and_value': OneOf(None, Tuple(str, str)),
-        'values': ConstDict(str, OneOf(None, str)),  # value
+        'values': ConstDict(str, OneOf(None, str, bytes)),  # value
         'index_values': ConstDict(str, OneOf(None, str)),
         'identities': OneOf(None, TupleOf(str)),  # the identities in play if this is an index-level subscription
     },
-    LazyTransactionPriors={ 'writes': ConstDict(str, OneOf(None, str)) },
-    LazyLoadResponse={ 'identity': str, 'values': ConstDict(str, OneOf(None, str)) },
+    LazyTransactionPriors={ 'writes': ConstDict(str, OneOf(None, str, bytes)) },
+    LazyLoadResponse={ 'identity': str, 'values': ConstDict(str, OneOf(None, str, bytes)) },
     LazySubscriptionData={
         'schema': str,
         'typename': OneOf(None, str),
@@ -76,10 +177,130 @@ ServerToClient = Alternative(
         'identities': TupleOf(str)
     },
     Disconnected={},
+    ServerInstance={'guid': str},
+    ReplicaConnection={'guid': str, 'connIdentity': str, 'identity_root': int},
+    ResumeResult={
+        'transaction_id': int,
+        'resumed': bool  # if False, nothing was restored and the client must resubscribe
+    },
     Transaction={
-        "writes": ConstDict(str, OneOf(None, str)),
+        "writes": ConstDict(str, OneOf(None, str, bytes)),
         "set_adds": ConstDict(str, TupleOf(str)),
         "set_removes": ConstDict(str, TupleOf(str)),
         "transaction_id": int
-    }
+    },
+    ProtocolVersion={'version': int},
+    GroupedTransaction={
+        "writes": GroupedWrites,
+        "set_adds": GroupedSetOps,
+        "set_removes": GroupedSetOps,
+        "transaction_id": int
+    },
+    DeltaTransaction={
+        "writes": GroupedWrites,
+        "deltas": GroupedDeltas,
+        "set_adds": GroupedSetOps,
+        "set_removes": GroupedSetOps,
+        "transaction_id": int
+    },
+    Stats={'guid': str, 'samples': ConstDict(str, float)}
 )
+
+
+def legacyServerToClientMessage(msg, protocolVersion=0):
+    """Re-encode 'msg' for a client that speaks 'protocolVersion'.
+
+    Clients before version 4 get grouped transactions as flat ones, and version 0 clients
+    get serialized values as hex strings.
+    """
+    if msg.matches.GroupedTransaction and protocolVersion < GROUPED_WRITES_PROTOCOL_VERSION:
+        msg = ServerToClient.Transaction(
+            writes=keymapping.ungroup_data_keys(msg.writes),
+            set_adds=keymapping.ungroup_index_keys(msg.set_adds),
+            set_removes=keymapping.ungroup_index_keys(msg.set_removes),
+            transaction_id=msg.transaction_id
+        )
+
+    if protocolVersion >= BINARY_VALUES_PROTOCOL_VERSION:
+        return msg
+
+    if msg.matches.Transaction:
+        return ServerToClient.Transaction(
+            writes=_hexEncodeValues(msg.writes),
+            set_adds=msg.set_adds,
+            set_removes=msg.set_removes,
+            transaction_id=msg.transaction_id
+        )
+    if msg.matches.SubscriptionData:
+        return ServerToClient.SubscriptionData(
+            schema=msg.schema,
+            typename=msg.typename,
+            fieldname_and_value=msg.fieldname_and_value,
+            values=_hexEncodeValues(msg.values),
+            index_values=msg.index_values,
+            identities=msg.identities
+        )
+    if msg.matches.LazyTransactionPriors:
+        return ServerToClient.LazyTransactionPriors(writes=_hexEncodeValues(msg.writes))
+    if msg.matches.LazyLoadResponse:
+        return ServerToClient.LazyLoadResponse(
+            identity=msg.identity,
+            values=_hexEncodeValues(msg.values)
+        )
+    return msg
+
+
+def coalesceTransactionMessages(transactions):
+    """Merge a sequence of ServerToClient.GroupedTransaction messages into one.
+
+    Later writes win, and an identity that's added to an index and then removed (or the
+    reverse) only shows up in its final state. The result has the last transaction_id.
+    """
+    if len(transactions) == 1:
+        return transactions[0]
+
+    writes = {}
+    set_adds = {}
+    set_removes = {}
+
+    for msg in transactions:
+        for schemaAndTypename, objects in msg.writes.items():
+            groupWrites = writes.setdefault(tuple(schemaAndTypename), {})
+
+            for identity, fields in objects.items():
+                groupWrites.setdefault(identity, {}).update(fields)
+
+        for schemaAndTypename, indices in msg.set_adds.items():
+            groupAdds = set_adds.setdefault(tuple(schemaAndTypename), {})
+            groupRemoves = set_removes.get(tuple(schemaAndTypename), {})
+
+            for index, identities in indices.items():
+                index = tuple(index)
+                groupAdds.setdefault(index, set()).update(identities)
+                if index in groupRemoves:
+                    groupRemoves[index].difference_update(identities)
+
+        for schemaAndTypename, indices in msg.set_removes.items():
+            groupRemoves = set_removes.setdefault(tuple(schemaAndTypename), {})
+            groupAdds = set_adds.get(tuple(schemaAndTypename), {})
+
+            for index, identities in indices.items():
+                index = tuple(index)
+                groupRemoves.setdefault(index, set()).update(identities)
+                if index in groupAdds:
+                    groupAdds[index].difference_update(identities)
+
+    def nonempty(setOps):
+        res = {}
+        for schemaAndTypename, indices in setOps.items():
+            indices = {index: identities for index, identities in indices.items() if identities}
+            if indices:
+                res[schemaAndTypename] = indices
+        return res
+
+    return ServerToClient.GroupedTransaction(
+        writes=writes,
+        set_adds=nonempty(set_adds),
+        set_removes=nonempty(set_removes),
+        transaction_id=transactions[-1].transaction_id
+    )
@@ -75,6 +75,23 @@ class DatabaseObject(_base):
 
         return _cur_view.view.indexLookup(cls, **kwargs or {" exists": True})
 
+    @classmethod
+    def explainLookup(cls, **kwargs):
+        """Describe how lookupAll(**kwargs) would find its objects."""
+        if not hasattr(_cur_view, "view"):
+            raise Exception("Please lookup in indices from within a transaction.")
+
+        return _cur_view.view.explainLookup(cls, **kwargs or {" exists": True})
+
+    @classmethod
+    def lookupRange(cls, **kwargs):
+        """Lookup the objects whose value of an ordered index is in a range, given as
+        fieldname=(low, high), in order of that value."""
+        if not hasattr(_cur_view, "view"):
+            raise Exception("Please lookup in indices from within a transaction.")
+
+        return _cur_view.view.indexLookupRange(cls, **kwargs)
+
     @classmethod
     def lookupAny(cls, **kwargs):
         if not hasattr(_cur_view, "view"):
@@ -138,6 +155,20 @@ class DatabaseObject(_base):
 
 
 class Indexed:
+    """Marks a field as indexed. Ordered indices also support lookups and subscriptions
+    to ranges of values, but only hold ints, floats, and strs."""
+
+    def __init__(self, obj, ordered=False):
+        assert isinstance(obj, type)
+        self.obj = obj
+        self.ordered = ordered
+
+
+class DeltaEncoded:
+    """Marks a ListOf, TupleOf, or ConstDict field whose commits send just what changed
+    (appended elements, or added, replaced and removed keys) when that's a small part of
+    the value, rather than the whole thing. See field_deltas for how it's stored."""
+
     def __init__(self, obj):
         assert isinstance(obj, type)
         self.obj = obj
@@ -12,13 +12,23 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+from typed_python import NamedTuple, ConstDict, OneOf, Tuple, TupleOf, serialize, deserialize
+from object_database.identity import internIdentity, internIdentities
+
+import mmap
+import os
 import redis
+import struct
 import time
 import threading
 import logging
+import traceback
+import zlib
 
 
 class InMemoryPersistence(object):
+    """A kv store holding serialized values as bytes and sets of strings in local memory."""
+
     def __init__(self, db=0):
         self.values = {}
         self.lock = threading.RLock()
@@ -30,12 +40,12 @@ class InMemoryPersistence(object):
 
             val = self.values.get(key)
 
-            assert isinstance(val, str), key
+            assert isinstance(val, bytes), key
 
             return val
 
     def set(self, key, value):
-        assert isinstance(value, str) or value is None, (key, value)
+        assert isinstance(value, bytes) or value is None, (key, value)
 
         with self.lock:
             if value is None:
@@ -52,7 +62,7 @@ class InMemoryPersistence(object):
             if key not in self.values:
                 self.values[key] = set()
             for value in values:
-                self.values[key].add(value)
+                self.values[key].add(internIdentity(value))
 
     def _setRemove(self, key, values):
         if not values:
@@ -68,7 +78,8 @@ class InMemoryPersistence(object):
                 del self.values[key]
 
     def storedStringCount(self):
-        return len([x for x in self.values.values() if isinstance(x, str)])
+        """The number of value-style (non-set) keys we're holding."""
+        return len([x for x in self.values.values() if isinstance(x, bytes)])
 
     def getSetMembers(self, key):
         with self.lock:
@@ -93,9 +104,9 @@ class InMemoryPersistence(object):
 
         with self.lock:
             for k in (adds or []):
-                assert not isinstance(self.values.get(k, None), str), k + " is already a string"
+                assert not isinstance(self.values.get(k, None), bytes), k + " is already a value"
             for k in (removes or []):
-                assert not isinstance(self.values.get(k, None), str), k + " is already a string"
+                assert not isinstance(self.values.get(k, None), bytes), k + " is already a value"
 
             for k, v in kvs.items():
                 self.set(k, v)
@@ -125,45 +136,215 @@ class InMemoryPersistence(object):
 
 
 class RedisPersistence(object):
-    def __init__(self, db=0, port=None):
-        self.lock = threading.RLock()
+    """A kv store backed by redis. Values are bytes, and set members are strings.
+
+    We cache everything we read or write, so we only ask redis about a key once. Writes
+    update the cache and go to redis on a background thread, which sends everything
+    written since its last round trip in a single MULTI/EXEC pipeline. 'setSeveral' waits
+    for its write to land, so concurrent writers share round trips.
+
+    With asyncWrites=True, 'setSeveral' returns as soon as its write is queued, and a server
+    can broadcast a transaction, and commit the next one, while redis is still writing it.
+    Transactions acknowledged that way are lost if the process dies before they land.
+    'flush' waits for queued writes to land.
+
+    If redis rejects a write, we stop: every write after it, and every 'flush', raises.
+
+    Reads that miss the cache go to redis over a pool of connections without holding our
+    lock, so they don't wait on each other or on writes.
+
+    Databases written before values were stored as raw bytes held hex-encoded strings.
+    We convert those in place the first time we open them. Each key is converted and
+    recorded as converted in one script, so an upgrade that dies part way through can
+    simply be run again.
+    """
+
+    STORAGE_FORMAT_KEY = " storageFormat"
+    BINARY_STORAGE_FORMAT = b"binary"
+
+    # the keys an unfinished upgrade has already converted
+    CONVERTED_KEYS_KEY = " storageFormatConverted"
+
+    # KEYS[1] is the key to convert, KEYS[2] the set of converted keys
+    CONVERT_HEX_VALUE_SCRIPT = """
+        if redis.call('sismember', KEYS[2], KEYS[1]) == 1 then
+            return 0
+        end
+        local value = redis.call('get', KEYS[1]):gsub('..', function(pair)
+            return string.char(tonumber(pair, 16))
+        end)
+        redis.call('set', KEYS[1], value)
+        redis.call('sadd', KEYS[2], KEYS[1])
+        return 1
+        """
+
+    def __init__(self, db=0, port=None, asyncWrites=False, maxConnections=16, maxQueuedWrites=1000):
         kwds = {}
 
         if port is not None:
             kwds['port'] = port
 
-        self.redis = redis.StrictRedis(db=db, decode_responses=True, **kwds)
+        self.pool = redis.BlockingConnectionPool(
+            db=db, max_connections=maxConnections, timeout=None, decode_responses=False, **kwds
+        )
+        self.redis = redis.StrictRedis(connection_pool=self.pool)
+
+        # guards everything below. We never talk to redis holding it.
+        self.lock = threading.RLock()
+
+        # held by a writer from when it reads the sets it changes until it has queued its
+        # write, so that each writer sees the changes of the ones before it.
+        self._writeLock = threading.Lock()
+
+        # key -> bytes, or a nonempty set of strings, as of the last write we queued
         self.cache = {}
 
+        # key -> how many queued writes delete it. These read as empty, whatever redis holds.
+        self._pendingDeletes = {}
+
+        # how many reads are waiting on redis, and the keys written since one of them started.
+        # Those reads may have seen an older value, so they mustn't cache it.
+        self._readsInFlight = 0
+        self._writtenDuringReads = set()
+
+        self.asyncWrites = asyncWrites
+        self.maxQueuedWrites = maxQueuedWrites
+
+        # (kvs, setAdds, setRemoves, deletedKeys) for each write redis doesn't have yet, oldest first
+        self._writeQueue = []
+        self._writesQueued = 0
+        self._writesFlushed = 0
+        self._writesChanged = threading.Condition(self.lock)
+        self._closed = False
+
+        # the exception that stopped our writer thread, if redis rejected a write
+        self._writeFailure = None
+
         self._logger = logging.getLogger(__name__)
 
-    def get(self, key):
-        """Get the value stored in a value-style key, or None if no key exists.
+        self._upgradeHexEncodedValues()
 
-        Throws an exception if the value is a set.
+        self._writerThread = threading.Thread(target=self._serviceWrites)
+        self._writerThread.daemon = True
+        self._writerThread.start()
+
+    def _call(self, f):
+        """Call 'f', waiting for redis if it's still loading its data."""
+        while True:
+            try:
+                return f()
+            except redis.exceptions.BusyLoadingError:
+                self._logger.info("Redis is still loading. Waiting...")
+                time.sleep(1.0)
+
+    def _upgradeHexEncodedValues(self):
+        """Convert a database holding hex-encoded values to raw bytes, if necessary."""
+        storageFormat = self._call(lambda: self.redis.get(self.STORAGE_FORMAT_KEY))
+
+        if storageFormat == self.BINARY_STORAGE_FORMAT:
+            return
+
+        convertHexValue = self.redis.register_script(self.CONVERT_HEX_VALUE_SCRIPT)
+
+        converted = 0
+        for key in self.redis.scan_iter(count=1000):
+            # reverse index keys hold index hash values, which are plain strings already
+            if self.redis.type(key) != b"string" or b" ixval:" in key:
+                continue
+
+            converted += convertHexValue(keys=[key, self.CONVERTED_KEYS_KEY])
+
+        if converted:
+            self._logger.info("Converted %s hex-encoded values to bytes.", converted)
+
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.set(self.STORAGE_FORMAT_KEY, self.BINARY_STORAGE_FORMAT)
+        pipe.delete(self.CONVERTED_KEYS_KEY)
+        pipe.execute()
+
+    def _lookup(self, key):
+        """(True, value) if we know what 'key' holds without asking redis, else (False, None).
+
+        Must be called holding self.lock.
         """
+        if key in self.cache:
+            return True, self.cache[key]
+        if key in self._pendingDeletes:
+            return True, None
+        return False, None
+
+    def _readThrough(self, keys, fetch):
+        """Map each of 'keys' to what it holds, or None if it's empty, reading the ones we
+        don't know from redis in one round trip with 'fetch'."""
+        res = {}
+
+        with self.lock:
+            needed = []
+
+            for key in keys:
+                known, value = self._lookup(key)
+                if known:
+                    res[key] = value
+                else:
+                    needed.append(key)
+
+            if not needed:
+                return res
+
+            self._readsInFlight += 1
+
+        try:
+            values = self._call(lambda: fetch(needed))
+        except Exception:
+            with self.lock:
+                self._finishRead()
+            raise
+
         with self.lock:
-            if key in self.cache:
-                assert not isinstance(self.cache[key], set), "item is a set, not a string"
-                return self.cache[key]
+            for key, value in zip(needed, values):
+                known, current = self._lookup(key)
+
+                if known:
+                    res[key] = current
+                elif key in self._writtenDuringReads:
+                    # the key was deleted while we read it, and redis has caught up
+                    res[key] = None
+                else:
+                    if value is not None:
+                        self.cache[key] = value
+                    res[key] = value
+
+            self._finishRead()
+
+        return res
+
+    def _finishRead(self):
+        self._readsInFlight -= 1
+
+        if not self._readsInFlight:
+            self._writtenDuringReads = set()
+
+    def _mget(self, keys):
+        return self.redis.mget(keys)
+
+    def _smembers(self, keys):
+        pipe = self.redis.pipeline(transaction=False)
+
+        for key in keys:
+            pipe.smembers(key)
 
-            success = False
-            while not success:
-                try:
-                    result = self.redis.get(key)
-                    success = True
-                except redis.exceptions.BusyLoadingError:
-                    self._logger.info("Redis is still loading. Waiting...")
-                    time.sleep(1.0)
+        return [set(k.decode("utf8") for k in members) or None for members in pipe.execute()]
 
-            if result is None:
-                return result
+    def get(self, key):
+        """Get the value stored in a value-style key, or None if no key exists.
 
-            assert isinstance(result, str)
+        Throws an exception if the value is a set.
+        """
+        result = self._readThrough([key], self._mget)[key]
 
-            self.cache[key] = result
+        assert not isinstance(result, set), "item is a set, not a string"
 
-            return result
+        return result
 
     def getSeveralAsDictionary(self, keys):
         keys = list(keys)
@@ -171,122 +352,756 @@ class RedisPersistence(object):
 
     def getSeveral(self, keys):
         """Get the values (or None) stored in several value-style keys."""
+        keys = list(keys)
+        values = self._readThrough(keys, self._mget)
 
-        with self.lock:
-            needed_keys = [k for k in keys if k not in self.cache]
-
-            if needed_keys:
-                success = False
-                while not success:
-                    try:
-                        vals = self.redis.mget(needed_keys)
-                        success = True
-                    except redis.exceptions.BusyLoadingError:
-                        self._logger.info("Redis is still loading. Waiting...")
-                        time.sleep(1.0)
+        return [values[k] for k in keys]
 
-                for ix in range(len(needed_keys)):
-                    if vals[ix] is not None:
-                        self.cache[needed_keys[ix]] = vals[ix]
+    def getSetMembers(self, key):
+        result = self._readThrough([key], self._smembers)[key]
 
-            return [self.cache.get(k, None) for k in keys]
+        assert not isinstance(result, bytes), "item is a string, not a set"
 
-    def getSetMembers(self, key):
-        with self.lock:
-            if key in self.cache:
-                assert isinstance(self.cache[key], set), "item is a string, not a set"
-                return self.cache[key]
-
-            success = False
-            while not success:
-                try:
-                    vals = self.redis.smembers(key)
-                    success = True
-                except redis.exceptions.BusyLoadingError:
-                    self._logger.info("Redis is still loading. Waiting...")
-                    time.sleep(1.0)
-
-            if vals:
-                self.cache[key] = set([k for k in vals])
-                return self.cache[key]
-            else:
-                return set()
+        return result if result is not None else set()
 
     def setSeveral(self, kvs, setAdds=None, setRemoves=None):
-        new_sets, dropped_sets = set(), set()
-        with self.lock:
-            pipe = self.redis.pipeline()
+        setAdds = {k: v for k, v in (setAdds or {}).items() if v}
+        setRemoves = {k: v for k, v in (setRemoves or {}).items() if v}
 
-            for key, value in kvs.items():
-                if value is None:
-                    pipe.delete(key)
-                else:
-                    pipe.set(key, value)
-
-            for key, to_add in (setAdds or {}).items():
-                if key not in self.cache:
-                    self.getSetMembers(key)
+        with self._writeLock:
+            self._checkWritable()
 
-                for to_add_val in to_add:
-                    pipe.sadd(key, to_add_val)
+            # we need the current members of every set we change. Nobody else can write
+            # them until we release self._writeLock, so what we read stays current.
+            members = self._readThrough(set(setAdds) | set(setRemoves), self._smembers)
 
-            for key, to_remove in (setRemoves or {}).items():
-                if key not in self.cache:
-                    self.getSetMembers(key)
+            with self.lock:
+                new_sets, dropped_sets = set(), set()
+                deletedKeys = []
 
-                for to_remove_val in to_remove:
-                    pipe.srem(key, to_remove_val)
+                for key, value in kvs.items():
+                    assert isinstance(value, bytes) or value is None, (key, value)
+                    assert not isinstance(self.cache.get(key), set), key + " is a set"
 
-            pipe.execute()
+                    if value is None:
+                        self.cache.pop(key, None)
+                        deletedKeys.append(key)
+                    else:
+                        self.cache[key] = value
 
-            # update our cache _after_ executing the pipe
-            for key, value in kvs.items():
-                if value is None:
-                    if key in self.cache:
-                        del self.cache[key]
-                else:
-                    self.cache[key] = value
+                for key, to_add in setAdds.items():
+                    assert not isinstance(members[key], bytes), key + " is already a value"
 
-            for key, to_add in (setAdds or {}).items():
-                if to_add:
-                    if key not in self.cache or not self.cache[key]:
+                    if members[key] is None:
                         self.cache[key] = set()
                         new_sets.add(key)
 
-                    for val in to_add:
-                        self.cache[key].add(val)
+                    self.cache[key].update(to_add)
 
-            for key, to_remove in (setRemoves or {}).items():
-                if to_remove:
-                    assert self.cache.get(key)
+                for key, to_remove in setRemoves.items():
+                    s = self.cache.get(key)
 
-                    for val in to_remove:
-                        self.cache[key].discard(val)
+                    assert isinstance(s, set), (key, to_remove)
 
-                    if not self.cache[key]:
-                        dropped_sets.add(key)
+                    s.difference_update(to_remove)
+
+                    if not s:
                         del self.cache[key]
+                        deletedKeys.append(key)
+                        dropped_sets.add(key)
+
+                for key in deletedKeys:
+                    self._pendingDeletes[key] = self._pendingDeletes.get(key, 0) + 1
+
+                if self._readsInFlight:
+                    self._writtenDuringReads.update(kvs)
+                    self._writtenDuringReads.update(setAdds)
+                    self._writtenDuringReads.update(setRemoves)
+
+                while len(self._writeQueue) >= self.maxQueuedWrites:
+                    self._writesChanged.wait()
+                    self._checkWritable()
+
+                self._writeQueue.append((kvs, setAdds, setRemoves, deletedKeys))
+                self._writesQueued += 1
+                writeNumber = self._writesQueued
+                self._writesChanged.notify_all()
+
+        if not self.asyncWrites:
+            self._waitForWrites(writeNumber)
 
         return new_sets, dropped_sets
 
+    def _serviceWrites(self):
+        while True:
+            with self.lock:
+                while not self._writeQueue and not self._closed:
+                    self._writesChanged.wait()
+
+                if not self._writeQueue:
+                    return
+
+                batch = list(self._writeQueue)
+
+            try:
+                self._writeBatch(batch)
+            except Exception as e:
+                self._logger.error("Failed to write to redis:\n%s", traceback.format_exc())
+
+                # the cache now holds values redis doesn't, so we can't take any more writes
+                with self.lock:
+                    self._writeFailure = e
+                    self._writesChanged.notify_all()
+                return
+
+            with self.lock:
+                del self._writeQueue[:len(batch)]
+                self._writesFlushed += len(batch)
+
+                for _, _, _, deletedKeys in batch:
+                    for key in deletedKeys:
+                        self._pendingDeletes[key] -= 1
+                        if not self._pendingDeletes[key]:
+                            del self._pendingDeletes[key]
+
+                self._writesChanged.notify_all()
+
+    def _writeBatch(self, batch):
+        """Send queued writes to redis in one MULTI/EXEC.
+
+        We retry while redis is loading or unreachable. Replaying a write redis already
+        has leaves it unchanged, so it's safe to retry a pipeline that failed partway
+        through. Any other error propagates.
+        """
+        while True:
+            pipe = self.redis.pipeline(transaction=True)
+
+            for kvs, setAdds, setRemoves, _ in batch:
+                for key, value in kvs.items():
+                    if value is None:
+                        pipe.delete(key)
+                    else:
+                        pipe.set(key, value)
+
+                for key, to_add in setAdds.items():
+                    pipe.sadd(key, *to_add)
+
+                for key, to_remove in setRemoves.items():
+                    pipe.srem(key, *to_remove)
+
+            try:
+                pipe.execute()
+                return
+            except redis.exceptions.BusyLoadingError:
+                self._logger.info("Redis is still loading. Waiting...")
+                time.sleep(1.0)
+            except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+                self._logger.warning("Lost our connection to redis while writing. Retrying...")
+                time.sleep(1.0)
+
+    def _checkWritable(self):
+        if self._writeFailure is not None:
+            raise Exception(
+                "RedisPersistence stopped after redis rejected a write"
+            ) from self._writeFailure
+
+    def _waitForWrites(self, writeNumber):
+        with self.lock:
+            while self._writesFlushed < writeNumber:
+                self._checkWritable()
+                self._writesChanged.wait()
+
+    def flush(self):
+        """Wait for every write we've queued so far to land in redis."""
+        with self.lock:
+            writeNumber = self._writesQueued
+
+        self._waitForWrites(writeNumber)
+
+    def close(self):
+        """Write out everything we've queued and stop our writer thread."""
+        with self.lock:
+            self._closed = True
+            self._writesChanged.notify_all()
+
+        self._writerThread.join()
+        self.pool.disconnect()
+
     def set(self, key, value):
+        self.setSeveral({key: value})
+
+    def exists(self, key):
+        with self.lock:
+            known, value = self._lookup(key)
+
+        if known:
+            return value is not None
+
+        return bool(self._call(lambda: self.redis.exists(key)))
+
+    def delete(self, key):
+        self.setSeveral({key: None})
+
+
+WriteAheadLogRecord = NamedTuple(
+    values=ConstDict(str, OneOf(None, bytes)),
+    set_adds=ConstDict(str, TupleOf(str)),
+    set_removes=ConstDict(str, TupleOf(str))
+)
+
+SnapshotIndex = NamedTuple(
+    # key -> (offset, length) of its value in the snapshot's data region
+    values=ConstDict(str, Tuple(int, int)),
+    sets=ConstDict(str, TupleOf(str))
+)
+
+
+class MappedSnapshot(object):
+    """A read-only snapshot of a kv store, mapped into memory.
+
+    The file is a data region holding every value back to back, then a serialized
+    SnapshotIndex, then a fixed-size trailer saying where the index is. Opening a
+    snapshot maps the file and deserializes only the index, so it takes time
+    proportional to the number of keys rather than to the size of the data.
+
+    This isn't zero-copy: each lookup copies its value out of the mapping into a new bytes
+    object, because callers keep values past our lifetime and put them in messages that
+    need bytes. What the mapping saves is reading the whole file in at startup.
+    """
+
+    MAGIC = b"odbsnap1"
+    _TRAILER = struct.Struct("<8sQQI")
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, "rb") as f:
+            self._mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._mapping) < self._TRAILER.size:
+            raise Exception("Snapshot %s is truncated" % path)
+
+        magic, indexOffset, indexLength, indexCrc = self._TRAILER.unpack_from(
+            self._mapping, len(self._mapping) - self._TRAILER.size
+        )
+
+        if magic != self.MAGIC:
+            raise Exception("%s is not a snapshot" % path)
+
+        indexBytes = self._mapping[indexOffset:indexOffset + indexLength]
+
+        if zlib.crc32(indexBytes) != indexCrc:
+            raise Exception("Snapshot %s has a corrupt index" % path)
+
+        index = deserialize(SnapshotIndex, indexBytes)
+
+        self._values = index.values
+        self._sets = index.sets
+
+    @classmethod
+    def write(cls, path, items):
+        """Write the (key, bytes-or-set) pairs in 'items' to 'path' as a snapshot."""
+        values = {}
+        sets = {}
+        offset = 0
+
+        with open(path, "wb") as f:
+            for key, value in items:
+                if isinstance(value, bytes):
+                    f.write(value)
+                    values[key] = (offset, len(value))
+                    offset += len(value)
+                else:
+                    sets[key] = value
+
+            indexBytes = serialize(SnapshotIndex, SnapshotIndex(values=values, sets=sets))
+
+            f.write(indexBytes)
+            f.write(cls._TRAILER.pack(cls.MAGIC, offset, len(indexBytes), zlib.crc32(indexBytes)))
+
+            f.flush()
+            os.fsync(f.fileno())
+
+    def lookup(self, key):
+        """The bytes or set stored at 'key', or None. Values are fresh copies."""
+        if key in self._values:
+            offset, length = self._values[key]
+            return self._mapping[offset:offset + length]
+
+        if key in self._sets:
+            return set(self._sets[key])
+
+        return None
+
+    def valueKeys(self):
+        return iter(self._values)
+
+    def items(self):
+        for key in self._values:
+            yield key, self.lookup(key)
+
+        for key in self._sets:
+            yield key, set(self._sets[key])
+
+    def close(self):
+        self._mapping.close()
+
+
+class WriteAheadLogPersistence(object):
+    """A kv store made durable by files in a directory.
+
+    Every write goes to an append-only log, and is on disk before 'setSeveral' returns.
+    Writers that arrive while we're syncing share the next fsync. Once the log grows past
+    'snapshotThreshold' bytes we start a new log and write a compacted snapshot on a
+    background thread, after which the older files are deleted.
+
+    What we hold is the newest snapshot, mapped read-only, underneath a stack of
+    in-memory overlays holding everything written since. Writes go to the top overlay.
+    Starting a snapshot freezes the overlays below a fresh one so the background thread
+    can merge them into the new snapshot without holding our lock.
+
+    On startup we map the newest complete snapshot and replay the logs after it into an
+    overlay. Log records are framed with their length and crc32, so a write torn by a
+    crash at the end of a log is found and discarded.
+    """
+
+    LOG_PREFIX = "log."
+    SNAPSHOT_PREFIX = "snapshot."
+
+    _HEADER = struct.Struct("<II")
+
+    def __init__(self, path, snapshotThreshold=64 * 1024 * 1024, fsync=True):
+        self.lock = threading.RLock()
+        self.path = path
+        self.snapshotThreshold = snapshotThreshold
+        self.fsync = fsync
+
+        # newest first. each maps keys to bytes, sets, or None if the key was deleted.
+        self._overlays = [{}]
+        self._snapshot = None
+
+        self._logger = logging.getLogger(__name__)
+
+        # held while we sync or replace the log file. Always acquired before self.lock.
+        self._syncLock = threading.Lock()
+
+        self._snapshotThread = None
+        self._closed = False
+
+        os.makedirs(path, exist_ok=True)
+
+        self._logSegment = self._recover()
+        self._logFile = open(self._filePath(self.LOG_PREFIX, self._logSegment), "ab")
+        self._logPosition = 0
+
+        # (segment, position) up to which the log is known to be on disk
+        self._syncedThrough = (self._logSegment, 0)
+
+    def _filePath(self, prefix, segment):
+        return os.path.join(self.path, "%s%012d" % (prefix, segment))
+
+    def _listFiles(self):
+        snapshots = []
+        logs = []
+
+        for name in os.listdir(self.path):
+            if name.endswith(".tmp"):
+                # a snapshot we didn't finish writing
+                os.remove(os.path.join(self.path, name))
+            elif name.startswith(self.SNAPSHOT_PREFIX):
+                snapshots.append(int(name[len(self.SNAPSHOT_PREFIX):]))
+            elif name.startswith(self.LOG_PREFIX):
+                logs.append(int(name[len(self.LOG_PREFIX):]))
+
+        return sorted(snapshots), sorted(logs)
+
+    def _recover(self):
+        """Load our state from disk, returning the number of the log segment to write next.
+
+        Snapshot N holds everything written to the logs before log N.
+        """
+        t0 = time.time()
+
+        snapshots, logs = self._listFiles()
+
+        firstSegment = snapshots[-1] if snapshots else 0
+        recordCount = 0
+
+        if snapshots:
+            self._snapshot = MappedSnapshot(self._filePath(self.SNAPSHOT_PREFIX, firstSegment))
+
+        for segment in logs:
+            if segment >= firstSegment:
+                recordCount += self._replay(self._filePath(self.LOG_PREFIX, segment))
+
+        if snapshots or logs:
+            self._logger.info(
+                "Recovered %s with %s log records in %.2f seconds.",
+                self.path, recordCount, time.time() - t0
+            )
+
+        return max([firstSegment] + logs) + 1
+
+    def _replay(self, path):
+        with open(path, "rb") as f:
+            data = f.read()
+
+        offset = 0
+        recordCount = 0
+
+        while offset + self._HEADER.size <= len(data):
+            length, crc = self._HEADER.unpack_from(data, offset)
+
+            payload = data[offset + self._HEADER.size:offset + self._HEADER.size + length]
+
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+
+            record = deserialize(WriteAheadLogRecord, payload)
+
+            self._applyWrites(
+                {k: record.values[k] for k in record.values},
+                {k: set(record.set_adds[k]) for k in record.set_adds},
+                {k: set(record.set_removes[k]) for k in record.set_removes}
+            )
+
+            offset += self._HEADER.size + length
+            recordCount += 1
+
+        if offset < len(data):
+            self._logger.warning(
+                "Discarding %s bytes of incomplete writes at the end of %s",
+                len(data) - offset, path
+            )
+
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+
+        return recordCount
+
+    @classmethod
+    def _frame(cls, record):
+        payload = serialize(WriteAheadLogRecord, record)
+
+        return cls._HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+    def _lookup(self, key, overlays=None, snapshot=None):
+        """The bytes or set stored at 'key', or None."""
+        if overlays is None:
+            overlays = self._overlays
+            snapshot = self._snapshot
+
+        for overlay in overlays:
+            if key in overlay:
+                return overlay[key]
+
+        if snapshot is not None:
+            return snapshot.lookup(key)
+
+        return None
+
+    def _items(self, overlays, snapshot):
+        """Every (key, bytes-or-set) pair held by 'overlays' on top of 'snapshot'."""
+        seen = set()
+
+        for overlay in overlays:
+            for key, value in overlay.items():
+                if key not in seen:
+                    seen.add(key)
+                    if value is not None:
+                        yield key, value
+
+        if snapshot is not None:
+            for key, value in snapshot.items():
+                if key not in seen:
+                    yield key, value
+
+    @property
+    def values(self):
+        """A copy of everything we hold, as a dict."""
+        with self.lock:
+            return dict(self._items(self._overlays, self._snapshot))
+
+    def get(self, key):
+        with self.lock:
+            value = self._lookup(key)
+
+            assert not isinstance(value, set), key
+
+            return value
+
+    def getSeveral(self, keys):
+        with self.lock:
+            return [self.get(k) for k in keys]
+
+    def getSeveralAsDictionary(self, keys):
+        keys = list(keys)
+        return {keys[i]: value for i, value in enumerate(self.getSeveral(keys))}
+
+    def getSetMembers(self, key):
         with self.lock:
+            value = self._lookup(key)
+
             if value is None:
-                self.redis.delete(key)
-                if key in self.cache:
-                    del self.cache[key]
-            else:
-                self.redis.set(key, value)
-                self.cache[key] = value
+                return set()
+
+            assert isinstance(value, set), key
+
+            return value
 
     def exists(self, key):
         with self.lock:
-            if key in self.cache:
-                return True
-            return self.redis.exists(key)
+            return self._lookup(key) is not None
+
+    def storedStringCount(self):
+        """The number of value-style (non-set) keys we're holding."""
+        with self.lock:
+            count = 0
+            seen = set()
+
+            for overlay in self._overlays:
+                for key, value in overlay.items():
+                    if key not in seen:
+                        seen.add(key)
+                        if isinstance(value, bytes):
+                            count += 1
+
+            if self._snapshot is not None:
+                for key in self._snapshot.valueKeys():
+                    if key not in seen:
+                        count += 1
+
+            return count
+
+    def set(self, key, value):
+        self.setSeveral({key: value})
 
     def delete(self, key):
+        self.setSeveral({key: None})
+
+    def setSeveral(self, kvs, setAdds=None, setRemoves=None):
+        setAdds = {k: v for k, v in (setAdds or {}).items() if v}
+        setRemoves = {k: v for k, v in (setRemoves or {}).items() if v}
+
+        frame = self._frame(
+            WriteAheadLogRecord(values=kvs, set_adds=setAdds, set_removes=setRemoves)
+        )
+
         with self.lock:
-            if key in self.cache:
-                del self.cache[key]
-            self.redis.delete(key)
+            if self._closed:
+                raise Exception("WriteAheadLogPersistence at %s is closed" % self.path)
+
+            # a record we can't apply would fail again every time we replayed the log
+            self._checkWrites(kvs, setAdds, setRemoves)
+
+            self._logFile.write(frame)
+            self._logPosition += len(frame)
+            position = (self._logSegment, self._logPosition)
+
+            result = self._applyWrites(kvs, setAdds, setRemoves)
+
+        self._syncThrough(position)
+
+        if position[1] > self.snapshotThreshold:
+            self._startBackgroundSnapshot()
+
+        return result
+
+    def _mutableSet(self, key):
+        """The set stored at 'key' in our top overlay, copying it up from below if
+        necessary, or None if there isn't one."""
+        top = self._overlays[0]
+
+        if key not in top:
+            value = self._lookup(key, self._overlays[1:], self._snapshot)
+
+            if value is None:
+                return None
+
+            assert isinstance(value, set), key + " is already a value"
+
+            top[key] = set(value)
+
+        return top[key]
+
+    def _checkWrites(self, kvs, setAdds, setRemoves):
+        """Raise if '_applyWrites' would fail to apply a write, without changing anything.
+
+        Must be called holding self.lock.
+        """
+        def current(k):
+            return kvs[k] if k in kvs else self._lookup(k)
+
+        for k, v in kvs.items():
+            assert isinstance(v, bytes) or v is None, (k, v)
+
+        for k in setAdds:
+            assert not isinstance(current(k), bytes), k + " is already a value"
+
+        for k, to_remove in setRemoves.items():
+            s = current(k)
+
+            assert not isinstance(s, bytes), k + " is already a value"
+
+            members = set(s or ()) | set(setAdds.get(k, ()))
+
+            for value in to_remove:
+                assert value in members, (k, value)
+
+    def _applyWrites(self, kvs, setAdds, setRemoves):
+        """Apply a write to our top overlay and return the sets it created and emptied,
+        like InMemoryPersistence.setSeveral.
+
+        Must be called holding self.lock.
+        """
+        new_sets, dropped_sets = set(), set()
+
+        top = self._overlays[0]
+
+        for k, v in kvs.items():
+            assert isinstance(v, bytes) or v is None, (k, v)
+            top[k] = v
+
+        for k, to_add in setAdds.items():
+            s = self._mutableSet(k)
+
+            if s is None:
+                new_sets.add(k)
+                s = top[k] = set()
+
+            s.update(internIdentities(to_add))
+
+        for k, to_remove in setRemoves.items():
+            s = self._mutableSet(k)
+
+            assert s is not None, k
+
+            for value in to_remove:
+                assert value in s, (k, value, s)
+                s.remove(value)
+
+            if not s:
+                top[k] = None
+                dropped_sets.add(k)
+
+        return new_sets, dropped_sets
+
+    def _syncThrough(self, position):
+        """Make sure the log is on disk at least up to 'position'."""
+        with self._syncLock:
+            # 'close' syncs everything written before it
+            if self._syncedThrough >= position or self._closed:
+                return
+
+            with self.lock:
+                self._logFile.flush()
+                syncingThrough = (self._logSegment, self._logPosition)
+
+            # anyone who writes while we're syncing will wait for the lock and then
+            # sync everything they're waiting on at once.
+            if self.fsync:
+                os.fsync(self._logFile.fileno())
+
+            self._syncedThrough = syncingThrough
+
+    def _startNewLogSegment(self):
+        """Close the current log, start another one, and freeze the overlays holding
+        everything written to the old one.
+
+        Returns the new segment number, the frozen overlays, and the snapshot beneath them.
+        Must be called holding self._syncLock and self.lock.
+        """
+        self._logFile.flush()
+        if self.fsync:
+            os.fsync(self._logFile.fileno())
+        self._logFile.close()
+
+        self._logSegment += 1
+        self._logFile = open(self._filePath(self.LOG_PREFIX, self._logSegment), "ab")
+        self._logPosition = 0
+        self._syncedThrough = (self._logSegment, 0)
+
+        frozenOverlays = list(self._overlays)
+
+        self._overlays.insert(0, {})
+
+        return self._logSegment, frozenOverlays, self._snapshot
+
+    def _startBackgroundSnapshot(self):
+        with self._syncLock, self.lock:
+            if self._logPosition <= self.snapshotThreshold:
+                # someone else beat us to it
+                return
+
+            if self._snapshotThread is not None and self._snapshotThread.is_alive():
+                return
+
+            args = self._startNewLogSegment()
+
+            self._snapshotThread = threading.Thread(target=self._writeSnapshot, args=args)
+            self._snapshotThread.daemon = True
+            self._snapshotThread.start()
+
+    def snapshot(self):
+        """Start a new log and write a snapshot of our current state, returning once it's on disk."""
+        if self._snapshotThread is not None:
+            self._snapshotThread.join()
+
+        with self._syncLock, self.lock:
+            args = self._startNewLogSegment()
+
+        self._writeSnapshot(*args)
+
+    def _writeSnapshot(self, segment, frozenOverlays, oldSnapshot):
+        t0 = time.time()
+
+        path = self._filePath(self.SNAPSHOT_PREFIX, segment)
+
+        MappedSnapshot.write(path + ".tmp", self._items(frozenOverlays, oldSnapshot))
+
+        os.rename(path + ".tmp", path)
+        self._syncDirectory()
+
+        newSnapshot = MappedSnapshot(path)
+
+        with self.lock:
+            self._overlays = [o for o in self._overlays if not any(o is f for f in frozenOverlays)]
+            self._snapshot = newSnapshot
+
+        if oldSnapshot is not None:
+            oldSnapshot.close()
+
+        # everything before this snapshot is now redundant
+        snapshots, logs = self._listFiles()
+
+        for older in snapshots:
+            if older < segment:
+                os.remove(self._filePath(self.SNAPSHOT_PREFIX, older))
+
+        for older in logs:
+            if older < segment:
+                os.remove(self._filePath(self.LOG_PREFIX, older))
+
+        self._logger.info("Wrote snapshot %s in %.2f seconds.", path, time.time() - t0)
+
+    def _syncDirectory(self):
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        if self._snapshotThread is not None:
+            self._snapshotThread.join()
+
+        with self._syncLock, self.lock:
+            self._closed = True
+
+            self._logFile.flush()
+            if self.fsync:
+                os.fsync(self._logFile.fileno())
+            self._logFile.close()
+
+            if self._snapshot is not None:
+                self._snapshot.close()
@@ -0,0 +1,450 @@
+#   Copyright 2018 Braxton Mckee
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from object_database.tcp_server import TcpServer, _openChannel, _eventLoop
+from object_database.server import (
+    ConnectedChannel,
+    PendingTransaction,
+    EXISTS_INDEX,
+    mergeGroupedWrites,
+    mergeGroupedSetOps
+)
+from object_database.messages import ClientToServer, ServerToClient
+from object_database.messages import (
+    PROTOCOL_VERSION,
+    COMPRESSED_FRAMES_PROTOCOL_VERSION,
+    GROUPED_WRITES_PROTOCOL_VERSION,
+    DELTA_WRITES_PROTOCOL_VERSION,
+    decodeSerializedValue
+)
+from object_database.schema import SchemaDefinition, TypeDefinition
+from object_database.core_schema import core_schema
+from object_database.persistence import InMemoryPersistence
+import object_database.keymapping as keymapping
+
+import logging
+import queue
+import threading
+import traceback
+
+
+class ReplicaServer(TcpServer):
+    """A TcpServer that serves reads from a copy of another server's data.
+
+    The replica keeps each type its clients subscribe to in its own in-memory kvstore, by
+    subscribing to the whole type on the primary, and applies the primary's transactions to
+    that copy as they arrive. It answers subscriptions and lazy loads itself and broadcasts
+    transactions to its own clients, so the primary sends each transaction once per replica
+    rather than once per client. Commits and flushes are forwarded to the primary, which
+    also owns the Connection objects and identity roots of the replica's clients.
+
+    Transaction ids on a replica are the primary's, so clients can commit against either.
+    """
+
+    def __init__(self, host, port, ssl_context, auth_token,
+                 primaryHost, primaryPort, primaryAuthToken=None):
+        TcpServer.__init__(self, host, port, InMemoryPersistence(), ssl_context, auth_token)
+
+        self.primaryHost = primaryHost
+        self.primaryPort = primaryPort
+        self.primaryAuthToken = primaryAuthToken if primaryAuthToken is not None else auth_token
+
+        # our ClientToServerProtocol connection to the primary, and the messages it has sent
+        # us, which we process in order on '_primaryThread'.
+        self._primary = None
+        self._primaryMessages = queue.Queue()
+        self._primaryThread = None
+        self._primaryInitialized = threading.Event()
+        self._primaryProtocolVersion = 0
+
+        # schema name -> the union of the definitions our clients gave us, which is what
+        # we've defined on the primary.
+        self._schemasOnPrimary = {}
+
+        # (schema, typename) pairs we hold a complete copy of
+        self._replicatedTypes = set()
+
+        # (schema, typename) -> {'values', 'index_values'} for types we're loading
+        self._typeBuildup = {}
+
+        # (schema, typename) -> [(connectedChannel, Subscribe message)] waiting for it to load
+        self._subscriptionsWaitingForTypes = {}
+
+        # our guid for a request to the primary -> (connectedChannel, the client's guid, ...)
+        self._forwardedTransactions = {}
+        self._forwardedFlushes = {}
+        self._pendingConnections = {}
+
+        # identities created by transactions we've forwarded, and the channel that created them,
+        # so that it hears about them even if it isn't subscribed to their type.
+        self._createdIdentities = {}
+
+        self._logger = logging.getLogger(__name__)
+
+    def start(self):
+        self._primary = _openChannel(
+            self.primaryHost, self.primaryPort, timeout=10.0, retry=True, eventLoop=_eventLoop
+        )
+
+        self._primaryThread = threading.Thread(target=self.servicePrimaryMessages)
+        self._primaryThread.daemon = True
+        self._primaryThread.start()
+
+        self._primary.setServerToClientHandler(self._onPrimaryMessage)
+        self._primary.write(ClientToServer.Authenticate(token=self.primaryAuthToken))
+        self._primary.write(ClientToServer.ProtocolVersion(version=PROTOCOL_VERSION))
+
+        self._primaryInitialized.wait(timeout=10.0)
+        assert self._primaryInitialized.is_set(), "never heard back from the primary"
+
+        TcpServer.start(self)
+
+    def stop(self):
+        TcpServer.stop(self)
+
+        self._primaryMessages.put(None)
+        self._primaryThread.join()
+        self._primary.close()
+
+    def _onPrimaryMessage(self, msg):
+        self._primaryMessages.put(msg)
+
+    def servicePrimaryMessages(self):
+        while True:
+            msg = self._primaryMessages.get()
+            if msg is None:
+                return
+
+            try:
+                self._handlePrimaryMessage(msg)
+            except Exception:
+                self._logger.error(
+                    "Unexpected error handling %s from the primary:\n%s",
+                    msg._which, traceback.format_exc()
+                )
+
+    def _handlePrimaryMessage(self, msg):
+        if msg.matches.Initialize:
+            # we don't have any data yet, so we're trivially up to date with the primary
+            with self._transactionNumLock, self._lock:
+                self._last_allocated_transaction_num = msg.transaction_num
+                self._finishBroadcastTurn(msg.transaction_num)
+
+            self._primaryInitialized.set()
+        elif msg.matches.ProtocolVersion:
+            self._primaryProtocolVersion = msg.version
+
+            if msg.version >= COMPRESSED_FRAMES_PROTOCOL_VERSION:
+                self._primary.peerAcceptsCompressedFrames()
+        elif msg.matches.Transaction or msg.matches.GroupedTransaction or msg.matches.DeltaTransaction:
+            self._applyPrimaryTransaction(msg)
+        elif msg.matches.SubscriptionData:
+            buildup = self._typeBuildup.setdefault(
+                (msg.schema, msg.typename), {'values': {}, 'index_values': {}}
+            )
+            buildup['values'].update({k: decodeSerializedValue(v) for k, v in msg.values.items()})
+            buildup['index_values'].update(msg.index_values)
+        elif msg.matches.SubscriptionComplete:
+            self._completeTypeLoad(msg)
+        elif msg.matches.TransactionResult:
+            with self._lock:
+                connectedChannel, guid, created = \
+                    self._forwardedTransactions.pop(msg.transaction_guid)
+                for identity in created:
+                    self._createdIdentities.pop(identity, None)
+
+            connectedChannel.sendTransactionSuccess(guid, msg.success, msg.badKey)
+        elif msg.matches.FlushResponse:
+            with self._lock:
+                connectedChannel, guid = self._forwardedFlushes.pop(msg.guid)
+                connectedChannel.write(ServerToClient.FlushResponse(guid=guid))
+        elif msg.matches.ReplicaConnection:
+            self._completeConnection(msg)
+        elif msg.matches.Disconnected:
+            self._logger.error("Lost our connection to the primary. Disconnecting all clients.")
+
+            with self._lock:
+                channels = list(self._clientChannels)
+
+            for channel in channels:
+                channel.close()
+        elif msg.matches.SubscriptionIncrease or msg.matches.ServerInstance:
+            # we track the objects our clients create ourselves, and we can't resume
+            # our connection to the primary.
+            pass
+        else:
+            self._logger.error("Unexpected message from the primary: %s", msg._which)
+
+    def _applyPrimaryTransaction(self, msg):
+        if msg.matches.GroupedTransaction or msg.matches.DeltaTransaction:
+            writes, set_adds, set_removes, deltas = {}, {}, {}, {}
+
+            mergeGroupedWrites(writes, msg.writes)
+            mergeGroupedSetOps(set_adds, msg.set_adds)
+            mergeGroupedSetOps(set_removes, msg.set_removes)
+
+            if msg.matches.DeltaTransaction:
+                mergeGroupedWrites(deltas, msg.deltas)
+
+            transaction = PendingTransaction(
+                None, writes, set_adds, set_removes, (), (), msg.transaction_id - 1, deltas
+            )
+        else:
+            transaction = PendingTransaction.fromKeys(
+                None,
+                {k: decodeSerializedValue(v) for k, v in msg.writes.items()},
+                {k: set(v) for k, v in msg.set_adds.items()},
+                {k: set(v) for k, v in msg.set_removes.items()},
+                (),
+                (),
+                msg.transaction_id - 1
+            )
+        transaction.transaction_id = msg.transaction_id
+
+        with self._transactionNumLock, self._lock:
+            # we never commit anything ourselves, so nothing else can be writing to the kvstore
+            self._persistTransactions([transaction])
+
+            createdBy = {}
+            for (schema_name, typename), indices in transaction.set_adds.items():
+                for identity in indices.get(EXISTS_INDEX, ()):
+                    connectedChannel = self._createdIdentities.get(identity)
+                    if connectedChannel is None:
+                        continue
+                    if connectedChannel.channel not in self._clientChannels:
+                        continue
+
+                    createdBy.setdefault((connectedChannel, schema_name, typename), set()).add(identity)
+
+            for (connectedChannel, schema_name, typename), identities in createdBy.items():
+                self._subscribeToCreatedObjects(connectedChannel, schema_name, typename, identities)
+
+            self._last_allocated_transaction_num = msg.transaction_id
+            self._broadcastTransactions([transaction])
+            self._finishBroadcastTurn(msg.transaction_id)
+
+    def _completeTypeLoad(self, msg):
+        schemaAndTypename = (msg.schema, msg.typename)
+
+        buildup = self._typeBuildup.pop(schemaAndTypename, {'values': {}, 'index_values': {}})
+
+        kvs = dict(buildup['values'])
+        set_adds = {}
+
+        for reverseKey, hashVal in buildup['index_values'].items():
+            if hashVal is not None:
+                kvs[reverseKey] = hashVal.encode("utf8")
+
+                schema_name, typename, identity, fieldname = \
+                    keymapping.split_data_reverse_index_key(reverseKey)
+                index_key = keymapping.index_key_from_names_encoded(
+                    schema_name, typename, fieldname, hashVal
+                )
+
+                set_adds.setdefault(index_key, set()).add(identity)
+
+        with self._transactionNumLock, self._lock:
+            self._writeToKvstore(kvs, set_adds, {})
+
+            # the primary sent us every transaction on the types we already had before this
+            # message, so all of our data is current as of 'msg.tid'.
+            if msg.tid > self._cur_transaction_num:
+                self._last_allocated_transaction_num = msg.tid
+                self._finishBroadcastTurn(msg.tid)
+
+            self._replicatedTypes.add(schemaAndTypename)
+
+            waiting = self._subscriptionsWaitingForTypes.pop(schemaAndTypename, [])
+
+        for connectedChannel, subscribeMsg in waiting:
+            if connectedChannel.channel in self._clientChannels:
+                TcpServer.onClientToServerMessage(self, connectedChannel, subscribeMsg)
+
+    def addConnection(self, channel):
+        guid = self.identityProducer.createIdentity()
+
+        with self._lock:
+            # the primary creates the Connection object and identity root. We send the
+            # client its Initialize message once we hear back.
+            connectedChannel = ConnectedChannel(self._cur_transaction_num, channel, None, None)
+
+            self._clientChannels[channel] = connectedChannel
+            self._pendingConnections[guid] = connectedChannel
+
+            channel.setClientToServerHandler(
+                lambda msg: self.onClientToServerMessage(connectedChannel, msg)
+            )
+
+        self._primary.write(ClientToServer.CreateReplicaConnection(guid=guid))
+
+    def _completeConnection(self, msg):
+        with self._lock:
+            connectedChannel = self._pendingConnections.pop(msg.guid)
+            connectedChannel.connectionObject = \
+                core_schema.Connection.fromIdentity(msg.connIdentity)
+            connectedChannel.identityRoot = msg.identity_root
+
+            if connectedChannel.channel not in self._clientChannels:
+                # the client went away before we heard back
+                self._dropConnectionEntry(connectedChannel.connectionObject)
+                return
+
+            connectedChannel.initial_tid = self._cur_transaction_num
+            connectedChannel.sendInitializationMessage()
+
+    def dropConnection(self, channel):
+        with self._lock:
+            connectedChannel = self._clientChannels.get(channel)
+
+            if connectedChannel is not None and connectedChannel.connectionObject is None:
+                # '_completeConnection' will drop its Connection object
+                del self._clientChannels[channel]
+                return
+
+        TcpServer.dropConnection(self, channel)
+
+    def _dropConnectionEntry(self, entry):
+        self._primary.write(ClientToServer.DropReplicaConnection(connIdentity=entry._identity))
+
+    def onClientToServerMessage(self, connectedChannel, msg):
+        if msg.matches.Authenticate or connectedChannel.needsAuthentication:
+            TcpServer.onClientToServerMessage(self, connectedChannel, msg)
+        elif msg.matches.DefineSchema:
+            TcpServer.onClientToServerMessage(self, connectedChannel, msg)
+            self._defineSchemaOnPrimary(msg.name, msg.definition)
+        elif msg.matches.Subscribe:
+            schemaAndTypename = (msg.schema, msg.typename)
+
+            with self._lock:
+                if schemaAndTypename not in self._replicatedTypes:
+                    waiting = self._subscriptionsWaitingForTypes.get(schemaAndTypename)
+
+                    if waiting is None:
+                        waiting = self._subscriptionsWaitingForTypes[schemaAndTypename] = []
+
+                        # we always replicate whole types, whatever the client asked for
+                        self._primary.write(
+                            ClientToServer.Subscribe(
+                                schema=msg.schema,
+                                typename=msg.typename,
+                                fieldname_and_value=None,
+                                isLazy=False
+                            )
+                        )
+
+                    waiting.append((connectedChannel, msg))
+                    return
+
+            TcpServer.onClientToServerMessage(self, connectedChannel, msg)
+        elif msg.matches.CompleteTransaction:
+            self._forwardTransaction(connectedChannel, msg)
+        elif msg.matches.Flush:
+            guid = self.identityProducer.createIdentity()
+
+            with self._lock:
+                self._forwardedFlushes[guid] = (connectedChannel, msg.guid)
+
+            self._primary.write(ClientToServer.Flush(guid=guid))
+        elif msg.matches.CreateReplicaConnection or msg.matches.DropReplicaConnection:
+            self._logger.error("Replicas can't serve other replicas.")
+        else:
+            TcpServer.onClientToServerMessage(self, connectedChannel, msg)
+
+    def _defineSchemaOnPrimary(self, name, definition):
+        with self._lock:
+            current = self._schemasOnPrimary.get(name, {})
+            merged = dict(current)
+
+            for typename, typedef in definition.items():
+                if typename in merged:
+                    prior = merged[typename]
+                    typedef = TypeDefinition(
+                        fields=prior.fields +
+                        tuple(f for f in typedef.fields if f not in prior.fields),
+                        indices=prior.indices +
+                        tuple(i for i in typedef.indices if i not in prior.indices)
+                    )
+                merged[typename] = typedef
+
+            if merged == current:
+                return
+
+            self._schemasOnPrimary[name] = merged
+
+            self._primary.write(
+                ClientToServer.DefineSchema(name=name, definition=SchemaDefinition(merged))
+            )
+
+    def _forwardTransaction(self, connectedChannel, msg):
+        try:
+            data = connectedChannel.extractTransactionData(msg.transaction_guid)
+        except Exception:
+            self._logger.error("Unknown error forwarding transaction: %s", traceback.format_exc())
+            connectedChannel.sendTransactionSuccess(msg.transaction_guid, False, "<NONE>")
+            return
+
+        created = set()
+        for indices in data['set_adds'].values():
+            created.update(indices.get(EXISTS_INDEX, ()))
+
+        guid = self.identityProducer.createIdentity()
+
+        with self._lock:
+            self._forwardedTransactions[guid] = (connectedChannel, msg.transaction_guid, created)
+
+            for identity in created:
+                self._createdIdentities[identity] = connectedChannel
+
+            if data['deltas'] and self._primaryProtocolVersion < DELTA_WRITES_PROTOCOL_VERSION:
+                # the primary can't apply them, so send it the values they produce from
+                # our copy, which its conflict checks keep honest
+                transaction = PendingTransaction(
+                    None, data['writes'], {}, {}, (), (), msg.as_of_version, data['deltas']
+                )
+                transaction.applyDeltas(self._kvstore.getSeveralAsDictionary(transaction.key_deltas))
+                data['deltas'] = {}
+
+            if data['deltas']:
+                self._primary.write(
+                    ClientToServer.TransactionDeltas(deltas=data['deltas'], transaction_guid=guid)
+                )
+
+            if self._primaryProtocolVersion >= GROUPED_WRITES_PROTOCOL_VERSION:
+                self._primary.write(
+                    ClientToServer.GroupedTransactionData(
+                        writes=data['writes'],
+                        set_adds=data['set_adds'],
+                        set_removes=data['set_removes'],
+                        key_versions=tuple(data['key_versions']),
+                        index_versions=tuple(data['index_versions']),
+                        transaction_guid=guid
+                    )
+                )
+            else:
+                self._primary.write(
+                    ClientToServer.TransactionData(
+                        writes=keymapping.ungroup_data_keys(data['writes']),
+                        set_adds=keymapping.ungroup_index_keys(data['set_adds']),
+                        set_removes=keymapping.ungroup_index_keys(data['set_removes']),
+                        key_versions=tuple(data['key_versions']),
+                        index_versions=tuple(data['index_versions']),
+                        transaction_guid=guid
+                    )
+                )
+            self._primary.write(
+                ClientToServer.CompleteTransaction(
+                    as_of_version=msg.as_of_version,
+                    transaction_guid=guid
+                )
+            )
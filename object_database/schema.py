@@ -12,7 +12,8 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-from object_database.object import DatabaseObject, Index, Indexed
+from object_database.object import DatabaseObject, DeltaEncoded, Index, Indexed
+from object_database.field_deltas import isDeltaEncodable
 from types import FunctionType
 from typed_python import ConstDict, NamedTuple, Tuple, TupleOf
 
@@ -39,6 +40,10 @@ class Schema:
         # class -> set(fieldname)
         self._indexed_fields = {}
         self._indexTypes = {}
+        # class -> set(indexname) of the indices that support range lookups
+        self._orderedIndices = {}
+        # class -> set(fieldname) of the DeltaEncoded fields
+        self._deltaEncodedFields = {}
         self._frozen = False
         # Map: cls(DatabaseObject) -> original_cls
         self._types_to_original = {}
@@ -115,7 +120,13 @@ class Schema:
 
         return self._types[typename]
 
-    def _addIndex(self, type, prop):
+    def isOrderedIndex(self, type, name):
+        return name in self._orderedIndices.get(type, ())
+
+    def isDeltaEncoded(self, type, name):
+        return name in self._deltaEncodedFields.get(type, ())
+
+    def _addIndex(self, type, prop, ordered=False):
         assert issubclass(type, DatabaseObject)
 
         if type not in self._indices:
@@ -130,6 +141,9 @@ class Schema:
         self._indexTypes[type][prop] = index_type
         self._indexed_fields[type].add(prop)
 
+        if ordered:
+            self._orderedIndices.setdefault(type, set()).add(prop)
+
     def _addTupleIndex(self, type, name, props, indexType):
         assert issubclass(type, DatabaseObject)
 
@@ -172,6 +186,10 @@ class Schema:
                         types[name] = val
                     elif isinstance(val, Indexed) and isinstance(val.obj, type):
                         types[name] = val.obj
+                    elif isinstance(val, DeltaEncoded):
+                        assert isDeltaEncodable(val.obj), \
+                            "Only ListOf, TupleOf, and ConstDict fields can be DeltaEncoded, not %s" % val.obj
+                        types[name] = val.obj
 
         t._define(**types)
 
@@ -180,7 +198,9 @@ class Schema:
                 if isinstance(val, Index):
                     self._addTupleIndex(t, name, val.names, Tuple(*tuple(types[k] for k in val.names)))
                 if not name.startswith('__') and isinstance(val, Indexed):
-                    self._addIndex(t, name)
+                    self._addIndex(t, name, ordered=val.ordered)
+                elif not name.startswith('__') and isinstance(val, DeltaEncoded):
+                    self._deltaEncodedFields.setdefault(t, set()).add(name)
                 elif (not name.startswith("__") or name in ["__str__", "__repr__"]):
                     if isinstance(val, (FunctionType, staticmethod, property)):
                         setattr(t, name, val)
@@ -13,21 +13,291 @@
 #   limitations under the License.
 
 from object_database.messages import ClientToServer, ServerToClient
-from object_database.identity import IdentityProducer
+from object_database.messages import (
+    PROTOCOL_VERSION,
+    COMPRESSED_FRAMES_PROTOCOL_VERSION,
+    RESUMABLE_PROTOCOL_VERSION,
+    GROUPED_WRITES_PROTOCOL_VERSION,
+    DELTA_WRITES_PROTOCOL_VERSION,
+    coalesceTransactionMessages,
+    decodeSerializedValue,
+    legacyServerToClientMessage
+)
+from object_database.identity import IdentityProducer, internIdentity
 from object_database.messages import SchemaDefinition
 from object_database.core_schema import core_schema
+from object_database.server_metrics import ServerMetrics, formatPrometheus, flattenSamples, gauge, METRIC_PREFIX
 import object_database.keymapping as keymapping
-from object_database.util import Timer
+from object_database.util import Timer, genToken
 from typed_python import *
 
+import bisect
+import collections
 import queue
 import time
 import logging
 import threading
 import traceback
+import zlib
 
 DEFAULT_GC_INTERVAL = 900.0
 
+# how often the garbage collection thread looks for version numbers to drop
+DEFAULT_GC_PERIOD = 10.0
+
+VERSION_NUMBER_SHARD_COUNT = 64
+
+DEFAULT_TRANSACTION_HISTORY_SIZE = 1000
+
+# the (fieldname, value hash) of the index every object is in while it exists
+EXISTS_INDEX = (" exists", keymapping.index_value_to_hash(True))
+
+
+class VersionNumberShard:
+    """The last committed transaction id for each key in one slice of the keyspace.
+
+    Transactions only take the locks of the shards they touch, so transactions over
+    disjoint keys can check for conflicts and persist their writes concurrently.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # for each key, the last version number we committed
+        self.version_numbers = {}
+
+        # key -> when we last committed to it, for the keys garbage collection hasn't
+        # looked at since. The least recently committed keys come first.
+        self.timestamps = collections.OrderedDict()
+
+    def touch(self, key, timestamp):
+        self.timestamps[key] = timestamp
+        self.timestamps.move_to_end(key)
+
+    def popStale(self, threshold, maxCount):
+        """Remove and return up to 'maxCount' of the keys we last committed to before 'threshold'."""
+        res = []
+
+        while self.timestamps and len(res) < maxCount:
+            key, timestamp = self.timestamps.popitem(last=False)
+
+            if timestamp >= threshold:
+                self.timestamps[key] = timestamp
+                self.timestamps.move_to_end(key, last=False)
+                break
+
+            res.append(key)
+
+        return res
+
+
+def mergeGroupedWrites(target, writes):
+    """Add grouped writes (which may come straight off the wire) to the dict 'target'."""
+    for schemaAndTypename, objects in writes.items():
+        groupWrites = target.setdefault(tuple(schemaAndTypename), {})
+
+        for identity, fields in objects.items():
+            groupWrites.setdefault(identity, {}).update(fields)
+
+
+def mergeGroupedSetOps(target, setOps):
+    """Add grouped index changes (which may come straight off the wire) to the dict 'target'."""
+    for schemaAndTypename, indices in setOps.items():
+        groupSetOps = target.setdefault(tuple(schemaAndTypename), {})
+
+        for index, identities in indices.items():
+            if identities:
+                groupSetOps.setdefault(tuple(index), set()).update(identities)
+
+
+def _nonemptySetOps(setOps):
+    """Drop the empty index changes from a grouped map of index changes."""
+    res = {}
+
+    for schemaAndTypename, indices in setOps.items():
+        indices = {index: identities for index, identities in indices.items() if identities}
+        if indices:
+            res[schemaAndTypename] = indices
+
+    return res
+
+
+def deltaTransactionMessage(transactionMessage, transactions):
+    """'transactionMessage', the coalesced GroupedTransaction of 'transactions', as a
+    DeltaTransaction that carries their deltas instead of the values they produced.
+
+    A field gets a delta only if every transaction that wrote to it did so with a delta,
+    in which case it's their frames in order. Otherwise its last value stays in 'writes'.
+    """
+    # (schema and typename, identity, fieldname) -> frames
+    deltas = {}
+    whole = set()
+
+    for transaction in transactions:
+        for schemaAndTypename, objects in transaction.writes.items():
+            objectDeltas = transaction.deltas.get(schemaAndTypename, {})
+
+            for identity, fields in objects.items():
+                fieldDeltas = objectDeltas.get(identity, {})
+
+                for fieldname in fields:
+                    field = (schemaAndTypename, identity, fieldname)
+
+                    if field in whole:
+                        continue
+
+                    if fieldname in fieldDeltas:
+                        deltas[field] = deltas.get(field, b"") + fieldDeltas[fieldname]
+                    else:
+                        deltas.pop(field, None)
+                        whole.add(field)
+
+    writes = {}
+    for schemaAndTypename, objects in transactionMessage.writes.items():
+        schemaAndTypename = tuple(schemaAndTypename)
+
+        for identity, fields in objects.items():
+            fields = {f: v for f, v in fields.items() if (schemaAndTypename, identity, f) not in deltas}
+            if fields:
+                writes.setdefault(schemaAndTypename, {})[identity] = fields
+
+    groupedDeltas = {}
+    for (schemaAndTypename, identity, fieldname), frames in deltas.items():
+        groupedDeltas.setdefault(schemaAndTypename, {}).setdefault(identity, {})[fieldname] = frames
+
+    return ServerToClient.DeltaTransaction(
+        writes=writes,
+        deltas=groupedDeltas,
+        set_adds=transactionMessage.set_adds,
+        set_removes=transactionMessage.set_removes,
+        transaction_id=transactionMessage.transaction_id
+    )
+
+
+class PendingTransaction:
+    """A transaction a client has asked us to commit, and the keys it touches.
+
+    'writes' maps (schema, typename) -> identity -> fieldname -> value, and 'set_adds' and
+    'set_removes' map (schema, typename) -> (fieldname, value hash) -> identities. We keep
+    them grouped this way for routing and broadcasting, and also flatten them into
+    'key_value', 'index_adds' and 'index_removes', keyed the way the kvstore wants them.
+
+    'deltas' maps (schema, typename) -> identity -> fieldname -> frames to append to the
+    stored value of a DeltaEncoded field. Once we've read the stored values, 'applyDeltas'
+    puts the resulting values in 'writes' too, so only broadcasting cares about 'deltas'.
+    """
+
+    def __init__(self,
+                 sourceChannel,
+                 writes,
+                 set_adds,
+                 set_removes,
+                 keys_to_check_versions,
+                 indices_to_check_versions,
+                 as_of_version,
+                 deltas=None
+                 ):
+        self.sourceChannel = sourceChannel
+        self.writes = writes
+        self.deltas = deltas or {}
+        self.set_adds = _nonemptySetOps(set_adds)
+        self.set_removes = _nonemptySetOps(set_removes)
+        self.keys_to_check_versions = keys_to_check_versions
+        self.indices_to_check_versions = indices_to_check_versions
+        self.as_of_version = as_of_version
+
+        self.key_value = keymapping.ungroup_data_keys(self.writes)
+        self.key_deltas = keymapping.ungroup_data_keys(self.deltas)
+        self.index_adds = keymapping.ungroup_index_keys(self.set_adds)
+        self.index_removes = keymapping.ungroup_index_keys(self.set_removes)
+
+        self.keysWritingTo = set(self.key_value) | set(self.key_deltas)
+        self.setsWritingTo = set(self.index_adds) | set(self.index_removes)
+        self.schemaTypePairsWriting = (
+            set(self.writes) | set(self.deltas) | set(self.set_adds) | set(self.set_removes)
+        )
+
+        self.identities_mentioned = set()
+
+        for grouped in [self.writes, self.deltas]:
+            for objects in grouped.values():
+                self.identities_mentioned.update(objects)
+
+        for subset in [self.set_adds, self.set_removes]:
+            for indices in subset.values():
+                for identities in indices.values():
+                    self.identities_mentioned.update(identities)
+
+        # filled out as we commit
+        self.transaction_id = None
+        self.priorValues = None
+        self.result = (False, "<NONE>")
+
+    @staticmethod
+    def fromKeys(sourceChannel,
+                 key_value,
+                 set_adds,
+                 set_removes,
+                 keys_to_check_versions,
+                 indices_to_check_versions,
+                 as_of_version
+                 ):
+        """Make a PendingTransaction from writes and index changes keyed by their full keys."""
+        return PendingTransaction(
+            sourceChannel,
+            keymapping.group_data_keys(key_value),
+            keymapping.group_index_keys(set_adds),
+            keymapping.group_index_keys(set_removes),
+            keys_to_check_versions,
+            indices_to_check_versions,
+            as_of_version
+        )
+
+    def applyDeltas(self, currentValues):
+        """Add the values our deltas produce from 'currentValues' (the stored values of the
+        keys they apply to) to our writes.
+
+        A delta to a value that doesn't exist leaves it that way, and we broadcast that
+        as a write, since subscribers have nothing to apply it to either.
+        """
+        for key, frames in self.key_deltas.items():
+            schema_name, typename, identity, fieldname = keymapping.split_data_key(key)
+
+            current = currentValues[key]
+            value = current + frames if current is not None else None
+
+            self.key_value[key] = value
+            self.writes.setdefault((schema_name, typename), {}).setdefault(identity, {})[fieldname] = value
+
+            if value is None:
+                self.dropDelta(schema_name, typename, identity, fieldname)
+
+        self.key_deltas = {}
+
+    def dropDelta(self, schema_name, typename, identity, fieldname=None):
+        """Broadcast the whole value of 'fieldname' (or every field) of 'identity' instead of
+        our delta to it."""
+        objects = self.deltas.get((schema_name, typename))
+
+        if not objects or identity not in objects:
+            return
+
+        if fieldname is None:
+            del objects[identity]
+        else:
+            objects[identity].pop(fieldname, None)
+            if not objects[identity]:
+                del objects[identity]
+
+        if not objects:
+            del self.deltas[(schema_name, typename)]
+
+    def keysTouched(self):
+        return (
+            set(self.keys_to_check_versions) | set(self.indices_to_check_versions) |
+            self.keysWritingTo | self.setsWritingTo
+        )
+
 
 class ConnectedChannel:
     def __init__(self, initial_tid, channel, connectionObject, identityRoot):
@@ -40,8 +310,13 @@ class ConnectedChannel:
         self.subscribedTypes = {}  # schema, type to the lazy transaction id (or -1 if not lazy)
         self.subscribedIds = set()  # identities
         self.subscribedIndexKeys = {}  # full index keys to lazy transaction id
+        self.projections = {}  # schema, type to the only fields of it we send, if it's projected
         self.identityRoot = identityRoot
         self.pendingTransactions = {}
+        self.protocolVersion = 0
+
+        # if this is a read replica, the Connection objects we made for its clients
+        self.replicaConnections = {}
         self._needsAuthentication = True
 
     @property
@@ -54,10 +329,93 @@ class ConnectedChannel:
     def heartbeat(self):
         self.missedHeartbeats = 0
 
-    def sendTransaction(self, msg):
-        # we need to cut the transaction down
+    def write(self, msg, messageCache=None):
+        """Write 'msg' to the channel, re-encoding it for clients that predate the current protocol.
+
+        'messageCache' lets a broadcast share one re-encoded message across channels that
+        speak the same protocol version.
+        """
+        if self.protocolVersion < GROUPED_WRITES_PROTOCOL_VERSION:
+            if messageCache is None:
+                msg = legacyServerToClientMessage(msg, self.protocolVersion)
+            else:
+                if self.protocolVersion not in messageCache:
+                    messageCache[self.protocolVersion] = legacyServerToClientMessage(msg, self.protocolVersion)
+                msg = messageCache[self.protocolVersion]
+
         self.channel.write(msg)
 
+    def sendTransaction(self, msg, messageCache=None):
+        # we need to cut the transaction down
+        self.write(msg, messageCache)
+
+    def projectFields(self, schema_name, typename, fields):
+        """Only send this channel 'fields' (and whether objects exist) of schema_name.typename."""
+        typedef = self.definedSchemas.get(schema_name, {}).get(typename)
+
+        assert typedef is not None, "Can't project a type we didn't define: %s.%s" % (schema_name, typename)
+
+        fields = set(fields)
+        self.projections[schema_name, typename] = tuple(
+            f for f in typedef.fields if f in fields or f == " exists"
+        )
+
+    def fieldsToSend(self, schema_name, typename):
+        """The fields of schema_name.typename that this channel wants."""
+        projection = self.projections.get((schema_name, typename))
+        if projection is not None:
+            return projection
+        return self.definedSchemas[schema_name][typename].fields
+
+    def project(self, msg):
+        """'msg', a GroupedTransaction or DeltaTransaction, without values of fields this
+        channel didn't ask for."""
+        if not self.projections:
+            return msg
+
+        if msg.matches.DeltaTransaction:
+            return ServerToClient.DeltaTransaction(
+                writes=self._projectWrites(msg.writes),
+                deltas=self._projectWrites(msg.deltas),
+                set_adds=msg.set_adds,
+                set_removes=msg.set_removes,
+                transaction_id=msg.transaction_id
+            )
+
+        return ServerToClient.GroupedTransaction(
+            writes=self._projectWrites(msg.writes),
+            set_adds=msg.set_adds,
+            set_removes=msg.set_removes,
+            transaction_id=msg.transaction_id
+        )
+
+    def _projectWrites(self, writes):
+        res = {}
+        for schemaAndTypename, objects in writes.items():
+            projection = self.projections.get(tuple(schemaAndTypename))
+
+            if projection is None:
+                res[schemaAndTypename] = objects
+                continue
+
+            projected = {}
+            for identity, fields in objects.items():
+                fields = {f: v for f, v in fields.items() if f in projection}
+                if fields:
+                    projected[identity] = fields
+
+            if projected:
+                res[schemaAndTypename] = projected
+
+        return res
+
+    def negotiateProtocolVersion(self, clientVersion):
+        self.protocolVersion = min(clientVersion, PROTOCOL_VERSION)
+        self.channel.write(ServerToClient.ProtocolVersion(version=self.protocolVersion))
+
+        if self.protocolVersion >= COMPRESSED_FRAMES_PROTOCOL_VERSION:
+            self.channel.peerAcceptsCompressedFrames()
+
     def sendInitializationMessage(self):
         self.channel.write(
             ServerToClient.Initialize(
@@ -80,14 +438,30 @@ class ConnectedChannel:
                 'set_adds': {},
                 'set_removes': {},
                 'key_versions': set(),
-                'index_versions': set()
+                'index_versions': set(),
+                'deltas': {}
             }
 
-        self.pendingTransactions[guid]['writes'].update({k: msg.writes[k] for k in msg.writes})
-        self.pendingTransactions[guid]['set_adds'].update({k: set(msg.set_adds[k]) for k in msg.set_adds if msg.set_adds[k]})
-        self.pendingTransactions[guid]['set_removes'].update({k: set(msg.set_removes[k]) for k in msg.set_removes if msg.set_removes[k]})
-        self.pendingTransactions[guid]['key_versions'].update(msg.key_versions)
-        self.pendingTransactions[guid]['index_versions'].update(msg.index_versions)
+        pending = self.pendingTransactions[guid]
+
+        if msg.matches.TransactionDeltas:
+            mergeGroupedWrites(pending['deltas'], msg.deltas)
+            return
+
+        if msg.matches.GroupedTransactionData:
+            mergeGroupedWrites(pending['writes'], msg.writes)
+            mergeGroupedSetOps(pending['set_adds'], msg.set_adds)
+            mergeGroupedSetOps(pending['set_removes'], msg.set_removes)
+        else:
+            mergeGroupedWrites(
+                pending['writes'],
+                keymapping.group_data_keys({k: decodeSerializedValue(v) for k, v in msg.writes.items()})
+            )
+            mergeGroupedSetOps(pending['set_adds'], keymapping.group_index_keys(msg.set_adds))
+            mergeGroupedSetOps(pending['set_removes'], keymapping.group_index_keys(msg.set_removes))
+
+        pending['key_versions'].update(msg.key_versions)
+        pending['index_versions'].update(msg.index_versions)
 
     def extractTransactionData(self, guid):
         return self.pendingTransactions.pop(guid)
@@ -98,30 +472,70 @@ class Server:
         self._kvstore = kvstore
         self._auth_token = auth_token
 
+        # guards channel and subscription state, and the order in which we broadcast
+        # transactions. Conflict checking and persistence happen under the locks in
+        # '_version_number_shards' instead.
         self._lock = threading.RLock()
+        self._broadcastTurn = threading.Condition(self._lock)
 
         self.verbose = False
 
         self._gc_interval = DEFAULT_GC_INTERVAL
+        self.gcPeriod = DEFAULT_GC_PERIOD
+
+        # how many keys a slice of garbage collection takes from a shard at once
+        self.GC_SLICE_SIZE = 1000
+
+        # only one garbage collection pass runs at a time
+        self._gcLock = threading.Lock()
+        self._gcThread = None
 
         self._removeOldDeadConnections()
 
         # InMemoryChannel or ServerToClientProtocol -> ConnectedChannel
         self._clientChannels = {}
 
-        # id of the next transaction
+        # id of the last transaction we broadcast
         self._cur_transaction_num = 0
 
-        # for each key, the last version number we committed
-        self._version_numbers = {}
-        self._version_numbers_timestamps = {}
+        # identifies this server instance to clients, so they can't resume a connection
+        # against a server that doesn't know the transactions they saw.
+        self._serverGuid = genToken()
+
+        # the last 'transactionHistorySize' Transaction messages we broadcast, oldest first,
+        # so that clients that reconnect can catch up on what they missed.
+        self._transactionHistory = collections.deque()
+        self.transactionHistorySize = DEFAULT_TRANSACTION_HISTORY_SIZE
+
+        # id of the last transaction we handed out. Transactions between this and
+        # '_cur_transaction_num' are being persisted and are waiting to broadcast.
+        self._last_allocated_transaction_num = 0
+        self._transactionNumLock = threading.Lock()
+
+        self._version_number_shards = [VersionNumberShard() for _ in range(VERSION_NUMBER_SHARD_COUNT)]
+
+        # transaction id -> {key: what it held before the transaction} for each transaction
+        # we've written to the kvstore and not yet broadcast, so that a broadcast can read
+        # the kvstore as of its own transaction. Guarded by '_unbroadcastLock'.
+        self._unbroadcastPriorValues = {}
+        self._unbroadcastLock = threading.Lock()
 
         # (schema,type) to set(subscribed channel)
         self._type_to_channel = {}
 
-        # index-stringname to set(subscribed channel)
+        # index-stringname to set(subscribed channel). Subscriptions to ranges of ordered
+        # indices use the index key of their range token.
         self._index_to_channel = {}
 
+        # (schema, type, fieldname) to {range index key: (low_hash, high_hash)} for the
+        # ranges of ordered indices that channels are subscribed to
+        self._index_ranges = {}
+
+        # index group to the sorted list of its value hashes, for the ordered indices
+        # we've been asked for ranges of. Guarded by '_orderedIndexLock'.
+        self._orderedIndexValues = {}
+        self._orderedIndexLock = threading.Lock()
+
         # for each individually subscribed ID, a set of channels
         self._id_to_channel = {}
 
@@ -131,10 +545,16 @@ class Server:
         self.MAX_NORMAL_TO_SEND_SYNCHRONOUSLY = 1000
         self.MAX_LAZY_TO_SEND_SYNCHRONOUSLY = 10000
 
-        self._transactions = 0
-        self._keys_set = 0
-        self._index_values_updated = 0
-        self._subscriptions_written = 0
+        # how many objects of a large subscription we send per message
+        self.SUBSCRIPTION_CHUNK_SIZE = 10000
+
+        # if not None, we commit transactions in batches on a background thread, waiting
+        # up to this many seconds after a transaction arrives for others to join its batch.
+        # Must be set before 'start'.
+        self.groupCommitWindow = None
+        self.MAX_GROUP_COMMIT_SIZE = 1000
+
+        self.metrics = ServerMetrics()
 
         self._subscriptionResponseThread = None
 
@@ -145,16 +565,19 @@ class Server:
         # to prevent message processing on the main thread.
         self._subscriptionQueue = queue.Queue()
 
-        # if we're building a subscription up, all the objects that have changed while our
-        # lock was released.
+        # (connectedChannel, msg) pairs of CompleteTransaction and Flush messages waiting
+        # for the group commit thread.
+        self._groupCommitQueue = queue.Queue()
+        self._groupCommitThread = None
+
+        # if we're streaming a subscription on the background thread, the transactions
+        # committed since we last looked.
         self._pendingSubscriptionRecheck = None
 
         # fault injector to test this thing
         self._subscriptionBackgroundThreadCallback = None
         self._lazyLoadCallback = None
 
-        self._last_garbage_collect_timestamp = None
-
         self.identityProducer = IdentityProducer(self.allocateNewIdentityRoot())
 
         self._logger = logging.getLogger(__name__)
@@ -164,10 +587,24 @@ class Server:
         self._subscriptionResponseThread.daemon = True
         self._subscriptionResponseThread.start()
 
+        if self.groupCommitWindow is not None:
+            self._groupCommitThread = threading.Thread(target=self.serviceGroupCommits)
+            self._groupCommitThread.daemon = True
+            self._groupCommitThread.start()
+
+        self._gcThread = threading.Thread(target=self.serviceGarbageCollection)
+        self._gcThread.daemon = True
+        self._gcThread.start()
+
     def stop(self):
         self._shouldStop.set()
         self._subscriptionQueue.put((None, None))
         self._subscriptionResponseThread.join()
+        self._gcThread.join()
+
+        if self._groupCommitThread is not None:
+            self._groupCommitQueue.put((None, None))
+            self._groupCommitThread.join()
 
     def allocateNewIdentityRoot(self):
         with self._lock:
@@ -175,11 +612,11 @@ class Server:
             if curIdentityRoot is None:
                 curIdentityRoot = 0
             else:
-                curIdentityRoot = deserialize(int, bytes.fromhex(curIdentityRoot))
+                curIdentityRoot = deserialize(int, curIdentityRoot)
 
             result = curIdentityRoot
 
-            self._kvstore.set(" identityRoot", serialize(int, curIdentityRoot+1).hex())
+            self._kvstore.set(" identityRoot", serialize(int, curIdentityRoot+1))
 
             return result
 
@@ -195,6 +632,46 @@ class Server:
             except Exception:
                 self._logger.error("Unexpected error in serviceSubscription thread:\n%s", traceback.format_exc())
 
+    def serviceGroupCommits(self):
+        """Commit queued transactions in batches.
+
+        We take whatever arrives within 'groupCommitWindow' seconds of the first transaction
+        in a batch (up to MAX_GROUP_COMMIT_SIZE of them) and commit them together.
+        """
+        stopping = False
+
+        while not stopping:
+            request = self._groupCommitQueue.get()
+            if request[0] is None:
+                return
+
+            batch = [request]
+            deadline = time.time() + self.groupCommitWindow
+
+            while len(batch) < self.MAX_GROUP_COMMIT_SIZE:
+                try:
+                    request = self._groupCommitQueue.get(timeout=max(deadline - time.time(), 0.0))
+                except queue.Empty:
+                    break
+
+                if request[0] is None:
+                    stopping = True
+                    break
+
+                batch.append(request)
+
+            try:
+                self._completeTransactions(batch)
+            except Exception:
+                self._logger.error("Unexpected error in serviceGroupCommits thread:\n%s", traceback.format_exc())
+
+    def serviceGarbageCollection(self):
+        while not self._shouldStop.wait(self.gcPeriod):
+            try:
+                self._garbage_collect()
+            except Exception:
+                self._logger.error("Unexpected error in serviceGarbageCollection thread:\n%s", traceback.format_exc())
+
     def _removeOldDeadConnections(self):
         connection_index = keymapping.index_key(core_schema.Connection, " exists", True)
         oldIds = self._kvstore.getSetMembers(keymapping.index_key(core_schema.Connection, " exists", True))
@@ -207,6 +684,8 @@ class Server:
             )
 
     def checkForDeadConnections(self):
+        deadChannels = []
+
         with self._lock:
             heartbeatCount = {}
 
@@ -222,11 +701,14 @@ class Server:
                         self._clientChannels[c].connectionObject._identity
                     )
 
-                    c.close()
-                    self.dropConnection(c)
+                    deadChannels.append(c)
 
             self._logger.debug("Connection heartbeat distribution is %s", heartbeatCount)
 
+        for c in deadChannels:
+            c.close()
+            self.dropConnection(c)
+
     def dropConnection(self, channel):
         with self._lock:
             if channel not in self._clientChannels:
@@ -242,6 +724,7 @@ class Server:
                 self._index_to_channel[index_key].discard(connectedChannel)
                 if not self._index_to_channel[index_key]:
                     del self._index_to_channel[index_key]
+                    self._forgetIndexRange(index_key)
 
             for identity in connectedChannel.subscribedIds:
                 if identity in self._id_to_channel:
@@ -255,7 +738,10 @@ class Server:
 
             del self._clientChannels[channel]
 
-            self._dropConnectionEntry(co)
+        self._dropConnectionEntry(co)
+
+        for replicaConnection in list(connectedChannel.replicaConnections.values()):
+            self._dropConnectionEntry(replicaConnection)
 
     def _createConnectionEntry(self):
         identity = self.identityProducer.createIdentity()
@@ -265,7 +751,7 @@ class Server:
 
         self._handleNewTransaction(
             None,
-            {exists_key: serialize(bool, True).hex()},
+            {exists_key: serialize(bool, True)},
             {exists_index: set([identity])},
             {},
             [],
@@ -293,9 +779,9 @@ class Server:
 
     def addConnection(self, channel):
         try:
-            with self._lock:
-                connectionObject, identityRoot = self._createConnectionEntry()
+            connectionObject, identityRoot = self._createConnectionEntry()
 
+            with self._lock:
                 connectedChannel = ConnectedChannel(
                     self._cur_transaction_num,
                     channel,
@@ -317,6 +803,11 @@ class Server:
             )
 
     def _handleSubscriptionInForeground(self, channel, msg):
+        # must be called holding self._transactionNumLock and self._lock
+        self._waitForInFlightTransactions()
+
+        t0 = time.time()
+
         # first see if this would be an easy subscription to handle
         with Timer("Handle subscription in foreground: %s/%s/%s/isLazy=%s over %s",
                    msg.schema, msg.typename, msg.fieldname_and_value, msg.isLazy, lambda: len(identities)):
@@ -334,18 +825,16 @@ class Server:
                     identities,
                     channel
                 )
+                self._subscriptionComplete(t0)
                 return
 
-            self._sendPartialSubscription(
+            self._sendSubscriptionData(
                 channel,
                 msg.schema,
                 msg.typename,
                 msg.fieldname_and_value,
                 typedef,
-                identities,
-                set(identities),
-                BATCH_SIZE=None,
-                checkPending=False
+                identities
             )
 
             self._markSubscriptionComplete(
@@ -357,7 +846,7 @@ class Server:
                 isLazy=False
             )
 
-            channel.channel.write(
+            channel.write(
                 ServerToClient.SubscriptionComplete(
                     schema=msg.schema,
                     typename=msg.typename,
@@ -366,6 +855,99 @@ class Server:
                 )
             )
 
+            self._subscriptionComplete(t0)
+
+    def _subscriptionComplete(self, t0):
+        """Record a subscription that we started handling at 't0'."""
+        self.metrics.increment("subscriptions_total")
+        self.metrics.observe("subscription_seconds", time.time() - t0)
+
+    def _handleResume(self, connectedChannel, msg):
+        """Restore the subscriptions of a client that was connected until 'msg.transaction_id'
+        and send it the transactions it missed, if we still have all of them.
+
+        We only restore whole-type and identity subscriptions. The objects in an index can
+        change while the client is away, so it reissues its index subscriptions once we've
+        answered, and the missed transactions we send leave out objects that only those
+        subscriptions cover. Clients with projections never resume, since we don't know
+        them until they're sent again.
+
+        Must be called holding self._transactionNumLock and then self._lock.
+        """
+        self._waitForInFlightTransactions()
+
+        resumed = self._canResumeFrom(msg.server_guid, msg.transaction_id)
+
+        if resumed:
+            for schema_name, typename in msg.types:
+                self._markSubscriptionComplete(
+                    schema_name, typename, None, (), connectedChannel, isLazy=False
+                )
+
+            for identity in msg.identities:
+                identity = internIdentity(identity)
+                self._id_to_channel.setdefault(identity, set()).add(connectedChannel)
+                connectedChannel.subscribedIds.add(identity)
+
+            missed = [
+                self._transactionVisibleTo(connectedChannel, transactionMessage)
+                for transactionMessage in self._transactionHistory
+                if transactionMessage.transaction_id > msg.transaction_id
+            ]
+            missed = [m for m in missed if m.writes or m.set_adds or m.set_removes]
+
+            if missed:
+                connectedChannel.sendTransaction(coalesceTransactionMessages(missed))
+
+        connectedChannel.write(
+            ServerToClient.ResumeResult(transaction_id=self._cur_transaction_num, resumed=resumed)
+        )
+
+    def _canResumeFrom(self, server_guid, transaction_id):
+        if server_guid != self._serverGuid or transaction_id > self._cur_transaction_num:
+            return False
+
+        if transaction_id == self._cur_transaction_num:
+            return True
+
+        return bool(self._transactionHistory) and \
+            self._transactionHistory[0].transaction_id <= transaction_id + 1
+
+    def _transactionVisibleTo(self, connectedChannel, transactionMessage):
+        """The part of 'transactionMessage' covered by 'connectedChannel's subscriptions."""
+        subscribedIds = connectedChannel.subscribedIds
+
+        writes = {}
+        for schemaAndTypename, objects in transactionMessage.writes.items():
+            if tuple(schemaAndTypename) in connectedChannel.subscribedTypes:
+                writes[schemaAndTypename] = objects
+            else:
+                visible = {i: fields for i, fields in objects.items() if i in subscribedIds}
+                if visible:
+                    writes[schemaAndTypename] = visible
+
+        def visibleSetOps(setOps):
+            res = {}
+            for schemaAndTypename, indices in setOps.items():
+                if tuple(schemaAndTypename) in connectedChannel.subscribedTypes:
+                    res[schemaAndTypename] = indices
+                else:
+                    visible = {}
+                    for index, identities in indices.items():
+                        identities = [i for i in identities if i in subscribedIds]
+                        if identities:
+                            visible[index] = identities
+                    if visible:
+                        res[schemaAndTypename] = visible
+            return res
+
+        return ServerToClient.GroupedTransaction(
+            writes=writes,
+            set_adds=visibleSetOps(transactionMessage.set_adds),
+            set_removes=visibleSetOps(transactionMessage.set_removes),
+            transaction_id=transactionMessage.transaction_id
+        )
+
     def _parseSubscriptionMsg(self, channel, msg):
         schema_name = msg.schema
 
@@ -385,14 +967,82 @@ class Server:
         else:
             field, val = msg.fieldname_and_value
 
+        indexRange = keymapping.parse_index_range_token(val) if field != '_identity' else None
+
         if field == '_identity':
             identities = set([val])
+        elif indexRange is not None:
+            identities = set()
+            for valhash in self._indexValuesInRange(schema_name, typename, field, *indexRange):
+                identities.update(
+                    self._kvstore.getSetMembers(keymapping.index_key_from_names_encoded(schema_name, typename, field, valhash))
+                )
         else:
             identities = set(self._kvstore.getSetMembers(keymapping.index_key_from_names_encoded(schema_name, typename, field, val)))
 
         return typedef, identities
 
+    def _indexValuesInRange(self, schema_name, typename, fieldname, low_hash, high_hash):
+        """The value hashes of the ordered index 'fieldname' between 'low_hash' (inclusive) and
+        'high_hash' (exclusive), either of which may be None.
+
+        The first time we see an index, we load and sort its values from the kvstore, and
+        '_writeToKvstore' keeps them up to date from then on. Must be called with no
+        transactions in flight.
+        """
+        index_group = keymapping.index_group(schema_name, typename, fieldname)
+
+        with self._orderedIndexLock:
+            values = self._orderedIndexValues.get(index_group)
+
+            if values is None:
+                values = self._orderedIndexValues[index_group] = sorted(
+                    v for v in self._kvstore.getSetMembers(index_group) if keymapping.is_ordered_index_hash(v)
+                )
+
+            lowIx = 0 if low_hash is None else bisect.bisect_left(values, low_hash)
+            highIx = len(values) if high_hash is None else bisect.bisect_left(values, high_hash)
+
+            return values[lowIx:highIx]
+
+    def _subscribedIndexKeysFor(self, schema_name, typename, fieldname, valhash):
+        """The index keys of the subscriptions that objects with 'valhash' in index 'fieldname'
+        belong to: the index key itself, and the ranges that contain it."""
+        index_key = keymapping.index_key_from_names_encoded(schema_name, typename, fieldname, valhash)
+
+        res = [index_key] if index_key in self._index_to_channel else []
+
+        for range_key, (low_hash, high_hash) in self._index_ranges.get((schema_name, typename, fieldname), {}).items():
+            if keymapping.index_hash_in_range(valhash, low_hash, high_hash):
+                res.append(range_key)
+
+        return res
+
+    def _forgetIndexRange(self, index_key):
+        schema_name, typename, fieldname, valhash = keymapping.split_index_key_full(index_key)
+
+        ranges = self._index_ranges.get((schema_name, typename, fieldname))
+
+        if ranges is not None:
+            ranges.pop(index_key, None)
+            if not ranges:
+                del self._index_ranges[(schema_name, typename, fieldname)]
+
     def handleSubscriptionOnBackgroundThread(self, connectedChannel, msg):
+        """Send a subscription too large to send while holding our locks.
+
+        We find the identities in the subscription as of the current transaction, and then
+        stream them to the client in large chunks, reading from the kvstore without holding
+        self._lock, so commits proceed while we send. Every transaction committed in the
+        meantime lands in self._pendingSubscriptionRecheck, and we resend the objects it wrote
+        to or added to the subscribed index. Once few enough are left, we send the rest and
+        complete the subscription holding our locks, so the client sees a consistent state
+        from then on.
+        """
+        messageCount = 0
+        identities = ()
+        t0 = time.time()
+
         with Timer("Subscription requiring %s messages and produced %s objects for %s/%s/%s/isLazy=%s",
                    lambda: messageCount,
                    lambda: len(identities),
@@ -402,7 +1052,9 @@ class Server:
                    msg.isLazy
                    ):
             try:
-                with self._lock:
+                with self._transactionNumLock, self._lock:
+                    self._waitForInFlightTransactions()
+
                     typedef, identities = self._parseSubscriptionMsg(connectedChannel, msg)
 
                     if connectedChannel.channel not in self._clientChannels:
@@ -420,65 +1072,93 @@ class Server:
                             identities,
                             connectedChannel
                         )
+                        self._subscriptionComplete(t0)
                         return True
 
                     self._pendingSubscriptionRecheck = []
 
-                # we need to send everything we know about 'identities', keeping in mind that we have to
-                # check any new identities that get written to in the background to see if they belong
-                # in the new set
                 identities_left_to_send = set(identities)
 
-                messageCount = 0
-                while True:
-                    locktime_start = time.time()
+                # if objects keep changing faster than we can send them, stop chasing them
+                # and send whatever is left holding the lock.
+                maxChunks = len(identities) // self.SUBSCRIPTION_CHUNK_SIZE + 2
 
+                while True:
                     if self._subscriptionBackgroundThreadCallback:
                         self._subscriptionBackgroundThreadCallback(messageCount)
 
                     with self._lock:
-                        messageCount += 1
-                        if messageCount == 2:
-                            self._logger.info(
-                                "Beginning large subscription for %s/%s/%s",
-                                msg.schema, msg.typename, msg.fieldname_and_value
-                            )
-
-                        self._sendPartialSubscription(
-                            connectedChannel,
-                            msg.schema,
-                            msg.typename,
-                            msg.fieldname_and_value,
-                            typedef,
-                            identities,
-                            identities_left_to_send
+                        pending, self._pendingSubscriptionRecheck = self._pendingSubscriptionRecheck, []
+
+                    changed = self._identitiesChangedInSubscription(
+                        pending, msg.schema, msg.typename, msg.fieldname_and_value, identities
+                    )
+                    identities.update(changed)
+                    identities_left_to_send.update(changed)
+
+                    if len(identities_left_to_send) <= self.SUBSCRIPTION_CHUNK_SIZE or messageCount >= maxChunks:
+                        break
+
+                    messageCount += 1
+                    if messageCount == 2:
+                        self._logger.info(
+                            "Beginning large subscription for %s/%s/%s",
+                            msg.schema, msg.typename, msg.fieldname_and_value
                         )
 
-                        self._pendingSubscriptionRecheck = []
+                    to_send = [identities_left_to_send.pop() for _ in range(self.SUBSCRIPTION_CHUNK_SIZE)]
 
-                        if not identities_left_to_send:
-                            self._markSubscriptionComplete(
-                                msg.schema,
-                                msg.typename,
-                                msg.fieldname_and_value,
-                                identities,
-                                connectedChannel,
-                                isLazy=False
-                            )
+                    self._sendSubscriptionData(
+                        connectedChannel,
+                        msg.schema,
+                        msg.typename,
+                        msg.fieldname_and_value,
+                        typedef,
+                        to_send
+                    )
 
-                            connectedChannel.channel.write(
-                                ServerToClient.SubscriptionComplete(
-                                    schema=msg.schema,
-                                    typename=msg.typename,
-                                    fieldname_and_value=msg.fieldname_and_value,
-                                    tid=self._cur_transaction_num
-                                )
-                            )
+                    if connectedChannel.channel not in self._clientChannels:
+                        return
+
+                with self._transactionNumLock, self._lock:
+                    self._waitForInFlightTransactions()
 
-                            break
+                    changed = self._identitiesChangedInSubscription(
+                        self._pendingSubscriptionRecheck, msg.schema, msg.typename, msg.fieldname_and_value, identities
+                    )
+                    identities.update(changed)
+                    identities_left_to_send.update(changed)
 
-                    # don't hold the lock more than 75% of the time.
-                    time.sleep( (time.time() - locktime_start) / 3 )
+                    messageCount += 1
+
+                    self._sendSubscriptionData(
+                        connectedChannel,
+                        msg.schema,
+                        msg.typename,
+                        msg.fieldname_and_value,
+                        typedef,
+                        identities_left_to_send
+                    )
+
+                    self._markSubscriptionComplete(
+                        msg.schema,
+                        msg.typename,
+                        msg.fieldname_and_value,
+                        identities,
+                        connectedChannel,
+                        isLazy=False
+                    )
+
+                    connectedChannel.write(
+                        ServerToClient.SubscriptionComplete(
+                            schema=msg.schema,
+                            typename=msg.typename,
+                            fieldname_and_value=msg.fieldname_and_value,
+                            tid=self._cur_transaction_num
+                        )
+                    )
+
+                self._subscriptionComplete(t0)
 
                 if self._subscriptionBackgroundThreadCallback:
                     self._subscriptionBackgroundThreadCallback("DONE")
@@ -486,6 +1166,34 @@ class Server:
                 with self._lock:
                     self._pendingSubscriptionRecheck = None
 
+    def _identitiesChangedInSubscription(self, transactionMessages, schema_name, typename, fieldname_and_value, identities):
+        """The identities that 'transactionMessages' wrote to among 'identities', or added to
+        the index (or range) the subscription covers."""
+        if fieldname_and_value is None:
+            subscribedIndex = EXISTS_INDEX
+        else:
+            subscribedIndex = tuple(fieldname_and_value)
+
+        indexRange = keymapping.parse_index_range_token(subscribedIndex[1])
+
+        changed = set()
+
+        for transactionMessage in transactionMessages:
+            for identity in transactionMessage.writes.get((schema_name, typename), {}):
+                if identity in identities:
+                    changed.add(identity)
+
+            setAdds = transactionMessage.set_adds.get((schema_name, typename), {})
+
+            if indexRange is not None:
+                for (fieldname, valhash), addedToIndex in setAdds.items():
+                    if fieldname == subscribedIndex[0] and keymapping.index_hash_in_range(valhash, *indexRange):
+                        changed.update(addedToIndex)
+            else:
+                changed.update(setAdds.get(subscribedIndex, ()))
+
+        return changed
+
     def _completeLazySubscription(self,
                                   schema_name,
                                   typename,
@@ -496,7 +1204,7 @@ class Server:
                                   ):
         index_vals = self._buildIndexValueMap(typedef, schema_name, typename, identities)
 
-        connectedChannel.channel.write(
+        connectedChannel.write(
             ServerToClient.LazySubscriptionData(
                 schema=schema_name,
                 typename=typename,
@@ -516,7 +1224,7 @@ class Server:
             isLazy=True
         )
 
-        connectedChannel.channel.write(
+        connectedChannel.write(
             ServerToClient.SubscriptionComplete(
                 schema=schema_name,
                 typename=typename,
@@ -536,7 +1244,7 @@ class Server:
             vals = self._kvstore.getSeveral(keys)
 
             for i in range(len(keys)):
-                index_vals[keys[i]] = vals[i]
+                index_vals[keys[i]] = vals[i].decode("utf8") if vals[i] is not None else None
 
         return index_vals
 
@@ -544,6 +1252,7 @@ class Server:
         if fieldname_and_value is not None:
             # this is an index subscription
             for ident in identities:
+                ident = internIdentity(ident)
                 self._id_to_channel.setdefault(ident, set()).add(connectedChannel)
 
                 connectedChannel.subscribedIds.add(ident)
@@ -553,6 +1262,10 @@ class Server:
 
                 self._index_to_channel.setdefault(index_key, set()).add(connectedChannel)
 
+                indexRange = keymapping.parse_index_range_token(fieldname_and_value[1])
+                if indexRange is not None:
+                    self._index_ranges.setdefault((schema, typename, fieldname_and_value[0]), {})[index_key] = indexRange
+
                 connectedChannel.subscribedIndexKeys[index_key] = -1 if not isLazy else self._cur_transaction_num
             else:
                 # an object's identity cannot change, so we don't need to track our subscription to it
@@ -566,47 +1279,15 @@ class Server:
 
             connectedChannel.subscribedTypes[(schema, typename)] = -1 if not isLazy else self._cur_transaction_num
 
-    def _sendPartialSubscription(self,
-                                 connectedChannel,
-                                 schema_name,
-                                 typename,
-                                 fieldname_and_value,
-                                 typedef,
-                                 identities,
-                                 identities_left_to_send,
-                                 BATCH_SIZE=100,
-                                 checkPending=True):
-
-        # get some objects to send
-        kvs = {}
-        index_vals = {}
-
-        to_send = []
-        if checkPending:
-            for transactionMessage in self._pendingSubscriptionRecheck:
-                for key in transactionMessage.writes:
-                    transactionMessage.writes[key]
-
-                    # if we write to a key we've already sent, we'll need to resend it
-                    identity = keymapping.split_data_key(key)[2]
-                    if identity in identities:
-                        identities_left_to_send.add(identity)
-
-                for add_index_key in transactionMessage.set_adds:
-                    add_index_identities = transactionMessage.set_adds[add_index_key]
+    def _sendSubscriptionData(self, connectedChannel, schema_name, typename, fieldname_and_value, typedef, to_send):
+        """Send the current values of the objects 'to_send' in a subscription.
 
-                    add_schema, add_typename, add_fieldname, add_hashVal = keymapping.split_index_key_full(add_index_key)
-
-                    if add_schema == schema_name and add_typename == typename and (
-                            fieldname_and_value is None and add_fieldname == " exists" or
-                            fieldname_and_value is not None and tuple(fieldname_and_value) == (add_fieldname, add_hashVal)
-                    ):
-                        identities_left_to_send.update(add_index_identities)
-
-        while identities_left_to_send and (BATCH_SIZE is None or len(to_send) < BATCH_SIZE):
-            to_send.append(identities_left_to_send.pop())
+        Reads go straight to the kvstore, so this doesn't need self._lock.
+        """
+        to_send = list(to_send)
+        kvs = {}
 
-        for fieldname in typedef.fields:
+        for fieldname in connectedChannel.fieldsToSend(schema_name, typename):
             keys = [keymapping.data_key_from_names(schema_name, typename, identity, fieldname)
                     for identity in to_send]
 
@@ -617,7 +1298,7 @@ class Server:
 
         index_vals = self._buildIndexValueMap(typedef, schema_name, typename, to_send)
 
-        connectedChannel.channel.write(
+        connectedChannel.write(
             ServerToClient.SubscriptionData(
                 schema=schema_name,
                 typename=typename,
@@ -649,6 +1330,31 @@ class Server:
         # Handle remaining types of messages
         if msg.matches.Heartbeat:
             connectedChannel.heartbeat()
+        elif msg.matches.ProtocolVersion:
+            connectedChannel.negotiateProtocolVersion(msg.version)
+
+            if connectedChannel.protocolVersion >= RESUMABLE_PROTOCOL_VERSION:
+                connectedChannel.write(ServerToClient.ServerInstance(guid=self._serverGuid))
+        elif msg.matches.Resume:
+            with self._transactionNumLock, self._lock:
+                self._handleResume(connectedChannel, msg)
+        elif msg.matches.CreateReplicaConnection:
+            connectionObject, identityRoot = self._createConnectionEntry()
+
+            connectedChannel.replicaConnections[connectionObject._identity] = connectionObject
+
+            connectedChannel.write(
+                ServerToClient.ReplicaConnection(
+                    guid=msg.guid,
+                    connIdentity=connectionObject._identity,
+                    identity_root=identityRoot
+                )
+            )
+        elif msg.matches.DropReplicaConnection:
+            connectionObject = connectedChannel.replicaConnections.pop(msg.connIdentity, None)
+
+            if connectionObject is not None:
+                self._dropConnectionEntry(connectionObject)
         elif msg.matches.LoadLazyObject:
             with self._lock:
                 self._loadLazyObject(connectedChannel, msg)
@@ -657,73 +1363,114 @@ class Server:
                 self._lazyLoadCallback(msg.identity)
 
         elif msg.matches.Flush:
-            with self._lock:
-                connectedChannel.channel.write(ServerToClient.FlushResponse(guid=msg.guid))
+            if self._groupCommitThread is not None:
+                # don't let the flush overtake transactions that are still waiting to commit
+                self._groupCommitQueue.put((connectedChannel, msg))
+            else:
+                with self._lock:
+                    connectedChannel.write(ServerToClient.FlushResponse(guid=msg.guid))
         elif msg.matches.DefineSchema:
             assert isinstance(msg.definition, SchemaDefinition)
             connectedChannel.definedSchemas[msg.name] = msg.definition
-        elif msg.matches.Subscribe:
+        elif msg.matches.ProjectFields:
             with self._lock:
+                connectedChannel.projectFields(msg.schema, msg.typename, msg.fields)
+        elif msg.matches.GetStats:
+            connectedChannel.write(
+                ServerToClient.Stats(guid=msg.guid, samples=flattenSamples(self.metricFamilies()))
+            )
+        elif msg.matches.Subscribe:
+            with self._transactionNumLock, self._lock:
                 self._handleSubscriptionInForeground(connectedChannel, msg)
-        elif msg.matches.TransactionData:
+        elif msg.matches.TransactionData or msg.matches.GroupedTransactionData or msg.matches.TransactionDeltas:
             connectedChannel.handleTransactionData(msg)
         elif msg.matches.CompleteTransaction:
-            try:
-                data = connectedChannel.extractTransactionData(msg.transaction_guid)
+            if self._groupCommitThread is not None:
+                self._groupCommitQueue.put((connectedChannel, msg))
+            else:
+                self._completeTransactions([(connectedChannel, msg)])
 
-                with self._lock:
-                    isOK, badKey = self._handleNewTransaction(
+    def _completeTransactions(self, requests):
+        """Commit a sequence of (connectedChannel, msg) CompleteTransaction requests as one batch
+        and tell each client how it went.
+
+        Flush messages in 'requests' are answered once the batch has been broadcast.
+        """
+        pending = []
+
+        for connectedChannel, msg in requests:
+            transaction = None
+
+            if msg.matches.CompleteTransaction:
+                try:
+                    data = connectedChannel.extractTransactionData(msg.transaction_guid)
+
+                    transaction = PendingTransaction(
                         connectedChannel,
                         data['writes'],
                         data['set_adds'],
                         data['set_removes'],
                         data['key_versions'],
                         data['index_versions'],
-                        msg.as_of_version
+                        msg.as_of_version,
+                        data['deltas']
                     )
+                except Exception:
+                    self._logger.error("Unknown error committing transaction: %s", traceback.format_exc())
+
+            pending.append((connectedChannel, msg, transaction))
+
+        transactions = [transaction for _, _, transaction in pending if transaction is not None]
+
+        if transactions:
+            try:
+                self._handleNewTransactions(transactions)
             except Exception:
                 self._logger.error("Unknown error committing transaction: %s", traceback.format_exc())
-                isOK = False
-                badKey = "<NONE>"
 
-            connectedChannel.sendTransactionSuccess(msg.transaction_guid, isOK, badKey)
+                for transaction in transactions:
+                    transaction.result = (False, "<NONE>")
+
+        for connectedChannel, msg, transaction in pending:
+            if msg.matches.Flush:
+                with self._lock:
+                    connectedChannel.write(ServerToClient.FlushResponse(guid=msg.guid))
+            else:
+                isOK, badKey = transaction.result if transaction is not None else (False, "<NONE>")
+
+                connectedChannel.sendTransactionSuccess(msg.transaction_guid, isOK, badKey)
 
     def indexReverseLookupKvs(self, adds, removes):
+        """The reverse-index writes for grouped index changes 'adds' and 'removes'."""
         res = {}
 
-        for indexKey, identities in removes.items():
-            schemaname, typename, fieldname, valuehash = keymapping.split_index_key_full(indexKey)
-
-            for ident in identities:
-                res[keymapping.data_reverse_index_key(schemaname, typename, ident, fieldname)] = None
+        for (schemaname, typename), indices in removes.items():
+            for (fieldname, valuehash), identities in indices.items():
+                for ident in identities:
+                    res[keymapping.data_reverse_index_key(schemaname, typename, ident, fieldname)] = None
 
-        for indexKey, identities in adds.items():
-            schemaname, typename, fieldname, valuehash = keymapping.split_index_key_full(indexKey)
+        for (schemaname, typename), indices in adds.items():
+            for (fieldname, valuehash), identities in indices.items():
+                encoded = valuehash.encode("utf8")
 
-            for ident in identities:
-                res[keymapping.data_reverse_index_key(schemaname, typename, ident, fieldname)] = valuehash
+                for ident in identities:
+                    res[keymapping.data_reverse_index_key(schemaname, typename, ident, fieldname)] = encoded
 
         return res
 
-    def _broadcastSubscriptionIncrease(self, channel, indexKey, newIds):
-        newIds = list(newIds)
-
-        schema_name, typename, fieldname, fieldval = keymapping.split_index_key_full(indexKey)
-
-        channel.channel.write(
+    def _broadcastSubscriptionIncrease(self, channel, schema_name, typename, fieldname_and_value, newIds):
+        channel.write(
             ServerToClient.SubscriptionIncrease(
                 schema=schema_name,
                 typename=typename,
-                fieldname_and_value=(fieldname, fieldval),
-                identities=newIds
+                fieldname_and_value=fieldname_and_value,
+                identities=list(newIds)
             )
         )
 
     def _loadValuesForObject(self, channel, schema_name, typename, identities):
-        typedef = channel.definedSchemas.get(schema_name)[typename]
-
         valsToGet = []
-        for field_to_pull in typedef.fields:
+        for field_to_pull in channel.fieldsToSend(schema_name, typename):
             for ident in identities:
                 valsToGet.append(keymapping.data_key_from_names(schema_name, typename, ident, field_to_pull))
 
@@ -731,62 +1478,224 @@ class Server:
 
         return {valsToGet[i]: results[i] for i in range(len(valsToGet))}
 
-    def _increaseBroadcastTransactionToInclude(self, channel, indexKey, newIds, key_value, set_adds, set_removes):
+    def _increaseBroadcastTransactionToInclude(self, channel, schema_name, typename, newIds, transaction):
         # we need to include all the data for the objects in 'newIds' to the transaction
         # that we're broadcasting
-        schema_name, typename, fieldname, fieldval = keymapping.split_index_key_full(indexKey)
-
         typedef = channel.definedSchemas.get(schema_name)[typename]
 
-        key_value.update(self._loadValuesForObject(channel, schema_name, typename, newIds))
+        groupWrites = transaction.writes.setdefault((schema_name, typename), {})
+
+        objectFields = [(ident, fieldname) for fieldname in typedef.fields for ident in newIds]
+
+        values = self._readAsOf(
+            [keymapping.data_key_from_names(schema_name, typename, ident, fieldname)
+             for ident, fieldname in objectFields],
+            transaction.transaction_id
+        )
+
+        for (ident, fieldname), value in zip(objectFields, values):
+            groupWrites.setdefault(ident, {})[fieldname] = value
+
+        # channels seeing these objects for the first time have nothing to apply deltas to
+        for ident in newIds:
+            transaction.dropDelta(schema_name, typename, ident)
 
         reverseKeys = []
         for index_name in typedef.indices:
             for ident in newIds:
                 reverseKeys.append(keymapping.data_reverse_index_key(schema_name, typename, ident, index_name))
 
-        reverseVals = self._kvstore.getSeveral(reverseKeys)
+        reverseVals = self._readAsOf(reverseKeys, transaction.transaction_id)
         reverseKVMap = {reverseKeys[i]: reverseVals[i] for i in range(len(reverseKeys))}
 
+        groupSetAdds = transaction.set_adds.setdefault((schema_name, typename), {})
+
         for index_name in typedef.indices:
             for ident in newIds:
                 fieldval = reverseKVMap.get(keymapping.data_reverse_index_key(schema_name, typename, ident, index_name))
 
                 if fieldval is not None:
-                    ik = keymapping.index_key_from_names_encoded(schema_name, typename, index_name, fieldval)
-                    set_adds.setdefault(ik, set()).add(ident)
+                    groupSetAdds.setdefault((index_name, fieldval.decode("utf8")), set()).add(ident)
+
+    def _readAsOf(self, keys, transaction_id):
+        """The values of 'keys' as they stood just after transaction 'transaction_id'.
+
+        Later transactions may already be in the kvstore, but until they're broadcast we
+        know what each key they wrote held before they did. We read the kvstore before
+        looking at those, since a transaction records them before it writes.
+        """
+        values = self._kvstore.getSeveral(keys)
+
+        with self._unbroadcastLock:
+            later = [self._unbroadcastPriorValues[tid] for tid in sorted(self._unbroadcastPriorValues)
+                     if tid > transaction_id]
+
+            if not later:
+                return values
+
+            res = []
+            for key, value in zip(keys, values):
+                for priors in later:
+                    if key in priors:
+                        value = priors[key]
+                        break
+                res.append(value)
+
+            return res
+
+    def _forgetPriorValues(self, transactions):
+        with self._unbroadcastLock:
+            for transaction in transactions:
+                self._unbroadcastPriorValues.pop(transaction.transaction_id, None)
 
     def _loadLazyObject(self, channel, msg):
-        channel.channel.write(
+        channel.write(
             ServerToClient.LazyLoadResponse(
                 identity=msg.identity,
                 values=self._loadValuesForObject(channel, msg.schema, msg.typename, [msg.identity])
             )
         )
 
+    def versionNumberCount(self):
+        """The number of keys for which we're tracking a last-committed version number."""
+        return sum(len(shard.version_numbers) for shard in self._version_number_shards)
+
+    def metricFamilies(self):
+        """Our metrics, as families of samples (see server_metrics)."""
+        with self._lock:
+            channels = list(self._clientChannels.values())
+            transactionId = self._cur_transaction_num
+
+        families = self.metrics.families()
+
+        families.append(gauge("transaction_id", "The id of the last transaction broadcast.", transactionId))
+        families.append(gauge("connections", "Connected channels.", len(channels)))
+        families.append(gauge(
+            "version_numbers", "Keys whose last-committed version number we're tracking.", self.versionNumberCount()
+        ))
+
+        messages = []
+        byteCounts = []
+
+        for connectedChannel in channels:
+            if connectedChannel.connectionObject is None:
+                # a replica's client whose Connection the primary hasn't made yet
+                continue
+
+            labels = {"connection": connectedChannel.connectionObject._identity}
+
+            messages.append((METRIC_PREFIX + "channel_outbound_messages_total", labels,
+                             connectedChannel.channel.messagesWritten))
+
+            bytesWritten = getattr(connectedChannel.channel, "bytesWritten", None)
+            if bytesWritten is not None:
+                byteCounts.append((METRIC_PREFIX + "channel_outbound_bytes_total", labels, bytesWritten))
+
+        families.append((METRIC_PREFIX + "channel_outbound_messages_total", "counter",
+                         "Messages sent to each channel.", messages))
+        families.append((METRIC_PREFIX + "channel_outbound_bytes_total", "counter",
+                         "Bytes sent to each channel, for channels that serialize their messages.", byteCounts))
+
+        return families
+
+    def prometheusStats(self):
+        """Our metrics in the Prometheus text format."""
+        return formatPrometheus(self.metricFamilies())
+
+    def _shardIndexFor(self, key):
+        return zlib.crc32(key.encode("utf8")) % len(self._version_number_shards)
+
+    def _shardFor(self, key):
+        return self._version_number_shards[self._shardIndexFor(key)]
+
+    def _shardsFor(self, keys):
+        """The shards covering 'keys', in the order in which their locks must be acquired."""
+        indices = set(self._shardIndexFor(key) for key in keys)
+
+        return [self._version_number_shards[i] for i in sorted(indices)]
+
     def _garbage_collect(self, intervalOverride=None):
-        """Cleanup anything in '_version_numbers' where we have deleted the entry
-        and it's inactive for a long time."""
-        interval = intervalOverride or self._gc_interval
-
-        if self._last_garbage_collect_timestamp is None or time.time() - self._last_garbage_collect_timestamp > interval:
-            threshold = time.time() - interval
-
-            new_ts = {}
-            for key, ts in self._version_numbers_timestamps.items():
-                if ts < threshold:
-                    if keymapping.isIndexKey(key):
-                        if not self._kvstore.getSetMembers(key):
-                            del self._version_numbers[key]
-                    else:
-                        if self._kvstore.get(key) is None:
-                            del self._version_numbers[key]
-                else:
-                    new_ts[key] = ts
+        """Forget the version numbers of keys that have been empty, with nothing committed
+        to them, for 'intervalOverride' (or '_gc_interval') seconds.
+
+        Shards keep their keys in the order we last committed to them, so we only look at
+        the stale ones. We take them GC_SLICE_SIZE at a time, and only hold a shard's lock
+        while we take them and while we drop the ones the kvstore says are empty, so a
+        commit never waits for more than a slice. A key somebody commits to while we're
+        looking at it goes back into 'timestamps', and keeps its version number.
+
+        Keys that aren't empty keep their version numbers until they're committed to again.
+
+        Returns the number of version numbers we dropped.
+        """
+        threshold = time.time() - (intervalOverride or self._gc_interval)
+        reclaimed = 0
+
+        with self._gcLock:
+            for shard in self._version_number_shards:
+                while True:
+                    with shard.lock:
+                        t0 = time.time()
+                        stale = shard.popStale(threshold, self.GC_SLICE_SIZE)
+                        self.metrics.observe("gc_pause_seconds", time.time() - t0)
+
+                    if not stale:
+                        break
+
+                    dataKeys = [key for key in stale if not keymapping.isIndexKey(key)]
+
+                    empty = [key for key, value in zip(dataKeys, self._kvstore.getSeveral(dataKeys)) if value is None]
+                    empty.extend(
+                        key for key in stale if keymapping.isIndexKey(key) and not self._kvstore.getSetMembers(key)
+                    )
+
+                    with shard.lock:
+                        t0 = time.time()
+                        empty = [key for key in empty if key not in shard.timestamps]
+
+                        for key in empty:
+                            del shard.version_numbers[key]
 
-            self._version_numbers_timestamps = new_ts
+                        self.metrics.observe("gc_pause_seconds", time.time() - t0)
 
-            self._last_garbage_collect_timestamp = time.time()
+                    reclaimed += len(empty)
+                    self.metrics.increment("gc_keys_examined_total", len(stale))
+                    self.metrics.increment("gc_keys_reclaimed_total", len(empty))
+
+                    if len(stale) < self.GC_SLICE_SIZE:
+                        break
+
+        return reclaimed
+
+    def _allocateTransactionNums(self, count):
+        """Allocate 'count' consecutive transaction ids and return the first one."""
+        with self._transactionNumLock:
+            first = self._last_allocated_transaction_num + 1
+            self._last_allocated_transaction_num += count
+            return first
+
+    def _waitForBroadcastTurn(self, transaction_id):
+        """Block until every transaction before 'transaction_id' has been broadcast.
+
+        Must be called holding self._lock.
+        """
+        while self._cur_transaction_num != transaction_id - 1:
+            self._broadcastTurn.wait()
+
+    def _finishBroadcastTurn(self, transaction_id):
+        self._cur_transaction_num = transaction_id
+        self._broadcastTurn.notify_all()
+
+    def _waitForInFlightTransactions(self):
+        """Block until every transaction we've handed out an id to has been broadcast,
+        so that the kvstore matches '_cur_transaction_num'.
+
+        Must be called holding self._transactionNumLock, which prevents new transactions
+        from starting while we read, and then self._lock. Nothing may acquire them in
+        the opposite order, since we release self._lock while we wait.
+        """
+        while self._cur_transaction_num != self._last_allocated_transaction_num:
+            self._broadcastTurn.wait()
 
     def _handleNewTransaction(self,
                               sourceChannel,
@@ -807,76 +1716,210 @@ class Server:
             db_key -> set of identities added to an index
         set_removes: a map:
             db_key -> set of identities removed from an index
+
+        Returns a pair (isOK, badKey). Callers must not hold self._lock.
         """
-        self._cur_transaction_num += 1
-        transaction_id = self._cur_transaction_num
-        assert transaction_id > as_of_version
+        transaction = PendingTransaction.fromKeys(
+            sourceChannel,
+            key_value,
+            set_adds,
+            set_removes,
+            keys_to_check_versions,
+            indices_to_check_versions,
+            as_of_version
+        )
 
+        self._handleNewTransactions([transaction])
+
+        return transaction.result
+
+    def _handleNewTransactions(self, transactions):
+        """Commit a batch of PendingTransactions in order, filling out each one's 'result'.
+
+        Commits happen in two stages. First, holding only the version-number shard locks
+        for the keys involved, we check for conflicts, allocate transaction ids, and write
+        to the kvstore. Batches that touch disjoint keys can do this concurrently.
+        Then, holding self._lock, we wait for every earlier transaction id to be broadcast
+        and broadcast ours, so clients always see transactions in id order. Later
+        transactions may be in the kvstore by then, so anything a broadcast reads from it
+        goes through '_readAsOf'.
+
+        Each transaction is checked against the transactions ahead of it in the batch as
+        well as against what's already committed. The ones that succeed get consecutive
+        ids and go to the kvstore in a single write, and each channel gets one message
+        covering all of the ones it needs to hear about.
+
+        Callers must not hold self._lock.
+        """
         t0 = time.time()
 
-        set_adds = {k: v for k, v in set_adds.items() if v}
-        set_removes = {k: v for k, v in set_removes.items() if v}
+        shards = self._shardsFor(set().union(*[t.keysTouched() for t in transactions]))
 
-        identities_mentioned = set()
+        committed = []
 
-        keysWritingTo = set()
-        setsWritingTo = set()
-        schemaTypePairsWriting = set()
+        for shard in shards:
+            shard.lock.acquire()
 
-        if sourceChannel:
-            # check if we created any new objects to which we are not type-subscribed
-            # and if so, ensure we are subscribed
-            for add_index, added_identities in set_adds.items():
-                schema_name, typename, fieldname, fieldval = keymapping.split_index_key_full(add_index)
-                if fieldname == ' exists':
-                    if (schema_name, typename) not in sourceChannel.subscribedTypes:
-                        sourceChannel.subscribedIds.update(added_identities)
-                        for new_id in added_identities:
-                            self._id_to_channel.setdefault(new_id, set()).add(sourceChannel)
-                        self._broadcastSubscriptionIncrease(sourceChannel, add_index, added_identities)
+        tLocked = time.time()
+        self.metrics.observe("commit_shard_lock_wait_seconds", tLocked - t0)
+
+        try:
+            writtenInBatch = set()
 
-        for key in key_value:
-            keysWritingTo.add(key)
+            for transaction in transactions:
+                badKey = self._findConflict(transaction, writtenInBatch)
 
-            schema_name, typename, ident = keymapping.split_data_key(key)[:3]
-            schemaTypePairsWriting.add((schema_name, typename))
+                if badKey is not None:
+                    transaction.result = (False, badKey)
+                else:
+                    transaction.result = (True, None)
+                    committed.append(transaction)
+
+                    writtenInBatch.update(transaction.keysWritingTo)
+                    writtenInBatch.update(transaction.setsWritingTo)
 
-            identities_mentioned.add(ident)
+            self.metrics.observe("commit_validate_seconds", time.time() - tLocked)
+            self.metrics.increment("transaction_conflicts_total", len(transactions) - len(committed))
 
-        for subset in [set_adds, set_removes]:
-            for k in subset:
-                if subset[k]:
-                    schema_name, typename = keymapping.split_index_key(k)[:2]
+            if not committed:
+                return
 
-                    schemaTypePairsWriting.add((schema_name, typename))
+            first_transaction_id = self._allocateTransactionNums(len(committed))
+            last_transaction_id = first_transaction_id + len(committed) - 1
 
-                    setsWritingTo.add(k)
+            try:
+                t1 = time.time()
 
-                    identities_mentioned.update(subset[k])
+                for offset, transaction in enumerate(committed):
+                    transaction.transaction_id = first_transaction_id + offset
+                    assert transaction.transaction_id > transaction.as_of_version
+
+                    for key in transaction.keysWritingTo | transaction.setsWritingTo:
+                        shard = self._shardFor(key)
+                        shard.version_numbers[key] = transaction.transaction_id
+                        shard.touch(key, t1)
+
+                self._persistTransactions(committed)
+            except Exception:
+                self._forgetPriorValues(committed)
+
+                # nobody else can broadcast until we've taken our turn
+                with self._lock:
+                    self._waitForBroadcastTurn(first_transaction_id)
+                    self._finishBroadcastTurn(last_transaction_id)
+                raise
+        finally:
+            for shard in shards:
+                shard.lock.release()
+
+        t2 = time.time()
+
+        with self._lock:
+            self.metrics.observe("commit_server_lock_wait_seconds", time.time() - t2)
 
-        # check all version numbers for transaction conflicts.
-        for subset in [keys_to_check_versions, indices_to_check_versions]:
+            self._waitForBroadcastTurn(first_transaction_id)
+
+            try:
+                self._broadcastTransactions(committed)
+            finally:
+                self._forgetPriorValues(committed)
+                self._finishBroadcastTurn(last_transaction_id)
+
+        writeCount = sum(len(t.key_value) for t in committed)
+        setOpCount = sum(len(t.index_adds) + len(t.index_removes) for t in committed)
+
+        self.metrics.observe("commit_persist_seconds", t2 - t1)
+        self.metrics.observe("commit_broadcast_seconds", time.time() - t2)
+        self.metrics.increment("transactions_total", len(committed))
+        self.metrics.increment("keys_set_total", writeCount)
+        self.metrics.increment("index_values_updated_total", setOpCount)
+
+        if self.verbose or time.time() - t0 > self.longTransactionThreshold:
+            self._logger.info(
+                "%s transactions [%.2f/%.2f/%.2f] with %s writes, %s set ops: %s",
+                len(committed), t1 - t0, t2 - t1, time.time() - t2,
+                writeCount, setOpCount, sorted(committed[0].key_value)[:3]
+            )
+
+    def _findConflict(self, transaction, writtenInBatch):
+        """Return a key that 'transaction' depends on and that has changed since it was
+        read, or None if there isn't one.
+
+        Must be called holding the shard locks for every key 'transaction' touches.
+        """
+        for subset in [transaction.keys_to_check_versions, transaction.indices_to_check_versions]:
             for key in subset:
-                last_tid = self._version_numbers.get(key, -1)
-                if as_of_version < last_tid:
-                    return (False, key)
+                if key in writtenInBatch:
+                    return key
+
+                last_tid = self._shardFor(key).version_numbers.get(key, -1)
+                if transaction.as_of_version < last_tid:
+                    return key
+
+        return None
+
+    def _persistTransactions(self, transactions):
+        """Write a batch of transactions to the kvstore, recording the values each one
+        overwrote in its 'priorValues', and in '_unbroadcastPriorValues' along with the
+        reverse-index values it overwrote.
+
+        Must be called holding the shard locks for every key in the batch.
+        """
+        reverseKvs = [self.indexReverseLookupKvs(t.set_adds, t.set_removes) for t in transactions]
+
+        currentValues = self._kvstore.getSeveralAsDictionary(
+            set().union(*[t.keysWritingTo for t in transactions], *reverseKvs)
+        )
+
+        target_kvs = {}
+        set_adds = {}
+        set_removes = {}
+
+        unbroadcastPriorValues = {}
+
+        for transaction, transactionReverseKvs in zip(transactions, reverseKvs):
+            transaction.applyDeltas(currentValues)
+
+            transaction.priorValues = {k: currentValues[k] for k in transaction.key_value}
+
+            unbroadcastPriorValues[transaction.transaction_id] = dict(transaction.priorValues)
+            unbroadcastPriorValues[transaction.transaction_id].update(
+                (k, currentValues[k]) for k in transactionReverseKvs
+            )
 
-        t1 = time.time()
+            currentValues.update(transaction.key_value)
+            currentValues.update(transactionReverseKvs)
 
-        for key in keysWritingTo:
-            self._version_numbers[key] = transaction_id
-            self._version_numbers_timestamps[key] = t1
+            # set the json representation in the database
+            target_kvs.update(transaction.key_value)
+            target_kvs.update(transactionReverseKvs)
 
-        for key in setsWritingTo:
-            self._version_numbers[key] = transaction_id
-            self._version_numbers_timestamps[key] = t1
+            # an identity added and then removed within the batch (or vice versa) leaves
+            # the set as we found it
+            for index_key, identities in transaction.index_adds.items():
+                for identity in identities:
+                    if identity in set_removes.get(index_key, ()):
+                        set_removes[index_key].discard(identity)
+                    else:
+                        set_adds.setdefault(index_key, set()).add(identity)
 
-        priorValues = self._kvstore.getSeveralAsDictionary(key_value)
+            for index_key, identities in transaction.index_removes.items():
+                for identity in identities:
+                    if identity in set_adds.get(index_key, ()):
+                        set_adds[index_key].discard(identity)
+                    else:
+                        set_removes.setdefault(index_key, set()).add(identity)
 
-        # set the json representation in the database
-        target_kvs = {k: v for k, v in key_value.items()}
-        target_kvs.update(self.indexReverseLookupKvs(set_adds, set_removes))
+        set_adds = {k: v for k, v in set_adds.items() if v}
+        set_removes = {k: v for k, v in set_removes.items() if v}
 
+        with self._unbroadcastLock:
+            self._unbroadcastPriorValues.update(unbroadcastPriorValues)
+
+        self._writeToKvstore(target_kvs, set_adds, set_removes)
+
+    def _writeToKvstore(self, target_kvs, set_adds, set_removes):
+        """Write values and index changes to the kvstore, keeping its index metadata up to date."""
         new_sets, dropped_sets = self._kvstore.setSeveral(target_kvs, set_adds, set_removes)
 
         # update the metadata index
@@ -896,32 +1939,155 @@ class Server:
 
         self._kvstore.setSeveral({}, indexSetAdds, indexSetRemoves)
 
-        t2 = time.time()
+        with self._orderedIndexLock:
+            for index_group, index_vals in indexSetAdds.items():
+                values = self._orderedIndexValues.get(index_group)
+                if values is not None:
+                    for index_val in index_vals:
+                        ix = bisect.bisect_left(values, index_val)
+                        if ix == len(values) or values[ix] != index_val:
+                            values.insert(ix, index_val)
+
+            for index_group, index_vals in indexSetRemoves.items():
+                values = self._orderedIndexValues.get(index_group)
+                if values is not None:
+                    for index_val in index_vals:
+                        ix = bisect.bisect_left(values, index_val)
+                        if ix < len(values) and values[ix] == index_val:
+                            del values[ix]
+
+    def _broadcastTransactions(self, transactions):
+        """Send a batch of committed transactions to every channel subscribed to what they touched.
+
+        Each channel gets a single GroupedTransaction message covering the transactions it needs.
+        Must be called holding self._lock, in transaction id order.
+        """
+        transactionMessages = []
+
+        # channel -> indices in 'transactionMessages' of the transactions it needs
+        channelTransactions = {}
+
+        for transaction in transactions:
+            for channel in self._routeTransaction(transaction):
+                channelTransactions.setdefault(channel, []).append(len(transactionMessages))
+
+            transactionMessages.append(
+                ServerToClient.GroupedTransaction(
+                    writes=transaction.writes,
+                    set_adds=transaction.set_adds,
+                    set_removes=transaction.set_removes,
+                    transaction_id=transaction.transaction_id
+                )
+            )
+
+        if self._pendingSubscriptionRecheck is not None:
+            self._pendingSubscriptionRecheck.extend(transactionMessages)
+
+        self._transactionHistory.extend(transactionMessages)
+        while len(self._transactionHistory) > self.transactionHistorySize:
+            self._transactionHistory.popleft()
+
+        # channels that need the same transactions (and fields) share a message, and its
+        # legacy encodings
+        coalescedMessages = {}
+
+        for channel, which in channelTransactions.items():
+            which = tuple(which)
+
+            if which not in coalescedMessages:
+                coalescedMessages[which] = (
+                    coalesceTransactionMessages([transactionMessages[i] for i in which]),
+                    {}
+                )
+
+            if channel.protocolVersion >= DELTA_WRITES_PROTOCOL_VERSION and \
+                    any(transactions[i].deltas for i in which):
+                deltaKey = (which, "deltas")
+
+                if deltaKey not in coalescedMessages:
+                    coalescedMessages[deltaKey] = (
+                        deltaTransactionMessage(
+                            coalescedMessages[which][0],
+                            [transactions[i] for i in which]
+                        ),
+                        {}
+                    )
+
+                which = deltaKey
+
+            if channel.projections:
+                projectedKey = (which, frozenset(channel.projections.items()))
+
+                if projectedKey not in coalescedMessages:
+                    coalescedMessages[projectedKey] = (
+                        channel.project(coalescedMessages[which][0]),
+                        {}
+                    )
+
+                which = projectedKey
+
+            transaction_message, messageCache = coalescedMessages[which]
+
+            channel.sendTransaction(transaction_message, messageCache)
+
+    def _subscribeToCreatedObjects(self, channel, schema_name, typename, added_identities):
+        """Make sure 'channel', which created the objects 'added_identities', hears about them."""
+        if (schema_name, typename) not in channel.subscribedTypes:
+            channel.subscribedIds.update(added_identities)
+            for new_id in added_identities:
+                self._id_to_channel.setdefault(new_id, set()).add(channel)
+            self._broadcastSubscriptionIncrease(
+                channel, schema_name, typename, EXISTS_INDEX, added_identities
+            )
+
+    def _routeTransaction(self, transaction):
+        """Update subscriptions for a committed transaction and return the set of channels
+        that need to hear about it.
+
+        This may add the backing data for objects that newly match a channel's index
+        subscriptions to 'transaction'. Must be called holding self._lock.
+        """
+        sourceChannel = transaction.sourceChannel
+
+        if sourceChannel:
+            # check if we created any new objects to which we are not type-subscribed
+            # and if so, ensure we are subscribed
+            for (schema_name, typename), indices in transaction.set_adds.items():
+                if EXISTS_INDEX in indices:
+                    self._subscribeToCreatedObjects(
+                        sourceChannel, schema_name, typename, indices[EXISTS_INDEX]
+                    )
 
         channelsTriggeredForPriors = set()
 
         # check any index-level subscriptions that are going to increase as a result of this
         # transaction and add the backing data to the relevant transaction.
-        for index_key, adds in list(set_adds.items()):
-            if index_key in self._index_to_channel:
+        for (schema_name, typename), indices in list(transaction.set_adds.items()):
+            for (fieldname, valhash), adds in list(indices.items()):
+                subscribedIndexKeys = self._subscribedIndexKeysFor(schema_name, typename, fieldname, valhash)
+
+                if not subscribedIndexKeys:
+                    continue
+
                 idsToAddToTransaction = set()
 
-                for channel in self._index_to_channel.get(index_key):
-                    if index_key in channel.subscribedIndexKeys and \
-                            channel.subscribedIndexKeys[index_key] >= 0:
-                        # this is a lazy subscription. We're not using the transaction ID yet because
-                        # we don't store it on a per-object basis here. Instead, we're always sending
-                        # everything twice to lazy subscribers.
-                        channelsTriggeredForPriors.add(channel)
+                for index_key in subscribedIndexKeys:
+                    for channel in self._index_to_channel.get(index_key):
+                        if index_key in channel.subscribedIndexKeys and \
+                                channel.subscribedIndexKeys[index_key] >= 0:
+                            # this is a lazy subscription. We're not using the transaction ID yet because
+                            # we don't store it on a per-object basis here. Instead, we're always sending
+                            # everything twice to lazy subscribers.
+                            channelsTriggeredForPriors.add(channel)
 
-                    newIds = adds.difference(channel.subscribedIds)
-                    for new_id in newIds:
-                        self._id_to_channel.setdefault(new_id, set()).add(channel)
-                        channel.subscribedIds.add(new_id)
+                        newIds = adds.difference(channel.subscribedIds)
+                        for new_id in newIds:
+                            self._id_to_channel.setdefault(new_id, set()).add(channel)
+                            channel.subscribedIds.add(new_id)
 
-                    self._broadcastSubscriptionIncrease(channel, index_key, newIds)
+                        self._broadcastSubscriptionIncrease(channel, schema_name, typename, (fieldname, valhash), newIds)
 
-                    idsToAddToTransaction.update(newIds)
+                        idsToAddToTransaction.update(newIds)
 
                 if idsToAddToTransaction:
                     self._increaseBroadcastTransactionToInclude(
@@ -930,12 +2096,11 @@ class Server:
                                   # to explictly compute the union of the relevant set of
                                   # defined fields, as its possible one channel has more fields
                                   # for a type than another and we'd like to broadcast them all
-                        index_key, idsToAddToTransaction, key_value, set_adds, set_removes)
+                        schema_name, typename, idsToAddToTransaction, transaction)
 
-        transaction_message = None
         channelsTriggered = set()
 
-        for schema_type_pair in schemaTypePairsWriting:
+        for schema_type_pair in transaction.schemaTypePairsWriting:
             for channel in self._type_to_channel.get(schema_type_pair, ()):
                 if channel.subscribedTypes[schema_type_pair] >= 0:
                     # this is a lazy subscription. We're not using the transaction ID yet because
@@ -944,33 +2109,11 @@ class Server:
                     channelsTriggeredForPriors.add(channel)
                 channelsTriggered.add(channel)
 
-        for i in identities_mentioned:
+        for i in transaction.identities_mentioned:
             if i in self._id_to_channel:
                 channelsTriggered.update(self._id_to_channel[i])
 
         for channel in channelsTriggeredForPriors:
-            lazy_message = ServerToClient.LazyTransactionPriors(writes=priorValues)  # noqa
-
-        transaction_message = ServerToClient.Transaction(
-            writes={k: v for k, v in key_value.items()},
-            set_adds=set_adds,
-            set_removes=set_removes,
-            transaction_id=transaction_id
-        )
-
-        if self._pendingSubscriptionRecheck is not None:
-            self._pendingSubscriptionRecheck.append(transaction_message)
-
-        for channel in channelsTriggered:
-            channel.sendTransaction(transaction_message)
-
-        if self.verbose or time.time() - t0 > self.longTransactionThreshold:
-            self._logger.info(
-                "Transaction [%.2f/%.2f/%.2f] with %s writes, %s set ops: %s",
-                t1 - t0, t2 - t1, time.time() - t2,
-                len(key_value), len(set_adds) + len(set_removes), sorted(key_value)[:3]
-            )
-
-        self._garbage_collect()
+            lazy_message = ServerToClient.LazyTransactionPriors(writes=transaction.priorValues)  # noqa
 
-        return (True, None)
+        return channelsTriggered
@@ -0,0 +1,170 @@
+#   Copyright 2018 Braxton Mckee
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Counters and latency histograms describing what a Server spends its time on.
+
+A metric family is a tuple (name, type, help, samples), with samples a list of
+(name, labels, value), following the Prometheus data model. 'formatPrometheus' renders
+families in the Prometheus text format, and 'flattenSamples' turns them into the dict
+that a 'Stats' message carries.
+"""
+
+import bisect
+import threading
+
+METRIC_PREFIX = "object_database_"
+
+# upper bounds, in seconds, of the buckets of our latency histograms
+LATENCY_BUCKETS = (
+    .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0
+)
+
+
+def _formatNumber(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, int) or value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def sampleKey(name, labels):
+    """The name of a sample, with its labels, as it appears in the Prometheus text format."""
+    if not labels:
+        return name
+
+    return name + "{" + ",".join(
+        '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in sorted(labels.items())
+    ) + "}"
+
+
+def formatPrometheus(families):
+    """Render metric families in the Prometheus text exposition format."""
+    lines = []
+
+    for name, metricType, help, samples in families:
+        lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s %s" % (name, metricType))
+
+        for sampleName, labels, value in samples:
+            lines.append("%s %s" % (sampleKey(sampleName, labels), _formatNumber(value)))
+
+    return "\n".join(lines) + "\n"
+
+
+def flattenSamples(families):
+    """A dict from the key of each sample in 'families' to its value."""
+    return {
+        sampleKey(sampleName, labels): float(value)
+        for _, _, _, samples in families
+        for sampleName, labels, value in samples
+    }
+
+
+def gauge(name, help, value, labels=None):
+    return (METRIC_PREFIX + name, "gauge", help, [(METRIC_PREFIX + name, labels or {}, value)])
+
+
+class Histogram:
+    """Counts of observed values falling at or below each of 'buckets'."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+
+        # the last count is of values above every bucket
+        self.bucketCounts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.bucketCounts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def samples(self, name):
+        res = []
+        cumulative = 0
+
+        for bound, count in zip(self.buckets + (float("inf"),), self.bucketCounts):
+            cumulative += count
+            res.append((name + "_bucket", {"le": _formatNumber(bound)}, cumulative))
+
+        res.append((name + "_sum", {}, self.sum))
+        res.append((name + "_count", {}, self.count))
+
+        return res
+
+
+class ServerMetrics:
+    """The counters and histograms a Server updates as it runs. Any thread may update them."""
+
+    # name -> help text
+    COUNTERS = {
+        "transactions_total": "Transactions committed.",
+        "transaction_conflicts_total": "Transactions rejected because something they read had changed.",
+        "keys_set_total": "Data keys written by committed transactions.",
+        "index_values_updated_total": "Index values whose identities changed in committed transactions.",
+        "subscriptions_total": "Subscriptions completed.",
+        "gc_keys_examined_total": "Stale keys garbage collection checked for values.",
+        "gc_keys_reclaimed_total": "Version numbers garbage collection dropped.",
+    }
+
+    HISTOGRAMS = {
+        "commit_validate_seconds": "Time spent checking a batch of transactions for conflicts.",
+        "commit_persist_seconds": "Time spent writing a batch of transactions to the kvstore.",
+        "commit_broadcast_seconds":
+            "Time spent waiting for earlier transactions to broadcast and then sending a batch to subscribers.",
+        "commit_shard_lock_wait_seconds": "Time a commit waited for the version-number shard locks.",
+        "commit_server_lock_wait_seconds": "Time a commit waited for the server lock before broadcasting.",
+        "subscription_seconds": "Time spent building and sending a subscription.",
+        "gc_pause_seconds": "Time a slice of garbage collection held a version-number shard lock.",
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {name: 0 for name in self.COUNTERS}
+        self._histograms = {name: Histogram() for name in self.HISTOGRAMS}
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def observe(self, name, value):
+        with self._lock:
+            self._histograms[name].observe(value)
+
+    def counter(self, name):
+        with self._lock:
+            return self._counters[name]
+
+    def histogramCount(self, name):
+        with self._lock:
+            return self._histograms[name].count
+
+    def families(self):
+        with self._lock:
+            res = [
+                (METRIC_PREFIX + name, "counter", self.COUNTERS[name],
+                 [(METRIC_PREFIX + name, {}, self._counters[name])])
+                for name in sorted(self.COUNTERS)
+            ]
+
+            res.extend(
+                (METRIC_PREFIX + name, "histogram", self.HISTOGRAMS[name],
+                 self._histograms[name].samples(METRIC_PREFIX + name))
+                for name in sorted(self.HISTOGRAMS)
+            )
+
+        return res
@@ -1,7 +1,7 @@
 from object_database.database_connection import DatabaseConnection
 from object_database.server import Server
 from object_database.messages import ClientToServer, ServerToClient, getHeartbeatInterval
-from object_database.algebraic_protocol import AlgebraicProtocol
+from object_database.algebraic_protocol import AlgebraicProtocol, DEFAULT_COMPRESSION_THRESHOLD
 from object_database.persistence import InMemoryPersistence
 
 import asyncio
@@ -12,6 +12,13 @@ import threading
 import socket
 import traceback
 
+# what to do with a client whose outbound queue grows past TcpServer.maxOutboundBytes:
+# disconnect it outright, or drop its backlog and tell it to reconnect and resubscribe.
+OVERFLOW_DISCONNECT = "disconnect"
+OVERFLOW_DROP = "drop"
+
+DEFAULT_MAX_OUTBOUND_BYTES = 256 * 1024 * 1024
+
 
 class ServerToClientProtocol(AlgebraicProtocol):
     def __init__(self, dbserver, loop):
@@ -19,8 +26,25 @@ class ServerToClientProtocol(AlgebraicProtocol):
         self.dbserver = dbserver
         self.loop = loop
         self.connectionIsDead = False
+        self.compressionThreshold = dbserver.compressionThreshold
         self._logger = logging.getLogger(__name__)
 
+        # held by a writer from serializing its message until its frame is queued, so frames
+        # go out in the order 'write' was called. The event loop never takes it.
+        self._serializeLock = threading.Lock()
+
+        # frames serialized by the writing thread, waiting for the event loop to flush them.
+        self._outboundLock = threading.Lock()
+        self._outbound = []
+        self._outboundBytes = 0
+        self._flushScheduled = False
+        self._outboundOverflowed = False
+        self.peakOutboundBytes = 0
+
+        # everything we've queued for the client
+        self.messagesWritten = 0
+        self.bytesWritten = 0
+
     def setClientToServerHandler(self, handler):
         def callHandler(*args):
             try:
@@ -37,11 +61,115 @@ class ServerToClientProtocol(AlgebraicProtocol):
         self.dbserver.addConnection(self)
 
     def write(self, msg):
-        if not self.connectionIsDead:
-            self.loop.call_soon_threadsafe(self.sendMessage, msg)
+        """Queue 'msg' for the client.
+
+        Serialization happens on the calling thread. Frames accumulate in a per-connection queue
+        that the event loop flushes with a single 'writelines', so a burst of writes costs one
+        cross-thread wakeup. Concurrent writers queue their frames in the order they called us.
+        """
+        if self.connectionIsDead:
+            return
+
+        with self._serializeLock:
+            try:
+                frame = self.serializeMessage(msg)
+            except Exception:
+                self._logger.error("Error in ServerToClientProtocol: %s", traceback.format_exc())
+                self.loop.call_soon_threadsafe(self.close)
+                return
+
+            if self._enqueueFrame(frame):
+                self.loop.call_soon_threadsafe(self._flushOutbound)
+
+    def _enqueueFrame(self, frame):
+        """Queue 'frame', returning whether the event loop needs to be woken up to flush it."""
+        with self._outboundLock:
+            if self._outboundOverflowed:
+                return False
+
+            self._outbound.append(frame)
+            self._outboundBytes += len(frame)
+            self.messagesWritten += 1
+            self.bytesWritten += len(frame)
+            self.peakOutboundBytes = max(self.peakOutboundBytes, self._outboundBytes)
+
+            # we count everything queued since the last flush, whether the transport is backed
+            # up or the event loop just hasn't gotten to us, since either way we're holding it.
+            if self._outboundBytes > self.dbserver.maxOutboundBytes:
+                self._outboundOverflowed = True
+                self.loop.call_soon_threadsafe(self._handleOutboundOverflow)
+                return False
+
+            if self._flushScheduled:
+                return False
+
+            self._flushScheduled = True
+
+            return True
+
+    @property
+    def outboundQueueDepth(self):
+        return len(self._outbound)
+
+    @property
+    def outboundQueueBytes(self):
+        return self._outboundBytes
+
+    def _flushOutbound(self):
+        with self._outboundLock:
+            if self.writingPaused and not self.connectionIsDead:
+                # leave '_flushScheduled' set so writers don't wake us up.
+                # 'onWritingResumed' will flush once the transport drains.
+                return
+
+            self._flushScheduled = False
+
+            if self.connectionIsDead or self._outboundOverflowed or not self._outbound:
+                return
+
+            frames = self._outbound
+            self._outbound = []
+            self._outboundBytes = 0
+
+        self.transport.writelines(frames)
+
+    def onWritingResumed(self):
+        self._flushOutbound()
+
+    def _handleOutboundOverflow(self):
+        with self._outboundLock:
+            droppedBytes = self._outboundBytes
+            self._outbound = []
+            self._outboundBytes = 0
+
+        if self.connectionIsDead:
+            return
+
+        self.dbserver.outboundOverflowCount += 1
+
+        self._logger.warning(
+            "Client at %s fell %s bytes behind (limit is %s). Applying overflow policy '%s'.",
+            self.transport.get_extra_info('peername'),
+            droppedBytes,
+            self.dbserver.maxOutboundBytes,
+            self.dbserver.outboundOverflowPolicy
+        )
+
+        if self.dbserver.outboundOverflowPolicy == OVERFLOW_DROP:
+            # tell the client its view is stale, so it reconnects and resubscribes,
+            # and let the transport drain what it already holds before closing.
+            self.connectionIsDead = True
+            self.transport.write(self.serializeMessage(ServerToClient.Disconnected()))
+            self.transport.close()
+        else:
+            self.connectionIsDead = True
+            self.transport.abort()
 
     def connection_lost(self, e):
         self.connectionIsDead = True
+        with self._outboundLock:
+            self._outbound = []
+            self._outboundBytes = 0
         _eventLoop.loop.call_later(0.01, self.completeDropConnection)
 
     def completeDropConnection(self):
@@ -151,7 +279,7 @@ class EventLoopInThread:
 _eventLoop = EventLoopInThread()
 
 
-def connect(host, port, auth_token, timeout=10.0, retry=False, eventLoop=_eventLoop):
+def _openChannel(host, port, timeout, retry, eventLoop):
     t0 = time.time()
     # With CLIENT_AUTH we are setting up the SSL to use encryption only, which is what we want.
     # If we also wanted authentication, we would use SERVER_AUTH.
@@ -174,7 +302,13 @@ def connect(host, port, auth_token, timeout=10.0, retry=False, eventLoop=_eventL
     if proto is None:
         raise ConnectionRefusedError()
 
-    conn = DatabaseConnection(proto)
+    return proto
+
+
+def connect(host, port, auth_token, timeout=10.0, retry=False, eventLoop=_eventLoop):
+    t0 = time.time()
+
+    conn = DatabaseConnection(_openChannel(host, port, timeout, retry, eventLoop))
     conn.authenticate(auth_token)
 
     conn.initialized.wait(timeout=max(timeout - (time.time() - t0), 0.0))
@@ -184,6 +318,19 @@ def connect(host, port, auth_token, timeout=10.0, retry=False, eventLoop=_eventL
     return conn
 
 
+def resume(conn, host, port, auth_token, timeout=10.0, retry=False, eventLoop=_eventLoop):
+    """Reconnect the disconnected DatabaseConnection 'conn', catching up on what it missed.
+
+    Returns True if the server could replay the transactions 'conn' missed, and False if
+    'conn' had to resubscribe from scratch.
+    """
+    t0 = time.time()
+
+    channel = _openChannel(host, port, timeout, retry, eventLoop)
+
+    return conn.resume(channel, auth_token, timeout=max(timeout - (time.time() - t0), 0.0))
+
+
 _eventLoop2 = []
 
 
@@ -198,6 +345,16 @@ class TcpServer(Server):
         self.socket_server = None
         self.stopped = False
 
+        # clients that fall more than this many bytes behind their (full) socket buffers
+        # get 'outboundOverflowPolicy' applied.
+        self.maxOutboundBytes = DEFAULT_MAX_OUTBOUND_BYTES
+        self.outboundOverflowPolicy = OVERFLOW_DISCONNECT
+        self.outboundOverflowCount = 0
+
+        # frames to clients at least this large get lz4-compressed, for clients that support it.
+        # None disables compression.
+        self.compressionThreshold = DEFAULT_COMPRESSION_THRESHOLD
+
     def start(self):
         Server.start(self)
 
@@ -217,6 +374,20 @@ class TcpServer(Server):
             except Exception:
                 logging.error("Caught exception in checkForDeadConnections:\n%s", traceback.format_exc())
 
+    def outboundQueueMetrics(self):
+        """Return a dict describing how far behind our clients are."""
+        with self._lock:
+            channels = list(self._clientChannels)
+
+        return dict(
+            connections=len(channels),
+            queuedMessages=sum(c.outboundQueueDepth for c in channels),
+            queuedBytes=sum(c.outboundQueueBytes for c in channels),
+            maxQueuedBytes=max([c.outboundQueueBytes for c in channels] or [0]),
+            peakQueuedBytes=max([c.peakOutboundBytes for c in channels] or [0]),
+            overflowedConnections=self.outboundOverflowCount
+        )
+
     def stop(self):
         Server.stop(self)
 
@@ -234,6 +405,9 @@ class TcpServer(Server):
 
         return connect(self.host, self.port, auth_token, eventLoop=loop)
 
+    def resume(self, conn, auth_token):
+        return resume(conn, self.host, self.port, auth_token)
+
     def __enter__(self):
         self.start()
         return self
@@ -15,6 +15,9 @@
 from typed_python import serialize, deserialize
 
 from object_database.keymapping import *
+import object_database.field_deltas as field_deltas
+import collections
+import concurrent.futures
 import logging
 import threading
 import queue
@@ -22,6 +25,9 @@ import time
 
 LOG_SLOW_COMMIT_THRESHOLD = 1.0
 
+# how many bytes of serialized values we keep the deserialized forms of
+DEFAULT_DESERIALIZED_VALUE_CACHE_BYTES = 64 * 1024 * 1024
+
 
 class DisconnectedException(Exception):
     pass
@@ -37,6 +43,16 @@ class ObjectDoesntExistException(Exception):
         self.obj = obj
 
 
+class FieldNotProjectedException(Exception):
+    def __init__(self, obj, field_name):
+        super().__init__(
+            "%s(%s).%s isn't one of the fields we asked the server for"
+            % (type(obj).__qualname__, obj._identity, field_name)
+        )
+        self.obj = obj
+        self.field_name = field_name
+
+
 def revisionConflictRetry(f):
     MAX_TRIES = 100
 
@@ -58,14 +74,76 @@ def revisionConflictRetry(f):
 
 
 class SerializedDatabaseValue:
-    """A value stored as Json with a python representation."""
+    """A serialized value (or None, for a deleted one) as we got it from the server.
+
+    Views find its python representation in the DeserializedValueCache.
+    """
+    __slots__ = ("serializedByteRep",)
 
-    def __init__(self, serializedByteRep, pyRep):
+    def __init__(self, serializedByteRep):
         assert serializedByteRep is None or isinstance(serializedByteRep, bytes), serializedByteRep
-        self.pyRep = pyRep
         self.serializedByteRep = serializedByteRep
 
 
+class DeserializedValueCache:
+    """A bounded LRU of deserialized values, keyed by their serialized bytes, the type they
+    were deserialized as, the serialization context, and whether they're the stored form of
+    a DeltaEncoded field.
+
+    Views, transaction listeners, and every connection in the process share one of these, so
+    a value that several of them read with the same type and context is deserialized once.
+    Values are keyed by the bytes themselves, which cache their own hash, so copies of the
+    same bytes from different messages share an entry.
+    """
+
+    def __init__(self, maxBytes=DEFAULT_DESERIALIZED_VALUE_CACHE_BYTES):
+        self.maxBytes = maxBytes
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+
+    def get(self, serializedByteRep, field_type, serializationContext, deltaEncoded=False):
+        key = (serializedByteRep, field_type, serializationContext, deltaEncoded)
+
+        with self._lock:
+            value = self._entries.get(key, self)
+            if value is not self:
+                self._entries.move_to_end(key)
+                return value
+
+        if deltaEncoded:
+            value = field_deltas.decode(field_type, serializedByteRep, serializationContext)
+        else:
+            value = deserialize(field_type, serializedByteRep, serializationContext)
+
+        self.put(serializedByteRep, field_type, serializationContext, value, deltaEncoded)
+
+        return value
+
+    def put(self, serializedByteRep, field_type, serializationContext, value, deltaEncoded=False):
+        if len(serializedByteRep) > self.maxBytes:
+            return
+
+        key = (serializedByteRep, field_type, serializationContext, deltaEncoded)
+
+        with self._lock:
+            if key not in self._entries:
+                self._bytes += len(serializedByteRep)
+            self._entries[key] = value
+
+            while self._bytes > self.maxBytes:
+                (evictedBytes, _, _, _), _ = self._entries.popitem(last=False)
+                self._bytes -= len(evictedBytes)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+_deserializedValues = DeserializedValueCache()
+
+
 def coerce_value(value, toType):
     if isinstance(value, toType):
         return value
@@ -97,12 +175,15 @@ class View(object):
         self._indexReads = set()
         self._set_adds = {}
         self._set_removes = {}
+        # the keys in '_writes' of DeltaEncoded fields
+        self._deltaEncodedWrites = set()
         self._t0 = None
         self._stack = None
         self._insistReadsConsistent = True
         self._insistWritesConsistent = True
         self._insistIndexReadsConsistent = False
         self._confirmCommitCallback = None
+        self.confirmation = None
         self._logger = logging.getLogger(__name__)
 
     def db(self):
@@ -153,6 +234,9 @@ class View(object):
 
             writes[data_key(cls, identity, kwd)] = (cls.__types__[kwd], coerced_val)
 
+            if cls.__schema__.isDeltaEncoded(cls, kwd):
+                self._deltaEncodedWrites.add(data_key(cls, identity, kwd))
+
         writes[data_key(cls, identity, " exists")] = (bool, True)
 
         self._writes.update(writes)
@@ -189,34 +273,37 @@ class View(object):
 
             return res
 
-        dbValWithPyrep = self._db._get_versioned_object_data(key, self._transaction_num)
+        if not self._db._isFieldProjected(type(obj), field_name):
+            raise FieldNotProjectedException(obj, field_name)
+
+        dbVal = self._db._get_versioned_object_data(key, self._transaction_num)
 
-        if dbValWithPyrep is None:
+        if dbVal is None:
             if not self._db._isTypeSubscribed(type(obj)):
                 raise Exception("No subscriptions exist for type %s" % obj)
 
             if not obj.exists():
                 raise ObjectDoesntExistException(obj)
 
-        return self.unwrapSerializedDatabaseValue(self.serializationContext, dbValWithPyrep, field_type)
+        return self.unwrapSerializedDatabaseValue(
+            self.serializationContext, dbVal, field_type,
+            obj.__schema__.isDeltaEncoded(type(obj), field_name)
+        )
 
     @staticmethod
-    def unwrapSerializedDatabaseValue(serializationContext, dbValWithPyrep, field_type):
+    def unwrapSerializedDatabaseValue(serializationContext, dbVal, field_type, deltaEncoded=False):
         assert field_type is not None
 
-        if dbValWithPyrep is None:
+        if dbVal is None:
             return default_initialize(field_type)
 
-        if isinstance(dbValWithPyrep, str):
-            dbValWithPyrep = SerializedDatabaseValue(bytes.fromhex(dbValWithPyrep), {})
+        if isinstance(dbVal, bytes):
+            dbVal = SerializedDatabaseValue(dbVal)
 
-        if dbValWithPyrep.serializedByteRep is None:
+        if dbVal.serializedByteRep is None:
             return default_initialize(field_type)
 
-        if dbValWithPyrep.pyRep.get(serializationContext) is None:
-            dbValWithPyrep.pyRep[serializationContext] = deserialize(field_type, dbValWithPyrep.serializedByteRep, serializationContext)
-
-        return dbValWithPyrep.pyRep[serializationContext]
+        return _deserializedValues.get(dbVal.serializedByteRep, field_type, serializationContext, deltaEncoded)
 
     def _exists(self, obj, identity):
         if not self._db._isTypeSubscribed(type(obj)):
@@ -262,6 +349,9 @@ class View(object):
 
         key = data_key(type(obj), identity, field_name)
 
+        if obj.__schema__.isDeltaEncoded(type(obj), field_name):
+            self._deltaEncodedWrites.add(key)
+
         if field_name not in obj.__schema__._indexed_fields[type(obj)]:
             self._writes[key] = (field_type, val)
         else:
@@ -328,39 +418,159 @@ class View(object):
         else:
             self._set_removes[index_key].add(identity)
 
+    def _planLookup(self, db_type, kwargs):
+        """Decide how to find the objects of 'db_type' that match every condition in 'kwargs'.
+
+        Returns a list of (fieldname, value, index_key, members, estimatedSize) steps: the index
+        lookups to intersect, smallest first, followed by the conditions on unindexed fields
+        we have to check object by object, which have no index_key or members. If no condition
+        is indexed, we start from every object of the type.
+        """
+        indices = db_type.__schema__._indices.get(db_type, {})
+
+        indexSteps = []
+        filterSteps = []
+
+        for fieldname, value in kwargs.items():
+            if fieldname in indices:
+                indexType = db_type.__schema__._indexTypes[db_type][fieldname]
+
+                if indexType is not None:
+                    value = indexType(value)
+
+                keyname = index_key(db_type, fieldname, value)
+
+                members = self._db._get_versioned_set_data(keyname, self._transaction_num)
+
+                estimatedSize = (
+                    members.estimatedSize()
+                    + len(self._set_adds.get(keyname, ()))
+                    - len(self._set_removes.get(keyname, ()))
+                )
+
+                indexSteps.append((fieldname, value, keyname, members, estimatedSize))
+            elif fieldname in db_type.__types__:
+                filterSteps.append((fieldname, value, None, None, None))
+            else:
+                raise Exception(
+                    "No index or field %s.%s.%s" % (db_type.__schema__.name, db_type.__qualname__, fieldname)
+                )
+
+        if not indexSteps:
+            return self._planLookup(db_type, {" exists": True}) + filterSteps
+
+        indexSteps.sort(key=lambda step: step[4])
+
+        return indexSteps + filterSteps
+
+    def _indexContains(self, keyname, members, identity):
+        if identity in self._set_adds.get(keyname, ()):
+            return True
+        if identity in self._set_removes.get(keyname, ()):
+            return False
+        return members.contains(identity)
+
     def indexLookup(self, db_type, **kwargs):
+        """The objects of 'db_type' matching every fieldname=value condition in kwargs.
+
+        We start from the smallest index set, keep the objects in each of the other index sets,
+        and only then read unindexed fields to check the remaining conditions.
+        """
         if not self._db._isTypeSubscribed(db_type):
             raise Exception("No subscriptions exist for type %s" % db_type)
 
-        assert len(kwargs) == 1, "Can only lookup one index at a time."
-        tname, value = list(kwargs.items())[0]
-
-        if db_type not in db_type.__schema__._indices or tname not in db_type.__schema__._indices[db_type]:
-            raise Exception("No index enabled for %s.%s.%s" % (db_type.__schema__.name, db_type.__qualname__, tname))
-
         if not hasattr(_cur_view, "view"):
             raise Exception("Please access indices from within a view.")
 
-        indexType = db_type.__schema__._indexTypes[db_type][tname]
+        assert kwargs, "Can't lookup without any conditions."
 
-        if indexType is not None:
-            value = indexType(value)
+        plan = self._planLookup(db_type, kwargs)
 
-        keyname = index_key(db_type, tname, value)
+        _, _, keyname, members, _ = plan[0]
 
         self._indexReads.add(keyname)
 
-        identities = self._db._get_versioned_set_data(keyname, self._transaction_num).toSet()
+        identities = members.toSet()
         identities = identities.union(self._set_adds.get(keyname, set()))
         identities = identities.difference(self._set_removes.get(keyname, set()))
 
+        for fieldname, value, keyname, members, _ in plan[1:]:
+            if not identities:
+                break
+
+            if keyname is not None:
+                self._indexReads.add(keyname)
+                identities = set(i for i in identities if self._indexContains(keyname, members, i))
+            else:
+                identities = set(i for i in identities if getattr(db_type.fromIdentity(i), fieldname) == value)
+
         return tuple([db_type.fromIdentity(x) for x in identities])
 
-    def indexLookupAny(self, db_type, **kwargs):
+    def explainLookup(self, db_type, **kwargs):
+        """Describe how indexLookup would find the objects matching 'kwargs', one step per line."""
+        lines = []
+
+        for fieldname, value, keyname, members, estimatedSize in self._planLookup(db_type, kwargs):
+            if keyname is None:
+                lines.append("filter on unindexed %s == %r" % (fieldname, value))
+            elif fieldname == " exists":
+                lines.append("start from all objects (~%s objects)" % estimatedSize)
+            else:
+                lines.append(
+                    "%s index %s == %r (~%s objects)" % (
+                        "intersect with" if lines else "start from", fieldname, value, estimatedSize
+                    )
+                )
+
+        return "\n".join(lines)
+
+    def indexLookupRange(self, db_type, **kwargs):
+        """The objects whose value of an ordered index is in a range, in order of that value.
+
+        The range is given as fieldname=(low, high). 'low' is inclusive and 'high' exclusive,
+        and either may be None. We only check the index values we read for conflicts, so
+        objects that other transactions move into the range won't cause a conflict.
+        """
         if not self._db._isTypeSubscribed(db_type):
             raise Exception("No subscriptions exist for type %s" % db_type)
 
         assert len(kwargs) == 1, "Can only lookup one index at a time."
+        tname, (low, high) = list(kwargs.items())[0]
+
+        if not hasattr(_cur_view, "view"):
+            raise Exception("Please access indices from within a view.")
+
+        low_hash, high_hash = index_range_hashes(db_type, tname, low, high)
+
+        group = index_group(db_type.__schema__.name, db_type.__qualname__, tname)
+
+        keynames = set(self._db._get_set_keys_in_range(group, low_hash, high_hash))
+
+        for keyname in self._set_adds:
+            if keyname.startswith(group + ":") and index_hash_in_range(keyname[len(group) + 1:], low_hash, high_hash):
+                keynames.add(keyname)
+
+        result = []
+
+        for keyname in sorted(keynames):
+            self._indexReads.add(keyname)
+
+            identities = self._db._get_versioned_set_data(keyname, self._transaction_num).toSet()
+            identities = identities.union(self._set_adds.get(keyname, set()))
+            identities = identities.difference(self._set_removes.get(keyname, set()))
+
+            result.extend(db_type.fromIdentity(x) for x in identities)
+
+        return tuple(result)
+
+    def indexLookupAny(self, db_type, **kwargs):
+        if not self._db._isTypeSubscribed(db_type):
+            raise Exception("No subscriptions exist for type %s" % db_type)
+
+        if len(kwargs) != 1:
+            res = self.indexLookup(db_type, **kwargs)
+            return res[0] if res else None
+
         tname, value = list(kwargs.items())[0]
 
         if db_type not in db_type.__schema__._indices or tname not in db_type.__schema__._indices[db_type]:
@@ -402,70 +612,165 @@ class View(object):
             raise Exception("Multiple instances of %s found with %s" % (lookup_type, kwargs))
         return res[0]
 
-    def commit(self):
+    def _encodeDeltas(self):
+        """The frames (see field_deltas) for our writes to DeltaEncoded fields that are small
+        changes to the values we started from, by key. We write the other ones in full."""
+        deltas = {}
+
+        if not self._db._acceptsDeltaWrites():
+            return deltas
+
+        for key in self._deltaEncodedWrites:
+            write = self._writes.get(key)
+
+            if write is None:
+                continue
+
+            field_type, value = write
+
+            prior = self._db._get_versioned_object_data(key, self._transaction_num)
+
+            if prior is None or prior.serializedByteRep is None:
+                continue
+
+            if field_deltas.chainLength(prior.serializedByteRep) >= field_deltas.MAX_DELTA_CHAIN_LENGTH:
+                continue
+
+            frames = field_deltas.encodeChange(
+                field_type,
+                self.unwrapSerializedDatabaseValue(self.serializationContext, prior, field_type, True),
+                value,
+                self.serializationContext
+            )
+
+            if frames is not None:
+                deltas[key] = frames
+
+                _deserializedValues.put(
+                    prior.serializedByteRep + frames, field_type, self.serializationContext, value, True
+                )
+
+        return deltas
+
+    def _checkCommittable(self):
         if not self._writeable:
             raise Exception("Views are static. Please open a transaction.")
 
-        if self._writes:
-            def encode(val):
-                if isinstance(val, tuple) and len(val) == 2 and isinstance(val[0], type):
-                    return SerializedDatabaseValue(
-                        serialize(val[0], val[1], self.serializationContext),
-                        {self.serializationContext: val[1]}
-                    )
+        if (self._set_adds or self._set_removes) and not self._insistReadsConsistent:
+            raise Exception("You can't update an indexed value without read and write consistency.")
 
-                elif val is None:
-                    return SerializedDatabaseValue(val, {})
-                else:
-                    assert False, "bad write: %s" % val
+    def _sendWrites(self, confirmCallback):
+        """Send our writes to the server, which answers by calling 'confirmCallback' with a
+        TransactionResult."""
+        def encode(key, val):
+            if isinstance(val, tuple) and len(val) == 2 and isinstance(val[0], type):
+                deltaEncoded = key in self._deltaEncodedWrites
 
-            writes = {key: encode(v) for key, v in self._writes.items()}
-            tid = self._transaction_num
+                if deltaEncoded:
+                    serializedByteRep = field_deltas.encodeValue(val[0], val[1], self.serializationContext)
+                else:
+                    serializedByteRep = serialize(val[0], val[1], self.serializationContext)
 
-            if (self._set_adds or self._set_removes) and not self._insistReadsConsistent:
-                raise Exception("You can't update an indexed value without read and write consistency.")
+                # we'll read this back as soon as the server confirms it, so don't make
+                # the next view deserialize what we already have
+                _deserializedValues.put(
+                    serializedByteRep, val[0], self.serializationContext, val[1], deltaEncoded
+                )
 
-            if self._confirmCommitCallback is None:
-                result_queue = queue.Queue()
+                return SerializedDatabaseValue(serializedByteRep)
 
-                confirmCallback = result_queue.put
+            elif val is None:
+                return SerializedDatabaseValue(val)
             else:
-                confirmCallback = self._confirmCommitCallback
-
-            self._db._set_versioned_object_data(
-                writes,
-                {k: v for k, v in self._set_adds.items() if v},
-                {k: v for k, v in self._set_removes.items() if v},
-                (
-                    self._reads.union(set(writes)) if self._insistReadsConsistent else
-                    set(writes) if self._insistWritesConsistent else
-                    set()
-                ),
-                self._indexReads if self._insistIndexReadsConsistent else set(),
-                tid,
-                confirmCallback
-            )
+                assert False, "bad write: %s" % val
+
+        deltas = self._encodeDeltas()
+        writes = {key: encode(key, v) for key, v in self._writes.items() if key not in deltas}
+        written = set(writes) | set(deltas)
+
+        self._db._set_versioned_object_data(
+            writes,
+            {k: v for k, v in self._set_adds.items() if v},
+            {k: v for k, v in self._set_removes.items() if v},
+            (
+                self._reads.union(written) if self._insistReadsConsistent else
+                written if self._insistWritesConsistent else
+                set()
+            ),
+            self._indexReads if self._insistIndexReadsConsistent else set(),
+            self._transaction_num,
+            confirmCallback,
+            deltas
+        )
 
-            if not self._confirmCommitCallback:
-                # this is the synchronous case - we want to wait for the confirm
-                t0 = time.time()
+    def commit(self):
+        self._checkCommittable()
 
-                res = result_queue.get()
+        if not self._writes:
+            return
 
-                if time.time() - t0 > LOG_SLOW_COMMIT_THRESHOLD:
-                    self._logger.info(
-                        "Committing %s writes and %s set changes took %.1f seconds",
-                        len(self._writes), len(self._set_adds) + len(self._set_removes), time.time() - t0
-                    )
+        if self.confirmation is not None:
+            confirmation = self.confirmation
+
+            self._db._acquirePipelineSlot()
+
+            def confirmCallback(res):
+                self._db._releasePipelineSlot()
+                _resolveWithTransactionResult(confirmation, res)
+
+            self._sendWrites(confirmCallback)
+
+        elif self._confirmCommitCallback is not None:
+            self._sendWrites(self._confirmCommitCallback)
+
+        else:
+            # this is the synchronous case - we want to wait for the confirm
+            result_queue = queue.Queue()
+
+            self._sendWrites(result_queue.put)
+
+            t0 = time.time()
+
+            res = result_queue.get()
+
+            if time.time() - t0 > LOG_SLOW_COMMIT_THRESHOLD:
+                self._logger.info(
+                    "Committing %s writes and %s set changes took %.1f seconds",
+                    len(self._writes), len(self._set_adds) + len(self._set_removes), time.time() - t0
+                )
+
+            if res.matches.Success:
+                return
+            if res.matches.Disconnected:
+                raise DisconnectedException()
+            if res.matches.RevisionConflict:
+                raise RevisionConflictException(res.key)
+
+            assert False, "unknown transaction result: " + str(res)
+
+    def commitFuture(self):
+        """Commit without waiting for the server, returning a concurrent.futures.Future that
+        resolves once it accepts the transaction, or raises the exception 'commit' would have.
+
+        If the transaction has its own onConfirmed or noconfirm callback, that hears the
+        result instead, and the future resolves at once.
+        """
+        if self.confirmation is not None:
+            raise Exception("Pipelined transactions already have a future: wait on 'confirmation'.")
 
-                if res.matches.Success:
-                    return
-                if res.matches.Disconnected:
-                    raise DisconnectedException()
-                if res.matches.RevisionConflict:
-                    raise RevisionConflictException(res.key)
+        self._checkCommittable()
 
-                assert False, "unknown transaction result: " + str(res)
+        future = concurrent.futures.Future()
+
+        if not self._writes or self._confirmCommitCallback is not None:
+            if self._writes:
+                self._sendWrites(self._confirmCommitCallback)
+
+            future.set_result(None)
+        else:
+            self._sendWrites(lambda res: _resolveWithTransactionResult(future, res))
+
+        return future
 
     def nocommit(self):
         class Scope:
@@ -484,13 +789,33 @@ class View(object):
         return self
 
     def __exit__(self, type, val, tb):
+        self.finish(type)
+
+    def finish(self, exceptionType=None, commit=None):
+        """Stop being the current view and release it, as leaving a 'with' block does.
+
+        Unless 'exceptionType' says the block raised, we first commit any writes by calling
+        'commit' (self.commit by default), and return what it returns.
+        """
         del _cur_view.view
+
+        committed = False
+
         try:
-            if type is None and self._writes:
-                self.commit()
+            if exceptionType is None and self._writes:
+                result = (commit or self.commit)()
+                committed = True
+                return result
         finally:
             self._db._releaseView(self)
 
+            if self.confirmation is not None and not committed:
+                # nothing to commit, or we never got to commit it
+                if exceptionType is None and not self._writes:
+                    self.confirmation.set_result(None)
+                else:
+                    self.confirmation.cancel()
+
 
 class Transaction(View):
     _writeable = True
@@ -527,6 +852,22 @@ class Transaction(View):
 
         return self
 
+    def pipelined(self):
+        """Commit without waiting for the server. 'self.confirmation' becomes a
+        concurrent.futures.Future that resolves once the server accepts the transaction, or
+        raises the RevisionConflictException or DisconnectedException that commit would have.
+
+        A connection can have 'maxPipelinedCommits' of these waiting on the server at once,
+        after which commit blocks until one of them resolves. The server commits them in the
+        order they were committed, but each one sees the database as it was when it was
+        opened, without the writes of the ones still in flight. A transaction that reads
+        what an earlier one writes will conflict unless it's opened after the earlier one's
+        confirmation resolves, at which point the connection has seen its writes.
+        """
+        self.confirmation = concurrent.futures.Future()
+
+        return self
+
     def noconfirm(self):
         """Indicate that the transaction should return immediately without a round-trip to
         confirm that it was successful."""
@@ -537,6 +878,16 @@ class Transaction(View):
         return self
 
 
+def _resolveWithTransactionResult(future, res):
+    """Resolve a concurrent.futures.Future the way 'commit' treats the TransactionResult 'res'."""
+    if res.matches.Success:
+        future.set_result(None)
+    elif res.matches.Disconnected:
+        future.set_exception(DisconnectedException())
+    else:
+        future.set_exception(RevisionConflictException(res.key))
+
+
 def current_transaction():
     if not hasattr(_cur_view, "view"):
         return None
@@ -769,8 +769,12 @@ PyObject *deserialize(PyObject* nullValue, PyObject* args) {
         PyErr_SetString(PyExc_TypeError, "first argument to serialize must be a native type object");
         return NULL;
     }
-    if (!PyBytes_Check(a2)) {
-        PyErr_SetString(PyExc_TypeError, "second argument to serialize must be a bytes object");
+    // accept anything exposing a contiguous buffer (bytes, bytearray, memoryview), so that
+    // callers can deserialize a slice of a larger buffer without copying it first.
+    Py_buffer view;
+    if (PyObject_GetBuffer(a2, &view, PyBUF_SIMPLE) == -1) {
+        PyErr_Clear();
+        PyErr_SetString(PyExc_TypeError, "second argument to deserialize must be a bytes-like object");
         return NULL;
     }
 
@@ -779,7 +783,9 @@ PyObject *deserialize(PyObject* nullValue, PyObject* args) {
         context.reset(new PythonSerializationContext(a3));
     }
 
-    DeserializationBuffer buf((uint8_t*)PyBytes_AsString(a2), PyBytes_GET_SIZE(a2), *context);
+    DeserializationBuffer buf((uint8_t*)view.buf, view.len, *context);
+
+    PyObject* result = NULL;
 
     try {
         Instance i = Instance::createAndInitialize(serializeType, [&](instance_ptr p) {
@@ -787,13 +793,15 @@ PyObject *deserialize(PyObject* nullValue, PyObject* args) {
             serializeType->deserialize(p, buf);
         });
 
-        return PyInstance::extractPythonObject(i.data(), i.type());
+        result = PyInstance::extractPythonObject(i.data(), i.type());
     } catch(std::exception& e) {
         PyErr_SetString(PyExc_TypeError, e.what());
-        return NULL;
     } catch(PythonExceptionSet& e) {
-        return NULL;
     }
+
+    PyBuffer_Release(&view);
+
+    return result;
 }
 
 PyObject *is_default_constructible(PyObject* nullValue, PyObject* args) {
@@ -690,6 +690,17 @@ class NativeTypesTests(unittest.TestCase):
         x = deserialize(str, serialize(str, "a"))
         self.assertTrue(isinstance(x, str))
 
+    def test_deserialize_from_buffers(self):
+        t = TupleOf(str)
+        data = serialize(t, ("a", "bc"))
+        buffer = bytearray(b"junk" + data + b"junk")
+
+        self.assertEqual(deserialize(t, bytearray(data)), ("a", "bc"))
+        self.assertEqual(deserialize(t, memoryview(buffer)[4:4 + len(data)]), ("a", "bc"))
+
+        with self.assertRaises(TypeError):
+            deserialize(t, 10)
+
     def test_dict_containment(self):
         for _ in range(100):
             producer = RandomValueProducer()